@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 
 # System libraries
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import json
 import logging
+import math
+import mmap
 import re
+import select
 import shlex
+import pickle
+import random
+import sqlite3
+from stat import S_ISDIR, S_ISLNK
 import struct
 import subprocess
 import sys
+import tempfile
 import time
-from threading import Thread
+from threading import Lock, Thread, local
+import zlib
 
 # Additional libraries
 import ConfigParser
@@ -19,6 +32,10 @@ except ImportError, e:
     print 'Hint: try running "pip install hurry.filesize"'
     sys.exit(1)
 import os
+try:
+    import numpy
+except ImportError:
+    numpy = None
 try:
     import pexpect
 except ImportError, e:
@@ -26,6 +43,80 @@ except ImportError, e:
     print 'Hint: try running "pip install pexpect"'
     sys.exit(1)
 
+# os.scandir is only built in from python 3.5 onward.  Fall back to the
+# scandir backport, and failing that to os.listdir plus os.lstat.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Some system calls are not wrapped by the os module (or only by newer
+# python versions) and are called through libc instead.
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (ImportError, OSError):
+    _libc = None
+
+# os.posix_fadvise is only built in from python 3.3 onward.  Fall back to
+# calling libc directly, and failing that make fadvise() a no-op.
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED, \
+        POSIX_FADV_DONTNEED
+except ImportError:
+    POSIX_FADV_SEQUENTIAL = 2
+    POSIX_FADV_WILLNEED = 3
+    POSIX_FADV_DONTNEED = 4
+    try:
+        _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                        ctypes.c_int64, ctypes.c_int]
+
+        def posix_fadvise(fd, offset, length, advice):
+            _libc.posix_fadvise(fd, offset, length, advice)
+    except AttributeError:
+        posix_fadvise = None
+
+# Linux fallocate(2), unlike posix_fallocate(3), fails with EOPNOTSUPP rather
+# than silently emulating the allocation by writing to every block.
+try:
+    _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                                ctypes.c_int64]
+
+    def fallocate(fd, offset, length):
+        if _libc.fallocate(fd, 0, offset, length):
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+except AttributeError:
+    fallocate = None
+
+# inotify(7) is likewise only reachable through libc.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 04000
+try:
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                        ctypes.c_uint32]
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    inotify = _libc
+except AttributeError:
+    inotify = None
+
 # https://stackoverflow.com/questions/375427
 # /non-blocking-read-on-a-subprocess-pipe-in-python
 try:
@@ -49,8 +140,38 @@ class Unbuffered:
         return getattr(self.stream, attr)
 
 
+# Archives backed up in parallel tag their status lines and write each one
+# whole, so that the output of different archives does not interleave.
+status_lock = Lock()
+status_local = local()
+
+
+def status_prefix(prefix):
+    """ Tag the status lines the calling thread writes from now on with
+    prefix.  Its lines are then held back until complete and written under
+    status_lock. """
+    status_local.prefix = prefix
+    status_local.line = ''
+
+
+def status_thread(target, args=()):
+    """ Return a thread running target which tags its status lines like the
+    calling thread does. """
+    prefix = getattr(status_local, 'prefix', None)
+
+    def run(*args):
+        if prefix is not None:
+            status_prefix(prefix)
+        target(*args)
+    return Thread(target=run, args=args)
+
+
 def status_item(item):
-    sys.stdout.write('%38s: ' % item)
+    if getattr(status_local, 'prefix', None) is None:
+        with status_lock:
+            sys.stdout.write('%38s: ' % item)
+    else:
+        status_local.line += '%38s: ' % item
 
 
 def status_result(result, type=0, no_newline=False):
@@ -59,25 +180,47 @@ def status_result(result, type=0, no_newline=False):
     1 is success (green), 2 is warning (yellow), 3 is error (red), and 4 is
     success with action taken (blue). """
     if type == 0:
-        print result,
+        text = result
     elif type == 1:
-        print '\033[32m' + result + '\033[0m',
+        text = '\033[32m' + result + '\033[0m'
     elif type == 2:
-        print '\033[33m' + result + '\033[0m',
+        text = '\033[33m' + result + '\033[0m'
     elif type == 3:
-        print '\033[31m' + result + '\033[0m',
+        text = '\033[31m' + result + '\033[0m'
     elif type == 4:
-        print '\033[34m' + result + '\033[0m',
+        text = '\033[34m' + result + '\033[0m'
+    else:
+        text = '\033[31mINVALID status_result() type specified\033[0m'
+
+    if getattr(status_local, 'prefix', None) is None:
+        with status_lock:
+            print text,
+            if not no_newline:
+                print
+    elif no_newline:
+        status_local.line += text + ' '
     else:
-        print '\033[31mINVALID status_result() type specified\033[0m',
+        line = status_local.line
+        status_local.line = ''
+        status_line(line + text)
 
-    if not no_newline:
-        print
 
+def status_line(text):
+    """ Write a whole line of output, tagged like the calling thread's
+    status lines. """
+    with status_lock:
+        sys.stdout.write((getattr(status_local, 'prefix', None) or '') +
+                         text + '\n')
 
-def print_pipe(type_type, pipe):
+
+def print_pipe(type_type, pipe, parser=None, prefix=''):
+    """ Echo a child's output, optionally feeding each line to a parser. """
     for line in iter(pipe.readline, ''):
-        print('    ' + line.rstrip())
+        with status_lock:
+            sys.stdout.write(getattr(status_local, 'prefix', None) or '')
+            print('    ' + prefix + line.rstrip())
+        if parser:
+            parser.feed(line)
 
 
 def print_header(activity):
@@ -103,8 +246,414 @@ def print_footer(activity, time_init):
     print '*' * 79
 
 
+class run_report:
+    """ Time the phases of a run, for the whole run and for each archive,
+    and write them out as JSON once the run is over.  Phases which run more
+    than once, such as several rsync passes, are added up.  Archives may be
+    processed on several threads at once. """
+
+    def __init__(self, activity):
+        self.lock = Lock()
+        self.activity = activity
+        self.started = time.time()
+        self.phases = {}
+        self.archives = {}
+
+    def phase(self, archive, name):
+        """ Return the totals of a phase, for an archive or (if archive is
+        None) the run as a whole. """
+        if archive is None:
+            phases = self.phases
+        else:
+            phases = self.archives.setdefault(archive, {'phases': {}}
+                                              )['phases']
+        return phases.setdefault(name, {'seconds': 0.0, 'calls': 0,
+                                        'bytes': 0, 'items': 0})
+
+    @contextmanager
+    def span(self, archive, name):
+        """ Time the enclosed block as a phase.  The block may fill in the
+        bytes and items it processed in the dict it is given. """
+        counts = {}
+        time_init = time.time()
+        try:
+            yield counts
+        finally:
+            with self.lock:
+                phase = self.phase(archive, name)
+                phase['seconds'] += time.time() - time_init
+                phase['calls'] += 1
+                phase['bytes'] += counts.get('bytes', 0)
+                phase['items'] += counts.get('items', 0)
+
+    def set(self, archive, key, value):
+        """ Record a fact about an archive, such as its result. """
+        with self.lock:
+            self.archives.setdefault(archive, {'phases': {}})[key] = value
+
+    def totals(self):
+        """ Return every phase added up across the run and its archives. """
+        totals = {}
+        for phases in [self.phases] + \
+                [a['phases'] for a in self.archives.values()]:
+            for name, phase in phases.items():
+                total = totals.setdefault(name, dict.fromkeys(phase, 0))
+                for key in phase:
+                    total[key] += phase[key]
+        return totals
+
+    def write(self, file, rc=None):
+        """ Write the report, replacing the file in one step. """
+        with self.lock:
+            report = {'activity': self.activity,
+                      'started': self.started,
+                      'finished': time.time(),
+                      'elapsed': time.time() - self.started,
+                      'returncode': rc,
+                      'phases': self.phases,
+                      'archives': self.archives,
+                      'totals': self.totals()}
+            try:
+                with open(file + '.tmp', 'w') as f:
+                    f.write(json.dumps(report, indent=1, sort_keys=True))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(file + '.tmp', file)
+            except (IOError, OSError):
+                logging.getLogger().warning(file + ': could not write run '
+                                            'report')
+                return
+        logging.getLogger().info('run report ' + file)
+
+
+def metrics_label(value):
+    """ Quote a Prometheus label value. """
+    return '"' + str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n') + '"'
+
+
+def metrics_write(metrics_dir, report, rc):
+    """ Write a run report as a Prometheus textfile for node_exporter's
+    textfile collector, as metrics_dir/archiver3_<activity>.prom.  The file
+    is written under another name and renamed into place, so a scrape
+    never sees it half written.  The last success of each archive is
+    carried over from the previous file, so an archive which failed, or
+    was not run, keeps reporting when it last succeeded. """
+    activity = report.activity
+    file = metrics_dir + 'archiver3_' + activity + '.prom'
+    last_success = {}
+    pattern = re.compile(r'^archiver3_archive_last_success_timestamp_seconds'
+                         r'\{activity="[^"]*",archive="((?:[^"\\]|\\.)*)"'
+                         r'\} (\S+)$')
+    if os.path.isfile(file):
+        for line in open(file):
+            match = pattern.match(line)
+            if match:
+                archive = re.sub(r'\\(.)', lambda m: m.group(1) == 'n' and
+                                 '\n' or m.group(1), match.group(1))
+                last_success[archive] = match.group(2)
+    with report.lock:
+        finished = time.time()
+        archives = dict((a, dict(facts)) for a, facts in
+                        report.archives.items())
+        phases = dict(report.phases)
+    for archive, facts in archives.items():
+        if facts.get('returncode') == 0:
+            last_success[archive] = '%.3f' % finished
+
+    metrics = []
+
+    def metric(name, kind, help, samples):
+        """ Add a metric family: samples are (labels, value) pairs, where
+        labels is a list of (label, value) pairs. """
+        if not samples:
+            return
+        metrics.append('# HELP archiver3_' + name + ' ' + help)
+        metrics.append('# TYPE archiver3_' + name + ' ' + kind)
+        for labels, value in samples:
+            metrics.append('archiver3_' + name + '{' + ','.join(
+                [k + '=' + metrics_label(v) for k, v in
+                 [('activity', activity)] + labels]) + '} ' + str(value))
+
+    metric('last_run_timestamp_seconds', 'gauge',
+           'When the last run finished.', [([], '%.3f' % finished)])
+    metric('last_run_duration_seconds', 'gauge',
+           'How long the last run took.',
+           [([], '%.3f' % (finished - report.started))])
+    metric('last_run_success', 'gauge',
+           'Whether the last run succeeded.', [([], int(rc == 0))])
+    metric('archive_last_success_timestamp_seconds', 'gauge',
+           'When each archive last completed successfully.',
+           [([('archive', a)], last_success[a])
+            for a in sorted(last_success)])
+    metric('archive_success', 'gauge',
+           'Whether each archive succeeded in the last run.',
+           [([('archive', a)], int(archives[a]['returncode'] == 0))
+            for a in sorted(archives) if 'returncode' in archives[a]])
+    metric('phase_duration_seconds', 'gauge',
+           'Time spent in each phase of the last run.',
+           [([('archive', ''), ('phase', p)], '%.3f' % phases[p]['seconds'])
+            for p in sorted(phases)] +
+           [([('archive', a), ('phase', p)],
+             '%.3f' % archives[a]['phases'][p]['seconds'])
+            for a in sorted(archives) for p in sorted(archives[a]['phases'])])
+    metric('phase_bytes', 'gauge',
+           'Bytes processed in each phase of the last run.',
+           [([('archive', a), ('phase', p)], archives[a]['phases'][p]['bytes'])
+            for a in sorted(archives) for p in sorted(archives[a]['phases'])
+            if archives[a]['phases'][p]['bytes']])
+    transfers = [(a, archives[a]['transfer']) for a in sorted(archives)
+                 if 'transfer' in archives[a]]
+    metric('transferred_bytes', 'gauge',
+           'Bytes rsync transferred for each archive in the last run.',
+           [([('archive', a)], t['bytes']) for a, t in transfers])
+    metric('transferred_files', 'gauge',
+           'Files rsync transferred for each archive in the last run.',
+           [([('archive', a)], t['transferred']) for a, t in transfers])
+    metric('deleted_files', 'gauge',
+           'Files rsync deleted for each archive in the last run.',
+           [([('archive', a)], t['deleted']) for a, t in transfers])
+    metric('container_fill_percent', 'gauge',
+           'Anticipated consumption of each encrypted filesystem once its '
+           'archive is synchronized.',
+           [([('archive', a)], '%.2f' % archives[a]['consumption'])
+            for a in sorted(archives) if 'consumption' in archives[a]])
+    metric('digests', 'gauge',
+           'Entries in the digest store of each archive.',
+           [([('archive', a)], archives[a]['digests'])
+            for a in sorted(archives) if 'digests' in archives[a]])
+    metric('validated_files', 'gauge',
+           'Files validated in the last run, by outcome.',
+           [([('archive', a), ('outcome', o)], archives[a][o])
+            for a in sorted(archives)
+            for o in ('hashed', 'unchanged', 'mismatch', 'deferred',
+                      'chunked') if o in archives[a]])
+    metric('verified_files', 'gauge',
+           'Remote files verified in the last run, by outcome.',
+           [([('archive', a), ('outcome', o.lower())],
+             archives[a]['verify'][o])
+            for a in sorted(archives) if 'verify' in archives[a]
+            for o in sorted(archives[a]['verify'])])
+
+    try:
+        tmp = file + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(metrics) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, file)
+    except (IOError, OSError):
+        logging.getLogger().warning(file + ': could not write metrics')
+        return 1
+
+
+def fadvise(fd, offset, length, advice):
+    """ Advise the kernel how a file is about to be accessed, for example
+    POSIX_FADV_DONTNEED to drop pages we read once so that a long scan does
+    not evict everybody else's page cache.  This is only a hint, so any
+    failure is silently ignored. """
+    if posix_fadvise is None:
+        return
+    try:
+        posix_fadvise(fd, offset, length, advice)
+    except (OSError, IOError):
+        pass
+
+
+def filesystem_type(path):
+    """ Return the type of the filesystem a path lives on, as listed in
+    /proc/self/mounts, or None if it cannot be determined. """
+    path = os.path.realpath(path)
+    best = ''
+    fstype = None
+    try:
+        mounts = open('/proc/self/mounts').read().splitlines()
+    except IOError:
+        return
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mountpoint = fields[1].replace('\\040', ' ')
+        if (path == mountpoint or
+                path.startswith(mountpoint.rstrip('/') + '/')) and \
+                len(mountpoint) >= len(best):
+            best = mountpoint
+            fstype = fields[2]
+    return fstype
+
+
+def provision_progress(done, total, time_init, final=False):
+    """ Show an in-place progress line while provisioning a container. """
+    elapsed = max(time.time() - time_init, 0.001)
+    rate = done / elapsed
+    if rate and done < total:
+        eta = '%ds' % ((total - done) / rate)
+    else:
+        eta = '0s'
+    sys.stdout.write('\r    %5.1f%%  %s/%s  %s/s  eta %s    ' %
+                     (float(done) / total * 100 if total else 100,
+                      size(done), size(total), size(int(rate)), eta))
+    if final:
+        print
+
+
+def provision_sparse(fd, length, verbose=False):
+    """ Extend a file without allocating any blocks.  Instant, but the space
+    is not reserved, so writes into the container can later fail if the
+    filesystem fills up. """
+    os.ftruncate(fd, length)
+
+
+def provision_fallocate(fd, length, verbose=False, offset=0):
+    """ Reserve blocks for a file without writing them.  Fast and safe, but
+    only supported by some filesystems. """
+    if fallocate is None:
+        raise OSError(errno.EOPNOTSUPP, 'fallocate unavailable')
+    fallocate(fd, offset, length - offset)
+
+
+def provision_zero(fd, length, verbose=False, block_size=16777216):
+    """ Allocate a file by writing zeros to it from a single page-aligned
+    buffer, so it works with O_DIRECT.  Works everywhere, but costs the
+    full write (and upload, on cloud-backed storage). """
+    buffer = mmap.mmap(-1, block_size)
+    done = 0
+    synced = 0
+    time_init = time.time()
+    shown = 0
+    while done < length:
+        count = min(block_size, length - done)
+        if count < block_size:
+            # Slicing would copy into an unaligned string.
+            buffer.close()
+            buffer = mmap.mmap(-1, count)
+        written = os.write(fd, buffer)
+        done += written
+        # Keep dirty pages from piling up when not using O_DIRECT.
+        if done - synced >= 268435456:
+            os.fsync(fd)
+            fadvise(fd, synced, done - synced, POSIX_FADV_DONTNEED)
+            synced = done
+        if verbose and time.time() - shown >= 1:
+            provision_progress(done, length, time_init)
+            shown = time.time()
+    os.fsync(fd)
+    if verbose:
+        provision_progress(done, length, time_init, final=True)
+    buffer.close()
+
+
+# Strategies which reserve every block of the container up front.  A sparse
+# container may run the host filesystem out of space underneath the
+# encrypted filesystem, so it is only used when asked for explicitly.
+provision_strategies = ['fallocate', 'zero-direct', 'zero']
+provision_choice = {}
+provision_lock = Lock()
+
+
+def provision_open(file, strategy, offset=0):
+    """ Open a file for provisioning with the given strategy.  The file is
+    truncated unless it is being extended from offset. """
+    flags = os.O_WRONLY | os.O_CREAT
+    if not offset:
+        flags |= os.O_TRUNC
+    if strategy == 'zero-direct':
+        flags |= getattr(os, 'O_DIRECT', 0)
+    return os.open(file, flags, 0600)
+
+
+def provision_run(file, length, strategy, verbose=False, offset=0):
+    """ Provision a file of length bytes with the given strategy, keeping
+    the first offset bytes as they are.  Raise OSError if the strategy is
+    not supported where the file lives. """
+    fd = provision_open(file, strategy, offset)
+    try:
+        if strategy == 'sparse':
+            provision_sparse(fd, length, verbose)
+        elif strategy == 'fallocate':
+            provision_fallocate(fd, length, verbose, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            provision_zero(fd, length - offset, verbose)
+    finally:
+        os.close(fd)
+
+
+def provision_probe(dir, length=33554432):
+    """ Determine the fastest safe provisioning strategy for a directory by
+    provisioning a small test file with each one.  The result is remembered
+    for the rest of the run.  Archives provisioned in parallel wait for the
+    first one to probe a directory rather than timing it concurrently. """
+    with provision_lock:
+        if dir in provision_choice:
+            return provision_choice[dir]
+        timings = []
+        for strategy in provision_strategies:
+            fd, test_file = tempfile.mkstemp(prefix='.ArchiveR3-provision-',
+                                             dir=dir)
+            os.close(fd)
+            time_init = time.time()
+            try:
+                provision_run(test_file, length, strategy)
+            except (OSError, IOError):
+                continue
+            finally:
+                if os.path.exists(test_file):
+                    os.remove(test_file)
+            timings.append((time.time() - time_init, strategy))
+        if timings:
+            provision_choice[dir] = min(timings)[1]
+        else:
+            provision_choice[dir] = 'zero'
+        return provision_choice[dir]
+
+
+def provision_container(file, length, strategy='auto', verbose=False,
+                        offset=0):
+    """ Create a container file of length bytes.  strategy is one of
+    'sparse', 'fallocate', 'zero-direct', 'zero', or 'auto' to benchmark the
+    filesystem and use the fastest strategy which reserves all blocks.  To
+    grow an existing container, pass its current size as offset; its
+    contents are left untouched.  Return 1 if failure or 0 if
+    successful. """
+    dir = normalize_dir(os.path.dirname(os.path.abspath(file)))
+    if verbose:
+        status_item('Filesystem Type')
+        status_result(str(filesystem_type(dir)))
+    if strategy == 'auto':
+        status_item('Provision Strategy')
+        status_result('PROBING', 2, no_newline=True)
+        strategy = provision_probe(dir)
+        status_result(strategy.upper(), 1)
+    else:
+        status_item('Provision Strategy')
+        status_result(strategy.upper())
+
+    time_init = time.time()
+    try:
+        provision_run(file, length, strategy, verbose=True, offset=offset)
+    except (OSError, IOError), e:
+        print
+        status_item('Generation Result')
+        status_result('FAILED: ' + str(e), 3)
+        if offset:
+            fd = os.open(file, os.O_WRONLY)
+            os.ftruncate(fd, offset)
+            os.close(fd)
+        elif os.path.exists(file):
+            os.remove(file)
+        return 1
+    elapsed = max(time.time() - time_init, 0.001)
+    status_item('Generation Result')
+    status_result(size(length - offset) + ' in ' + '%0.1f' % elapsed +
+                  ' seconds (' + size(int((length - offset) / elapsed)) +
+                  '/s)', 1)
+    return 0
+
+
 def section_break():
-    print '-' * 79
+    status_line('-' * 79)
 
 
 def enqueue_output(out, queue):
@@ -112,35 +661,135 @@ def enqueue_output(out, queue):
         queue.put(line)
 
 
-def dir_size(dir, block_size=0):
+inventory_entry = namedtuple('inventory_entry', 'path type size mode mtime '
+                             'ctime ino dev nlink uid gid')
+
+
+def inventory_record(path, stat):
+    """ Build a compact inventory record from the result of a stat call.  The
+    type is one of 'dir', 'link', or 'file' (anything else which is not a
+    directory or symlink, e.g. fifos, is treated as a file). """
+    if S_ISDIR(stat.st_mode):
+        type = 'dir'
+    elif S_ISLNK(stat.st_mode):
+        type = 'link'
+    else:
+        type = 'file'
+    return inventory_entry(path, type, stat.st_size, stat.st_mode,
+                           stat.st_mtime, stat.st_ctime, stat.st_ino,
+                           stat.st_dev, stat.st_nlink, stat.st_uid,
+                           stat.st_gid)
+
+
+def inventory_resolve(entry):
+    """ Follow a symlink record to whatever it points at.  Return None if the
+    link is dangling. """
+    try:
+        return inventory_record(entry.path, os.stat(entry.path))
+    except OSError:
+        return
+
+
+def inventory(dir, onerror=None, snapshot=None):
+    """ Walk a directory tree in a single pass, yielding one inventory record
+    per entry below dir.  Each entry is stat'ed exactly once (without
+    following symlinks) so that consumers never need to stat it again.
+    Directories are yielded before their contents.  Symlinked directories
+    are not descended into.
+
+    If a directory cannot be listed, onerror is called with the OSError
+    instance, mirroring os.walk().  By default such directories are
+    silently skipped.
+
+    If a tree_snapshot kept live by watch.py is given, the records are read
+    from it rather than from the filesystem. """
+    if snapshot:
+        for entry in snapshot.entries(dir):
+            yield entry
+        return
+    stack = [dir.rstrip('/') or '/']
+    while stack:
+        dirpath = stack.pop()
+        try:
+            if scandir:
+                entries = [(e.path, e) for e in scandir(dirpath)]
+            else:
+                entries = [(os.path.join(dirpath, name), None)
+                           for name in os.listdir(dirpath)]
+        except OSError, e:
+            if onerror is not None:
+                onerror(e)
+            continue
+
+        subdirs = []
+        for path, e in entries:
+            try:
+                if e is not None:
+                    stat = e.stat(follow_symlinks=False)
+                else:
+                    stat = os.lstat(path)
+            except OSError:
+                # Vanished between listing and stat.
+                continue
+            entry = inventory_record(path, stat)
+            yield entry
+            if entry.type == 'dir':
+                subdirs.append(path)
+
+        # Reverse so that subdirectories are visited in listing order.
+        stack.extend(reversed(subdirs))
+
+
+def dir_size(dir, block_size=0, observer=None, every=None, snapshot=None):
     """ Calculate the size of a directory by recursively adding up the size of
     all files within, recursively.  This does not double-count any symlinks or
     hard links.  Optionally specify a blocksize so that file sizes will be
     padded and more accurately represent actual consumed size on disk.
     If blocksize is specified directories will be tabulated as well, assuming
-    they consume 1 block.  Return -1 if any files or directories are not
-    readable. """
+    they consume 1 block.  If given, observer is called with the inventory
+    record of each file counted, and every with the record of every entry
+    (directories, symlinks, and further hard links included), so that other
+    passes over the tree can piggyback on this one.  If a tree_snapshot is
+    given and live, the tree is read from it instead of being walked, and
+    files are not opened to prove they are readable.  Return -1 if any files
+    or directories are not readable. """
     total_size = 0
     file_count = 0
     dir_count = 0
     seen = {}
+    if snapshot and not snapshot.valid():
+        snapshot = None
     status_item('Inventory')
-    for dirpath, dirnames, filenames in os.walk(dir):
-        for f in filenames:
+    if snapshot:
+        status_result('FROM WATCHER', 4, no_newline=True)
+
+    def unreadable(e):
+        raise e
+
+    try:
+        for entry in inventory(dir, onerror=unreadable, snapshot=snapshot):
+            if every:
+                every(entry)
+            if entry.type == 'link':
+                entry = inventory_resolve(entry)
+                if entry is None:
+                    continue
+
+            if entry.type == 'dir':
+                if block_size:
+                    dir_count += 1
+                    total_size += block_size
+                continue
+
             file_count += 1
             if file_count % 1000 == 0:
                 status_result('.', no_newline=True)
-            fp = os.path.join(dirpath, f)
-            try:
-                stat = os.stat(fp)
-            except OSError:
-                continue
 
             # TODO
-            # os.access() is unreliable.  There is at least one edge case where
-            # a remote mounted CIFS share which appears to have readable
-            # permissions (by looking at 'ls' output) actually fails to open
-            # due to remote-side ownership issues:
+            # os.access() is unreliable.  There is at least one edge case
+            # where a remote mounted CIFS share which appears to have
+            # readable permissions (by looking at 'ls' output) actually fails
+            # to open due to remote-side ownership issues:
             #
             # IOError: [Errno 13] Permission denied:
             # '/mnt/remotedir/somefile'
@@ -148,44 +797,33 @@ def dir_size(dir, block_size=0):
             # Unfortunately, the only recourse here is to perform direct open
             # attempts on every single file.
 
-#           if not os.access(fp, os.R_OK):
-#               status_result('PERMISSION DENIED ' + fp, 3)
-#               return -1
             try:
-                fh = open(fp, "r")
-                fh.close()
+                if not snapshot:
+                    fh = open(entry.path, "r")
+                    fh.close()
             except IOError as e:
-                status_result('PERMISSION DENIED ' + fp, 3)
+                status_result('PERMISSION DENIED ' + entry.path, 3)
                 return -1
             except:
                 status_result('UNEXPECTED ERROR' + sys.exc_info()[0], 3)
                 return -1
 
             try:
-                seen[stat.st_ino]
+                seen[entry.ino]
             except KeyError:
-                seen[stat.st_ino] = True
+                seen[entry.ino] = True
             else:
                 continue
+            if observer:
+                observer(entry)
             if block_size:
-                total_size += stat.st_size - (stat.st_size % block_size) + \
+                total_size += entry.size - (entry.size % block_size) + \
                     block_size
             else:
-                total_size += stat.st_size
-
-        for d in dirnames:
-            dp = os.path.join(dirpath, d)
-            # TODO: change a CIFS remote dir to some bogus ownership, rendering
-            # some particular directory technically unreadable but looking like
-            # it should be based on 'ls' output, then verify the os.access()
-            # function fails on it.  If necessary rewrite this routine like
-            # the one above for handling unreadable files.
-            if not os.access(dp, os.R_OK):
-                status_result('PERMISSION DENIED /' + dp, 3)
-                return -1
-            if block_size:
-                dir_count += 1
-                total_size += block_size
+                total_size += entry.size
+    except OSError, e:
+        status_result('PERMISSION DENIED ' + str(e.filename), 3)
+        return -1
 
     status_result('DONE', 1)
     status_item('')
@@ -194,6 +832,769 @@ def dir_size(dir, block_size=0):
     return total_size
 
 
+# Filesystems which are certainly not across a network.
+local_filesystem_types = ['btrfs', 'ext2', 'ext3', 'ext4', 'f2fs', 'jfs',
+                           'reiserfs', 'tmpfs', 'xfs', 'zfs']
+
+
+def compression_options(mode='auto'):
+    """ Return the rsync compression options for an archive, and explain the
+    choice on the status line.  rsync's --compress only shrinks the stream
+    between its sender and receiver, and ours is always local: the target
+    is the mounted container, and whatever reaches the network is written
+    by the filesystem underneath it.  Compressing can therefore only cost
+    CPU, so auto means off.  on is kept for anyone who syncs to a remote
+    rsync target with the library. """
+    status_item('Compression')
+    if mode == 'on':
+        status_result('ON (CONFIGURED)', 4)
+        return ['--compress']
+    if mode == 'off':
+        status_result('OFF (CONFIGURED)', 4)
+    else:
+        status_result('OFF (LOCAL TARGET)', 4)
+    return []
+
+
+class chunker:
+    """ Split a stream into content-defined chunks.  A chunk may end after
+    any byte where the sum of the gear values of the last window bytes has
+    its low bits clear, so an insertion or deletion only moves the cuts
+    near it and the chunks elsewhere in the file keep their contents.
+    Chunks are at least a quarter and at most four times the average size.
+
+    The rolling sum is computed over whole blocks by numpy when it is
+    installed, and one byte at a time otherwise; both find the same cuts. """
+
+    window = 48
+    gear = None
+
+    def __init__(self, average=1048576):
+        if chunker.gear is None:
+            # Fixed seed: cuts must be the same on every run and machine.
+            generator = random.Random(0x41523352)
+            chunker.gear = [generator.getrandbits(32) for i in range(256)]
+            if numpy is not None:
+                chunker.gear_array = numpy.array(chunker.gear,
+                                                 dtype=numpy.uint64)
+        self.mask = (1 << max(int(math.log(average, 2)), 6)) - 1
+        self.minimum = average // 4
+        self.maximum = average * 4
+        self.tail = ''
+        self.position = 0
+        self.start = 0
+
+    def candidates(self, data):
+        """ Return the offsets just past each byte of data where a chunk may
+        end, ignoring the size limits. """
+        full = self.tail + data
+        skip = len(self.tail)
+        window = self.window
+        if numpy is not None:
+            # Sums of at most 4M 32-bit values cannot overflow 64 bits.
+            sums = numpy.cumsum(chunker.gear_array[
+                numpy.frombuffer(full, dtype=numpy.uint8)],
+                dtype=numpy.uint64)
+            rolling = sums.copy()
+            rolling[window:] -= sums[:-window]
+            return (numpy.flatnonzero(
+                (rolling[skip:] & numpy.uint64(self.mask)) == 0) + 1).tolist()
+        gear = chunker.gear
+        found = []
+        rolling = 0
+        for i in xrange(len(full)):
+            rolling += gear[ord(full[i])]
+            if i >= window:
+                rolling -= gear[ord(full[i - window])]
+            if i >= skip and not rolling & self.mask:
+                found.append(i - skip + 1)
+        return found
+
+    def feed(self, data):
+        """ Consume the next block of the stream.  Return the stream offsets
+        at which the chunks completed within it end. """
+        cuts = []
+        for offset in self.candidates(data):
+            offset += self.position
+            while offset - self.start > self.maximum:
+                self.start += self.maximum
+                cuts.append(self.start)
+            if offset - self.start >= self.minimum:
+                cuts.append(offset)
+                self.start = offset
+        self.position += len(data)
+        while self.position - self.start > self.maximum:
+            self.start += self.maximum
+            cuts.append(self.start)
+        self.tail = (self.tail + data)[-(self.window - 1):]
+        return cuts
+
+
+def chunk_check(data):
+    """ Cheap fingerprint of a chunk, used to recognize chunks which are
+    unchanged since they were last hashed. """
+    return '%08x%08x' % (zlib.crc32(data) & 0xffffffff,
+                         zlib.adler32(data) & 0xffffffff)
+
+
+def chunk_ranges(chunks):
+    """ Merge the [offset, length] of adjacent chunks into byte ranges. """
+    ranges = []
+    for chunk in chunks:
+        if ranges and ranges[-1][0] + ranges[-1][1] == chunk[0]:
+            ranges[-1][1] += chunk[1]
+        else:
+            ranges.append([chunk[0], chunk[1]])
+    return ranges
+
+
+class digest_store:
+    """ On-disk index of the telemetry validate gathers for every path in an
+    archive, backed by SQLite in WAL mode.  Records are looked up one path
+    at a time rather than loading the whole archive into memory, and writes
+    are committed in batches so that an interrupted run only loses the
+    current batch.
+
+    Records are dicts with the keys listed in columns; keys whose value is
+    unknown (for example the hash of a directory) are omitted. """
+
+    columns = (('type', 'TEXT NOT NULL'),
+               ('hash', 'TEXT'),
+               ('mode', 'INTEGER'),
+               ('mtime', 'REAL'),
+               ('size', 'INTEGER NOT NULL DEFAULT 0'),
+               ('uid', 'INTEGER'),
+               ('gid', 'INTEGER'),
+               ('checked', 'REAL'),
+               ('ino', 'INTEGER'),
+               ('ctime', 'REAL'),
+               ('verified', 'REAL'))
+
+    def __init__(self, file, batch=1000):
+        self.file = file
+        self.batch = batch
+        self.pending = 0
+        self.names = [c[0] for c in self.columns]
+        self.db = sqlite3.connect(file)
+        # Paths are byte strings; hand them back the same way.
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests '
+                        '(path TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        # Add any columns introduced since the store was created.
+        existing = [row[1] for row in
+                    self.db.execute('PRAGMA table_info(digests)')]
+        for name, definition in self.columns:
+            if name not in existing:
+                self.db.execute('ALTER TABLE digests ADD COLUMN ' + name +
+                                ' ' + definition)
+        self.db.execute('CREATE INDEX IF NOT EXISTS digests_checked '
+                        'ON digests (checked)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                        '(path TEXT PRIMARY KEY, chunks TEXT, ranges TEXT)')
+        # Inventory entries set aside by candidate_put(), for this
+        # connection only.
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS candidates '
+                        '(path TEXT PRIMARY KEY, ' +
+                        ', '.join(inventory_entry._fields[1:]) + ')')
+        self.db.commit()
+        self.sql_get = 'SELECT ' + ', '.join(self.names) + \
+            ' FROM digests WHERE path = ?'
+        self.sql_put = 'INSERT OR REPLACE INTO digests (path, ' + \
+            ', '.join(self.names) + ') VALUES (?' + \
+            ', ?' * len(self.names) + ')'
+        self.sql_candidates = 'SELECT ' + \
+            ', '.join(['c.' + f for f in inventory_entry._fields]) + \
+            ', d.path, ' + ', '.join(['d.' + n for n in self.names])
+
+    def record(self, row):
+        """ Convert a row of column values into a record. """
+        return dict((k, v) for k, v in zip(self.names, row) if v is not None)
+
+    def get(self, path):
+        """ Return the record for a path, or None if it is unknown. """
+        row = self.db.execute(self.sql_get, (path,)).fetchone()
+        if row is not None:
+            return self.record(row)
+
+    def put(self, path, record):
+        """ Store the record for a path, replacing any previous one. """
+        self.db.execute(self.sql_put, [path] +
+                        [record.get(name) for name in self.names])
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+
+    def meta_get(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def meta_set(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) '
+                        'VALUES (?, ?)', (key, str(value)))
+
+    def chunks_get(self, path):
+        """ Return the chunk index of a path as a list of [offset, length,
+        check, hash], and the byte ranges which changed when it was built,
+        or None if the path is not indexed in chunks. """
+        row = self.db.execute('SELECT chunks, ranges FROM chunks WHERE '
+                              'path = ?', (path,)).fetchone()
+        if row is not None:
+            return json.loads(row[0]), json.loads(row[1])
+
+    def chunks_put(self, path, chunks, ranges):
+        """ Store the chunk index of a path, or drop it if chunks is
+        None. """
+        if chunks is None:
+            self.db.execute('DELETE FROM chunks WHERE path = ?', (path,))
+        else:
+            self.db.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)',
+                            (path, json.dumps(chunks), json.dumps(ranges)))
+
+    def candidate_put(self, entry):
+        """ Set aside an inventory entry, to be returned by candidates(). """
+        self.db.execute('INSERT OR REPLACE INTO candidates VALUES (?' +
+                        ', ?' * (len(entry) - 1) + ')', tuple(entry))
+
+    def candidates(self, before):
+        """ Yield (entry, record) for every entry set aside by
+        candidate_put(): first those never checked, then the rest by the
+        time they were last checked, oldest first, as the digests_checked
+        index orders them.  record is None for a path with no digest yet.
+
+        Rows are read a batch at a time, so records may be put in between;
+        records checked at or after before are left out, so that those put
+        meanwhile do not come round again.  The entries are forgotten once
+        all have been returned. """
+        n = len(inventory_entry._fields)
+        at = n + 1 + self.names.index('checked')
+
+        def rows(sql, key, start):
+            while True:
+                page = self.db.execute(sql, start + (self.batch,)).fetchall()
+                for row in page:
+                    record = None
+                    if row[n] is not None:
+                        record = self.record(row[n + 1:n + 1 + len(
+                            self.names)])
+                    yield inventory_entry(*row[:n]), record
+                if len(page) < self.batch:
+                    return
+                start = key(page[-1])
+
+        for candidate in rows(self.sql_candidates + ' FROM candidates c '
+                              'LEFT JOIN digests d ON d.path = c.path WHERE '
+                              'd.checked IS NULL AND c.path > ? ORDER BY '
+                              'c.path LIMIT ?',
+                              lambda row: (row[0],), ('',)):
+            yield candidate
+        # CROSS JOIN keeps digests the outer table, scanned in index order;
+        # the index breaks ties between equal check times by rowid.
+        for candidate in rows(self.sql_candidates + ', d.rowid FROM digests '
+                              'd CROSS JOIN candidates c ON c.path = d.path '
+                              'WHERE d.checked >= ? AND d.checked < ? AND '
+                              'NOT (d.checked = ? AND d.rowid <= ?) ORDER BY '
+                              'd.checked, d.rowid LIMIT ?',
+                              lambda row: (row[at], before, row[at],
+                                           row[-1]),
+                              (float('-inf'), before, float('-inf'), 0)):
+            yield candidate
+        self.db.execute('DELETE FROM candidates')
+
+    def changed_files(self, min_size=0):
+        """ Return (path, size, changed bytes) for every file indexed in
+        chunks, where changed bytes is what the last rehash found had
+        changed. """
+        return [(path, file_size, sum([r[1] for r in json.loads(ranges)]))
+                for path, file_size, ranges in self.db.execute(
+                    'SELECT c.path, d.size, c.ranges FROM chunks c JOIN '
+                    'digests d ON c.path = d.path WHERE d.size >= ?',
+                    (min_size,))]
+
+    def import_pickle(self, pickle_file):
+        """ One-time import of a dict-of-dicts pickle written by earlier
+        versions of validate.  The pickle itself is left in place.  Return
+        the number of records imported, or None if it was imported
+        before. """
+        key = 'imported ' + os.path.abspath(pickle_file)
+        if self.meta_get(key) is not None:
+            return
+        digests = pickle.load(open(pickle_file, 'rb'))
+        self.db.executemany(self.sql_put,
+                            ([path] + [record.get(name) for name in self.names]
+                             for path, record in digests.iteritems()))
+        self.meta_set(key, time.time())
+        self.commit()
+        return len(digests)
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class dedup_index:
+    """ Content-addressed index of the files in every archive, keyed by
+    digest and size and built from the digest stores validate.py keeps, so
+    that content duplicated within and across archives can be found without
+    hashing anything.  An archive's entries are reloaded only when its
+    digest store has changed. """
+
+    def __init__(self, file):
+        self.lock = Lock()
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS content (archive TEXT, '
+                        'path TEXT, hash TEXT, size INTEGER, mode INTEGER, '
+                        'mtime REAL, ctime REAL, uid INTEGER, gid INTEGER, '
+                        'PRIMARY KEY (archive, path))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS content_hash ON content '
+                        '(hash, size)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY '
+                        'KEY, value TEXT)')
+        self.db.commit()
+
+    def refresh(self, archive_dir, store_file):
+        """ Load an archive's hashed files from its digest store, unless it
+        is unchanged since they were last loaded.  Return the number of
+        files loaded, or None if there was nothing to do. """
+        try:
+            stamp = str(max([os.stat(f).st_mtime for f in
+                             [store_file, store_file + '-wal']
+                             if os.path.exists(f)]))
+        except ValueError:
+            return
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                                  (archive_dir,)).fetchone()
+            if row and row[0] == stamp:
+                return
+            store = sqlite3.connect(store_file)
+            store.text_factory = str
+            try:
+                rows = store.execute('SELECT path, hash, size, mode, mtime, '
+                                     'ctime, uid, gid FROM digests WHERE '
+                                     'type = "file" AND hash IS NOT '
+                                     'NULL').fetchall()
+            finally:
+                store.close()
+            self.db.execute('DELETE FROM content WHERE archive = ?',
+                            (archive_dir,))
+            self.db.executemany('INSERT OR REPLACE INTO content VALUES (?, '
+                                '?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(archive_dir,) + tuple(r) for r in rows])
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                            (archive_dir, stamp))
+            self.db.commit()
+            return len(rows)
+
+    def report(self, archive_dir):
+        """ Return the bytes duplicated within an archive (every copy after
+        the first) and the bytes of its content also found in other
+        archives. """
+        with self.lock:
+            within = self.db.execute(
+                'SELECT SUM(size * (copies - 1)) FROM (SELECT size, '
+                'COUNT(*) AS copies FROM content WHERE archive = ? GROUP BY '
+                'hash, size)', (archive_dir,)).fetchone()[0]
+            across = self.db.execute(
+                'SELECT SUM(size) FROM (SELECT DISTINCT hash, size FROM '
+                'content c WHERE archive = ? AND EXISTS (SELECT 1 FROM '
+                'content d WHERE d.hash = c.hash AND d.size = c.size AND '
+                'd.archive != c.archive))', (archive_dir,)).fetchone()[0]
+        return within or 0, across or 0
+
+    def duplicates(self, archive_dir, min_size=0):
+        """ Return the paths of files in an archive sharing their content
+        with another file in it, with their recorded metadata, grouped by
+        digest and size. """
+        groups = {}
+        with self.lock:
+            for row in self.db.execute(
+                    'SELECT c.path, c.hash, c.size, c.mode, c.mtime, c.ctime, '
+                    'c.uid, c.gid FROM content c JOIN (SELECT hash, size FROM '
+                    'content WHERE archive = ? AND size >= ? GROUP BY hash, '
+                    'size HAVING COUNT(*) > 1) d ON c.hash = d.hash AND '
+                    'c.size = d.size WHERE c.archive = ?',
+                    (archive_dir, min_size, archive_dir)):
+                groups.setdefault(row[1:3], []).append(row)
+        return groups.values()
+
+    def close(self):
+        self.db.close()
+
+
+class dedup_plan:
+    """ Decide which duplicate files in an archive can be stored in its
+    container as hard links to one copy rather than transferred again.
+
+    Only files still matching what validate.py hashed (by size, mtime, and
+    ctime in the current inventory) qualify, and only copies which also
+    share mode, owner, and mtime are linked, since links share one inode
+    and rsync would otherwise see the other copies as changed and transfer
+    them again.  The copies are excluded from rsync, which also protects
+    them from --delete, and linked to the first copy once rsync has put it
+    in place.  A copy which later changes no longer qualifies, so rsync
+    replaces its link with a file of its own. """
+
+    def __init__(self, index, archive_dir, min_size=1048576):
+        self.root = archive_dir.rstrip('/')
+        self.candidates = {}
+        for group in index.duplicates(archive_dir, min_size):
+            for row in group:
+                self.candidates[row[0]] = row
+        self.current = set()
+        self.links = []
+
+    def observe(self, entry):
+        row = self.candidates.get(entry.path)
+        if row and (row[2], row[4], row[5]) == \
+                (entry.size, entry.mtime, entry.ctime):
+            self.current.add(entry.path)
+
+    def plan(self):
+        """ Pair each redundant copy with the copy it will link to.  Return
+        the bytes this saves. """
+        groups = {}
+        for path in self.current:
+            row = self.candidates[path]
+            # hash, size, mode, mtime, uid, gid
+            groups.setdefault(row[1:5] + row[6:8], []).append(path)
+        self.links = []
+        saved = 0
+        for key, paths in groups.items():
+            paths.sort()
+            for path in paths[1:]:
+                self.links.append((os.path.relpath(paths[0], self.root),
+                                   os.path.relpath(path, self.root)))
+                saved += key[1]
+        return saved
+
+    def rsync_filter(self):
+        """ Write rsync exclude rules for the redundant copies to a
+        temporary file and return the options which apply it, or [] if there
+        is nothing to exclude.  The caller removes the file. """
+        if not self.links:
+            return []
+        base = os.path.basename(self.root)
+        fd, self.filter_file = tempfile.mkstemp(prefix='ArchiveR3-')
+        with os.fdopen(fd, 'w') as f:
+            for first, path in self.links:
+                # Anchor to the transfer root and escape wildcards.
+                f.write('/' + re.sub('([*?[\\\\])', '\\\\\\1',
+                                     os.path.join(base, path)) + '\0')
+        return ['--from0', '--exclude-from=' + self.filter_file]
+
+    def link(self, target):
+        """ Hard link the redundant copies in the target to their first
+        copies, all in one sudo invocation.  Return the number of links
+        which could not be made. """
+        if not self.links:
+            return 0
+        base = os.path.join(target.rstrip('/'), os.path.basename(self.root))
+        pairs = ''.join([os.path.join(base, first) + '\0' +
+                         os.path.join(base, path) + '\0'
+                         for first, path in self.links])
+        script = 'failed=0; ' \
+            'while IFS= read -r -d "" first && IFS= read -r -d "" path; do ' \
+            '[ "$first" -ef "$path" ] && continue; ' \
+            'mkdir -p "$(dirname "$path")" && ln -f "$first" "$path" || ' \
+            'failed=$((failed + 1)); done; echo $failed'
+        p = subprocess.Popen(['sudo', 'bash', '-c', script],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = p.communicate(pairs)[0]
+        try:
+            return int(out.strip())
+        except ValueError:
+            return len(self.links)
+
+
+class tree_snapshot:
+    """ Inventory records of a whole tree, kept current by a tree_watcher in
+    the watch.py daemon so that the tree can be inventoried without walking
+    it.  Readers only trust it while the daemon is live: its heartbeat is
+    recent and its watches cover the whole tree. """
+
+    fields = 'type size mode mtime ctime ino dev nlink uid gid'
+
+    def __init__(self, file):
+        self.file = file
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (dir TEXT, name '
+                        'TEXT, type TEXT, size INTEGER, mode INTEGER, mtime '
+                        'REAL, ctime REAL, ino INTEGER, dev INTEGER, nlink '
+                        'INTEGER, uid INTEGER, gid INTEGER, PRIMARY KEY (dir, '
+                        'name))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY '
+                        'KEY, value TEXT)')
+        self.db.commit()
+
+    def meta_get(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        if row:
+            return row[0]
+
+    def meta_set(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, str(value)))
+        self.db.commit()
+
+    def valid(self, max_age=60):
+        """ Return True if the daemon is watching the whole tree. """
+        heartbeat = self.meta_get('heartbeat')
+        return self.meta_get('state') == 'live' and heartbeat is not None \
+            and time.time() - float(heartbeat) < max_age
+
+    def entries(self, root):
+        """ Yield the records below root in the order inventory() would.
+        All of them are read in one transaction so that they are consistent
+        with each other even while the daemon is updating them. """
+        self.db.execute('BEGIN')
+        try:
+            stack = [root.rstrip('/') or '/']
+            while stack:
+                dirpath = stack.pop()
+                subdirs = []
+                for row in self.db.execute('SELECT name, ' +
+                                           self.fields.replace(' ', ', ') +
+                                           ' FROM entries WHERE dir = ? '
+                                           'ORDER BY name', (dirpath,)):
+                    entry = inventory_entry(os.path.join(dirpath, row[0]),
+                                            *row[1:])
+                    yield entry
+                    if entry.type == 'dir':
+                        subdirs.append(entry.path)
+                stack.extend(reversed(subdirs))
+        finally:
+            self.db.rollback()
+
+    def scan_dir(self, dirpath):
+        """ Relist and restat a directory.  Return the paths of the
+        subdirectories which appeared and those which disappeared. """
+        old = set([row[0] for row in self.db.execute(
+            'SELECT name FROM entries WHERE dir = ? AND type = "dir"',
+            (dirpath,))])
+        rows = []
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                entry = inventory_record(os.path.join(dirpath, name),
+                                         os.lstat(os.path.join(dirpath, name)))
+            except OSError:
+                continue
+            rows.append((dirpath, name) + tuple(entry[1:]))
+        new = set([row[1] for row in rows if row[2] == 'dir'])
+        self.db.execute('DELETE FROM entries WHERE dir = ?', (dirpath,))
+        self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, '
+                            '?, ?, ?, ?, ?, ?)', rows)
+        return [os.path.join(dirpath, n) for n in sorted(new - old)], \
+            [os.path.join(dirpath, n) for n in sorted(old - new)]
+
+    def scan_entry(self, dirpath, name):
+        """ Restat a single entry, for example a file being written. """
+        try:
+            entry = inventory_record(os.path.join(dirpath, name),
+                                     os.lstat(os.path.join(dirpath, name)))
+        except OSError:
+            self.db.execute('DELETE FROM entries WHERE dir = ? AND name = ?',
+                            (dirpath, name))
+            return
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, '
+                        '?, ?, ?, ?, ?, ?, ?, ?)',
+                        (dirpath, name) + tuple(entry[1:]))
+
+    def remove_tree(self, dirpath):
+        self.db.execute('DELETE FROM entries WHERE dir = ? OR substr(dir, 1, '
+                        '?) = ?', (dirpath, len(dirpath) + 1, dirpath + '/'))
+
+    def clear(self):
+        self.db.execute('DELETE FROM entries')
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class tree_watcher:
+    """ Keep a tree_snapshot in step with a directory tree using inotify,
+    which only sees changes made through the local kernel, so it is only
+    of use for archives on local disks.
+
+    Every directory is watched.  Events naming a single file restat just
+    that file; anything which changes a directory's listing relists the
+    directory, which in turn watches and scans new subdirectories and
+    forgets removed ones.  Events are applied in batches, debounced by a
+    second.  If the kernel's event queue overflows, events have been lost,
+    so the snapshot is marked stale and rebuilt by a full rescan.  If the
+    tree needs more watches than fs.inotify.max_user_watches allows, the
+    snapshot is left stale and readers fall back to walking the tree. """
+
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+        IN_DONT_FOLLOW
+    structure = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_Q_OVERFLOW
+
+    def __init__(self, root, snapshot, heartbeat=10):
+        self.root = root.rstrip('/') or '/'
+        self.snapshot = snapshot
+        self.heartbeat = heartbeat
+        self.fd = inotify.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.wds = {}
+        self.paths = {}
+
+    def watch(self, dirpath):
+        wd = inotify.inotify_add_watch(self.fd, dirpath, self.mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                raise OverflowError('inotify watch limit reached, raise '
+                                    'fs.inotify.max_user_watches')
+            # Vanished before it could be watched; its parent's listing
+            # will catch up.
+            return
+        self.wds[wd] = dirpath
+        self.paths[dirpath] = wd
+
+    def unwatch(self, dirpath):
+        """ Forget a removed directory and everything below it. """
+        for path in [p for p in self.paths if p == dirpath or
+                     p.startswith(dirpath + '/')]:
+            wd = self.paths.pop(path)
+            self.wds.pop(wd, None)
+            inotify.inotify_rm_watch(self.fd, wd)
+        self.snapshot.remove_tree(dirpath)
+
+    def scan_tree(self, dirpath):
+        """ Watch and scan a directory and everything below it.  Each
+        directory is watched before it is listed, so that nothing created
+        in between goes unseen. """
+        stack = [dirpath]
+        while stack:
+            path = stack.pop()
+            self.watch(path)
+            added, removed = self.snapshot.scan_dir(path)
+            stack.extend(added)
+
+    def rescan(self):
+        self.snapshot.meta_set('state', 'scanning')
+        for wd in self.wds.keys():
+            inotify.inotify_rm_watch(self.fd, wd)
+        self.wds = {}
+        self.paths = {}
+        self.snapshot.clear()
+        self.scan_tree(self.root)
+        self.snapshot.meta_set('rescanned', time.time())
+        self.snapshot.meta_set('state', 'live')
+
+    def events(self):
+        """ Read and decode all pending events. """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            offset = 0
+            while offset + 16 <= len(buf):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf,
+                                                              offset)
+                name = buf[offset + 16:offset + 16 + length].rstrip('\0')
+                offset += 16 + length
+                events.append((wd, mask, name))
+
+    def apply(self, events):
+        """ Bring the snapshot up to date with a batch of events.  Return
+        False if events were lost and a rescan is needed. """
+        relist = set()
+        restat = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                return False
+            dirpath = self.wds.get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_IGNORED or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Its parent's listing will notice it has gone.
+                if dirpath != self.root:
+                    relist.add(os.path.dirname(dirpath))
+                continue
+            if mask & self.structure or mask & IN_ISDIR:
+                relist.add(dirpath)
+            elif name:
+                restat.add((dirpath, name))
+        for dirpath in relist:
+            if dirpath not in self.paths:
+                continue
+            added, removed = self.snapshot.scan_dir(dirpath)
+            # A new listing changes the directory's own mtime and size too.
+            if dirpath != self.root:
+                self.snapshot.scan_entry(*os.path.split(dirpath))
+            for path in removed:
+                self.unwatch(path)
+            for path in added:
+                self.scan_tree(path)
+        for dirpath, name in restat:
+            if dirpath not in relist and dirpath in self.paths:
+                self.snapshot.scan_entry(dirpath, name)
+        self.snapshot.commit()
+        return True
+
+    def run(self, stop):
+        """ Keep the snapshot live until the stop event is set. """
+        logger = logging.getLogger()
+        try:
+            self.rescan()
+            logger.info(self.root + ': watching ' + str(len(self.wds)) +
+                        ' directories')
+            beat = 0
+            while not stop.is_set():
+                if time.time() - beat >= self.heartbeat:
+                    self.snapshot.meta_set('heartbeat', time.time())
+                    beat = time.time()
+                if not select.select([self.fd], [], [], 1)[0]:
+                    continue
+                # Let a burst of changes settle so it is applied at once.
+                time.sleep(1)
+                if not self.apply(self.events()):
+                    logger.warning(self.root + ': inotify queue overflowed, '
+                                   'rescanning')
+                    self.rescan()
+        except OverflowError, e:
+            logger.error(self.root + ': ' + str(e))
+            self.snapshot.meta_set('state', 'incomplete')
+            return 1
+        finally:
+            if self.snapshot.meta_get('state') == 'live':
+                self.snapshot.meta_set('state', 'stopped')
+            os.close(self.fd)
+
+
 def dir_validate(dir, auto=0, create=0, read=0, sudo=0, write=0):
     """ Validate a directory exists.
 
@@ -295,18 +1696,163 @@ def dir_validate(dir, auto=0, create=0, read=0, sudo=0, write=0):
     logger.info(dir + ': exists')
 
 
+class kernel_state:
+    """ Read-only view of the loopback devices, device mapper nodes, and
+    mounts known to the kernel, read straight from /sys, /dev/mapper, and
+    /proc rather than by running losetup and mountpoint under sudo.  Each
+    view is cached for the rest of the run and must be invalidated by
+    whoever changes it. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.cache = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.cache = {}
+
+    def cached(self, name, probe):
+        with self.lock:
+            if name not in self.cache:
+                self.cache[name] = probe()
+            return self.cache[name]
+
+    def probe_loops(self):
+        """ Map every loopback device to its backing file, or None if the
+        device is free. """
+        loops = {}
+        try:
+            names = os.listdir('/sys/block')
+        except OSError:
+            names = []
+        for name in names:
+            if not re.match('loop[0-9]+$', name):
+                continue
+            try:
+                backing = open('/sys/block/' + name +
+                               '/loop/backing_file').read().strip()
+            except IOError:
+                backing = None
+            loops['/dev/' + name] = backing
+        return loops
+
+    def probe_mappers(self):
+        try:
+            return set(os.listdir('/dev/mapper'))
+        except OSError:
+            return set()
+
+    def probe_mounts(self):
+        mounts = set()
+        try:
+            lines = open('/proc/self/mountinfo').read().splitlines()
+        except IOError:
+            return mounts
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 4:
+                mounts.add(re.sub('\\\\([0-7]{3})',
+                                  lambda m: chr(int(m.group(1), 8)),
+                                  fields[4]))
+        return mounts
+
+    def loops(self):
+        return self.cached('loops', self.probe_loops)
+
+    def loops_for(self, file):
+        """ Return the loopback devices associated with a file. """
+        file = os.path.realpath(file)
+        return sorted([device for device, backing in self.loops().items()
+                       if backing and re.sub(' \\(deleted\\)$', '',
+                                             backing) == file])
+
+    def loop_free(self):
+        """ Return the lowest numbered existing loopback device which is not
+        in use, or None if there is none. """
+        free = [device for device, backing in self.loops().items()
+                if backing is None]
+        if free:
+            return min(free, key=lambda d: int(d[len('/dev/loop'):]))
+
+    def mapped(self, name):
+        return name in self.cached('mappers', self.probe_mappers)
+
+    def mounted(self, mount_point):
+        return (mount_point.rstrip('/') or '/') in \
+            self.cached('mounts', self.probe_mounts)
+
+
+kernel = kernel_state()
+
+
+def process_wait(process, timeout):
+    """ Wait up to timeout seconds for a child process to exit, polling at
+    a growing interval so that a prompt exit is noticed promptly.  Return
+    its exit status, or None if it is still running. """
+    deadline = time.time() + timeout
+    delay = 0.01
+    while process.poll() is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
+    return process.returncode
+
+
+def mount_users(mount_point):
+    """ Return the ids of processes whose working directory, root, or open
+    files lie beneath a mount point, found by walking /proc.  Processes
+    belonging to other users (rsync running under sudo, for example) can
+    only be seen when running as root, so an empty result does not
+    guarantee the mount is idle. """
+    mount_point = mount_point.rstrip('/')
+    users = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        base = '/proc/' + pid + '/'
+        try:
+            links = [base + 'cwd', base + 'root'] + \
+                [base + 'fd/' + fd for fd in os.listdir(base + 'fd')]
+        except OSError:
+            continue
+        for link in links:
+            try:
+                target = os.readlink(link)
+            except OSError:
+                continue
+            if target == mount_point or target.startswith(mount_point + '/'):
+                users.append(int(pid))
+                break
+    return users
+
+
+def retry_busy(command, attempts=6, delay=0.1):
+    """ Run a command, retrying with exponential backoff for as long as it
+    fails because its target is busy, which commonly happens for a moment
+    after a filesystem is released while udev or a dying process still
+    holds the device open.  Return the exit status and error output of the
+    last attempt. """
+    for attempt in range(attempts):
+        p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        error = p.communicate()[1]
+        if not p.returncode or 'busy' not in error.lower():
+            break
+        if attempt < attempts - 1:
+            time.sleep(delay)
+            delay *= 2
+    return p.returncode, error
+
+
 def loopback_exists(file):
     """ Determine if a loopback device has been allocated for a particular
     file.  If found, return it.  If not, return 0.  Note this is opposite
     normal functions where 0 means success. """
-    # stderr prints 'SOMEFILE: No such file or directory' if not found
-    # TODO: verify trapping stderr here works
-    lbmatch = subprocess.Popen(['sudo', 'losetup', '--associated', file],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE).communicate()[0]
-    lbmatch = ''.join(lbmatch.split())
-    if re.match('.*\(' + file + '\).*', str(lbmatch)):
-        lbmatch = re.sub(':.*$', '', lbmatch)
+    devices = kernel.loops_for(file)
+    if devices:
+        lbmatch = devices[0]
         status_item('Container > Loopback Device')
         status_result('ASSOCIATED ' + lbmatch, 1)
         return lbmatch
@@ -315,24 +1861,25 @@ def loopback_exists(file):
 def loopback_cleanup(file):
     """ Attempt to clean up any residual loopback devices associated with a
     particular file which are not in use. """
-    # stderr prints 'SOMEFILE: No such file or directory' if not found
-    # TODO: verify trapping stderr here works
-    matches = subprocess.Popen(['sudo', 'losetup', '--all'],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE).communicate()[0]
-    for match in str(matches).splitlines():
-        if re.match('.*\(' + file + '\)', match):
-            loopback_old = re.sub(':.*$', '', match)
-            status_item('Removing Old Loopback Device')
-            subprocess.Popen(['sudo', 'losetup', '-d', loopback_old])
-            status_result(loopback_old, 4)
+    devices = kernel.loops_for(file)
+    for loopback_old in devices:
+        status_item('Removing Old Loopback Device')
+        subprocess.call(['sudo', 'losetup', '-d', loopback_old])
+        status_result(loopback_old, 4)
+    if devices:
+        kernel.invalidate()
 
 
 def loopback_next():
     """ Return the name of the next free loopback device. """
+    device = kernel.loop_free()
+    if device:
+        return device
+    # None free; losetup knows how to ask the kernel for another one.
     result = subprocess.Popen(['sudo', 'losetup', '-f'],
                               stdout=subprocess.PIPE,
                               stderr=subprocess.STDOUT).communicate()[0]
+    kernel.invalidate()
     if re.match('.*could not find any free loop device.*', result):
         status_item('Allocate Loopback')
         status_result('NO FREE DEVICES', 3)
@@ -352,6 +1899,7 @@ def loopback_setup(lbdevice, file, verbose=False):
     status_result(lbdevice)
     result = subprocess.Popen(['sudo', 'losetup', '--verbose', lbdevice, file],
                               stdout=subprocess.PIPE).communicate()[0]
+    kernel.invalidate()
     status_item('')
     if re.match('.*Loop device is ' + str(lbdevice) + '.*', result):
         status_result('LOOPBACKED', 4)
@@ -367,6 +1915,7 @@ def loopback_delete(lbdevice):
     status_item(lbdevice)
     try:
         subprocess.check_call(['sudo', 'losetup', '--detach', lbdevice])
+        kernel.invalidate()
     except subprocess.CalledProcessError, e:
         status_result('LOOPBACK DEALLOCATION ERROR')
         return 1
@@ -376,6 +1925,87 @@ def loopback_delete(lbdevice):
     status_result('UNLOOPBACKED', 4)
 
 
+def loopback_sectors(lbdevice):
+    """ Return the size of a loopback device in 512-byte sectors, or None if
+    it cannot be determined. """
+    try:
+        return int(open('/sys/block/' + os.path.basename(lbdevice) +
+                        '/size').read())
+    except (IOError, ValueError):
+        return
+
+
+def loopback_capacity(lbdevice, verbose=False):
+    """ Make a loopback device pick up the new size of its backing file.
+    Return 1 if failure or 0 if successful. """
+    if verbose:
+        status_item('Command')
+        status_result('sudo losetup --set-capacity ' + lbdevice)
+
+    status_item('Loopback Capacity')
+    try:
+        subprocess.check_call(['sudo', 'losetup', '--set-capacity', lbdevice])
+    except subprocess.CalledProcessError, e:
+        status_result('ERROR', 3)
+        return 1
+    except Exception, e:
+        status_result('COMMAND NOT FOUND', 3)
+        return 1
+    status_result(size(loopback_sectors(lbdevice) * 512), 4)
+    return 0
+
+
+def sample_entropy(buf):
+    """ Return the Shannon entropy of a block of bytes, in bits per byte (0
+    for constant data up to 8 for random data), and the fraction of bytes
+    which are zero.  Byte frequencies are counted in C, by numpy if it is
+    installed, rather than one byte at a time in python. """
+    if not buf:
+        return 0.0, 1.0
+    if numpy is not None:
+        counts = numpy.bincount(numpy.frombuffer(buf, dtype=numpy.uint8),
+                                minlength=256)
+        counts = counts[counts > 0].astype(float) / len(buf)
+        entropy = float(-(counts * numpy.log2(counts)).sum())
+        zeros = float(len(buf) - numpy.count_nonzero(
+            numpy.frombuffer(buf, dtype=numpy.uint8))) / len(buf)
+        return entropy, zeros
+    entropy = 0.0
+    for i in range(256):
+        count = buf.count(chr(i))
+        if count:
+            p = float(count) / len(buf)
+            entropy -= p * math.log(p, 2)
+    return entropy, float(buf.count('\0')) / len(buf)
+
+
+def container_probe(file, sample=65536):
+    """ Sample the head, middle, and tail of a container with one read each
+    and decide whether it holds ciphertext.  A TrueCrypt container starts
+    with an encrypted header which is indistinguishable from random data,
+    so the head alone decides the verdict: 'ciphertext' (high entropy),
+    'zero' (zero-filled, i.e. never encrypted), or 'unknown'.  Return the
+    verdict and a list of (region, entropy, zero fraction) statistics. """
+    stats = []
+    with open(file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        length = f.tell()
+        for region, offset in (('head', 0),
+                               ('middle', length // 2 - sample // 2),
+                               ('tail', length - sample)):
+            f.seek(max(offset, 0))
+            entropy, zeros = sample_entropy(f.read(sample))
+            stats.append((region, entropy, zeros))
+    entropy, zeros = stats[0][1:]
+    if zeros == 1.0:
+        verdict = 'zero'
+    elif entropy > 7.5:
+        verdict = 'ciphertext'
+    else:
+        verdict = 'unknown'
+    return verdict, stats
+
+
 def loopback_encrypted(lbdevice, password_base, backup_dir, container_file,
                        verbose=False):
     """ Perform tests to determine if the loopback device is a valid
@@ -385,20 +2015,17 @@ def loopback_encrypted(lbdevice, password_base, backup_dir, container_file,
         status_result('sudo tcplay -i -d ' + lbdevice)
 
     status_item('Encryption Integrity')
-    sum = 0
-    file = open(backup_dir + container_file, 'rb')
-    count = 0
-    integer = struct.unpack('i', file.read(4))[0]
-    while integer and count < 100000:
-        sum += integer
-        integer_file = file.read(4)
-        integer_file = '\0' * (4 - len(integer_file)) + integer_file
-        integer = struct.unpack('i', integer_file)[0]
-        count += 1
-    file.close()
-    if not sum:
+    verdict, stats = container_probe(backup_dir + container_file)
+    if verbose or verdict != 'ciphertext':
+        status_result(' '.join(['%s %.2f bits/byte %d%% zero' %
+                                (region, entropy, zeros * 100)
+                                for region, entropy, zeros in stats]))
+        status_item('')
+    if verdict == 'zero':
         status_result('EMPTY FILE?', 2)
         return 1
+    if verdict == 'unknown':
+        status_result('NOT RANDOM, TRYING ANYWAY', 2, no_newline=True)
 
     try:
         child = pexpect.spawn('sudo tcplay -i -d ' + lbdevice)
@@ -485,6 +2112,131 @@ def loopback_encrypt(lbdevice, password_base, container_file, verbose=False):
     print
 
 
+# External utilities this program depends on: name, whether it is run with
+# sudo, a harmless invocation, and the exit codes which prove it works.
+dependencies = [
+    ('dmsetup', True, ['-h'], [0]),
+    # e2fsck without arguments prints usage and exits with status 16
+    ('e2fsck', True, [], [16]),
+    ('expect', False, ['-v'], [0]),
+    ('find', True, ['--version'], [0]),
+    ('killall', True, ['--version'], [0]),
+    ('losetup', True, ['-h'], [0]),
+    ('mkdir', True, ['--help'], [0]),
+    ('mkfs.ext4', True, ['-V'], [0]),
+    ('mount', True, [], [0]),
+    # resize2fs without arguments prints usage and exits with status 1
+    ('resize2fs', True, [], [1]),
+    ('rsync', True, ['--version'], [0]),
+    ('tcplay', True, ['-v'], [0]),
+    ('umount', True, ['-h'], [0]),
+]
+
+
+def dependency_key(name):
+    """ Resolve a utility to its binary and return (path, mtime), or None
+    if it cannot be found.  sudo searches the sbin directories even when
+    they are not in our PATH, so they are searched here too. """
+    dirs = os.environ.get('PATH', '').split(os.pathsep) + \
+        ['/usr/local/sbin', '/usr/sbin', '/sbin']
+    for dir in dirs:
+        path = os.path.join(dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            path = os.path.realpath(path)
+            return [path, os.stat(path).st_mtime]
+
+
+def dependency_probe(name, sudo, args, codes):
+    """ Run a utility harmlessly to prove it works.  Return 'found', 'error',
+    or 'missing'. """
+    command = [name] + args
+    if sudo:
+        command = ['sudo'] + command
+    # create a blackhole stream so that we can redirect the output of
+    # dependency utilities so that it does not appear inline while this
+    # program is running
+    try:
+        with open(os.devnull, 'w') as devnull:
+            rc = subprocess.call(command, stdout=devnull, stderr=devnull)
+    except OSError:
+        return 'missing'
+    if rc in codes:
+        return 'found'
+    return 'error'
+
+
+def dependencies_check(data_dir, recheck=False):
+    """ Verify every dependency utility works.  Probes run concurrently, and
+    successful ones are cached in data_dir keyed by the resolved path and
+    mtime of both the utility and sudo, so that later runs only probe
+    utilities which have changed.  Return 1 if any dependency is unusable.
+    """
+    logger = logging.getLogger()
+    cache_file = data_dir + 'dependencies.json'
+    cache = {}
+    if not recheck:
+        try:
+            cache = json.load(open(cache_file))
+        except (IOError, ValueError):
+            pass
+
+    sudo_key = dependency_key('sudo')
+    results = {}
+    pending = []
+    for name, sudo, args, codes in dependencies:
+        key = [dependency_key(name), sudo_key if sudo else None]
+        if cache.get(name) == key:
+            results[name] = 'cached'
+        else:
+            pending.append((name, sudo, args, codes, key))
+
+    def probe(name, sudo, args, codes, key):
+        results[name] = dependency_probe(name, sudo, args, codes)
+
+    # Let the first sudo probe run alone so that any password prompt is not
+    # interleaved with others.
+    for dependency in pending:
+        if dependency[1]:
+            probe(*dependency)
+            break
+
+    threads = []
+    for dependency in pending:
+        if dependency[0] not in results:
+            t = Thread(target=probe, args=dependency)
+            t.daemon = True  # thread dies with the program
+            t.start()
+            threads.append(t)
+    for t in threads:
+        t.join()
+
+    rc = 0
+    for name, sudo, args, codes in dependencies:
+        label = name
+        if sudo:
+            label += ' (sudo)'
+        if results[name] == 'cached':
+            logger.info(label + ': found (cached)')
+        elif results[name] == 'found':
+            logger.info(label + ': found')
+        else:
+            logger.error(label + ': ' + results[name])
+            rc = 1
+
+    for name, sudo, args, codes, key in pending:
+        if results[name] == 'found':
+            cache[name] = key
+        else:
+            cache.pop(name, None)
+    try:
+        open(cache_file + '.tmp', 'w').write(json.dumps(cache, indent=1))
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError), e:
+        logger.warning(cache_file + ': could not save dependency cache')
+
+    return rc
+
+
 def config_read(config_file):
     """ Read the configuration file.  Return a ConfigParser object on success
     or nothing on failure. """
@@ -513,12 +2265,85 @@ def config_read(config_file):
         config.getint('ArchiveR3', 'provision_capacity_percent')
     config.provision_capacity_reprovision = \
         config.getint('ArchiveR3', 'provision_capacity_reprovision')
+    config.parallel_archives = \
+        config_option(config, 'parallel_archives', 1)
+    config.parallel_per_device = \
+        config_option(config, 'parallel_per_device', 1)
+    config.parallel_per_backup_dir = \
+        config_option(config, 'parallel_per_backup_dir',
+                      config.parallel_archives)
+    config.provision_strategy = \
+        config_option(config, 'provision_strategy', 'auto')
+    config.provision_grow = config_option(config, 'provision_grow', True)
+    config.stale_age = config_option(config, 'stale_age', 86400)
+    config.digest_dir = config_option(config, 'digest_dir', '')
+    if config.digest_dir:
+        config.digest_dir = normalize_dir(config.digest_dir)
+    config.dedup = config_option(config, 'dedup', True)
+    config.metrics_dir = config_option(config, 'metrics_dir', '')
+    if config.metrics_dir:
+        config.metrics_dir = normalize_dir(config.metrics_dir)
     return config
 
 
-def config_validate(config, interactive):
+def config_option(config, option, default, section='ArchiveR3'):
+    """ Read an optional setting from a section of the configuration file,
+    the ArchiveR3 section unless another is given, for example an archive's
+    own section.  The value is converted to the type of the default, which
+    is returned if the setting is absent. """
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    elif isinstance(default, int):
+        return config.getint(section, option)
+    elif isinstance(default, float):
+        return config.getfloat(section, option)
+    return config.get(section, option)
+
+
+def config_archive_option(config, archive_dir, option, default):
+    """ Read a setting which may be overridden for a single archive in a
+    section named after its directory, for example [/home/USERNAME],
+    falling back to the ArchiveR3 section and then to the default. """
+    for section in [archive_dir, archive_dir.rstrip('/')]:
+        if config.has_section(section) and \
+           config.has_option(section, option):
+            return config_option(config, option, default, section)
+    return config_option(config, option, default)
+
+
+def digest_file(config, archive_dir):
+    """ Return the digest store validate.py keeps an archive's digests in,
+    and backup.py reads them from. """
+    return config.digest_dir + archive_dir.split('/')[-2] + '.db'
+
+
+def watch_file(config, archive_dir):
+    """ Return the file watch.py keeps an archive's tree_snapshot in. """
+    return config.data_dir + archive_dir.split('/')[-2] + '.archive.watch'
+
+
+def config_bandwidth(config, archive_dir, bwlimit):
+    """ Return the bandwidth controller configured for an archive, or None
+    if the static limit bwlimit (in KBps) applies throughout.  Raise
+    ValueError if the settings are malformed. """
+    if not config_archive_option(config, archive_dir, 'bwlimit_adaptive',
+                                 False):
+        return None
+    option = lambda name, default: \
+        config_archive_option(config, archive_dir, name, default)
+    return bandwidth_controller(
+        option('bwlimit_min', 100), option('bwlimit_max', 0),
+        bandwidth_schedule(option('bwlimit_schedule', '')),
+        option('bwlimit_deadline', ''), option('bwlimit_interval', 300),
+        bwlimit)
+
+
+def config_validate(config, interactive, recheck=False):
     """ Make sure all the configuration settings make sense.  Try to be helpful
-    and intervene if there are issues, otherwise bail. """
+    and intervene if there are issues, otherwise bail.  Dependency probes
+    cached by a previous run are trusted unless recheck is set. """
 
     logger = logging.getLogger()
 
@@ -546,154 +2371,25 @@ def config_validate(config, interactive):
     logger.info('reprovision when container reaches: ' +
                 str(config.provision_capacity_reprovision) + '%')
 
-    # create a blackhole stream so that we can redirect the output of
-    # dependency utilities. for example, send the output of 'dd --version' to
-    # /dev/null so that it does not appear inline while this program is
-    # running
-
-    devnull = open('/dev/null', 'w')
-
-    try:
-        subprocess.check_call(['dd', '--version'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('dd: error')
-        return 1
-    except Exception, e:
-        logger.error('dd: missing')
-        return 1
-    logger.info('dd: found')
-
-    try:
-        subprocess.check_call(['sudo', 'dmsetup', '-h'], stderr=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('dmsetup (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('dmsetup (sudo): missing')
-        return 1
-    logger.info('dmsetup (sudo): found')
-
-    try:
-        subprocess.check_call(['sudo', 'e2fsck'], stderr=devnull)
-    except subprocess.CalledProcessError, e:
-        if re.match('.*returned non-zero exit status 16.*', str(e)):
-            logger.info('e2fsck (sudo): found')
-        else:
-            logger.error('e2fsck (sudo): error')
-            return 1
-    except Exception, e:
-        logger.error('e2fsck (sudo): missing')
-        return 1
-
-    try:
-        subprocess.check_call(['expect', '-v'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('expect: error')
+    if config.parallel_archives < 1 or config.parallel_per_device < 1 or \
+       config.parallel_per_backup_dir < 1:
+        logger.error('parallel settings must be at least 1')
         return 1
-    except Exception, e:
-        logger.error('expect: missing')
-        return 1
-    logger.info('expect: found')
 
-    try:
-        subprocess.check_call(['sudo', 'killall', '--version'], stderr=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('killall (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('killall (sudo): missing')
-        return 1
-    logger.info('killall (sudo): found')
+    logger.info('parallel archives: ' + str(config.parallel_archives) +
+                ' (per device ' + str(config.parallel_per_device) +
+                ', per backup dir ' + str(config.parallel_per_backup_dir) +
+                ')')
 
-    try:
-        subprocess.check_call(['sudo', 'losetup', '-h'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('losetup (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('losetup (sudo): missing')
+    if config.provision_strategy not in ['auto', 'sparse'] + \
+            provision_strategies:
+        logger.error('unknown provision strategy: ' +
+                     config.provision_strategy)
         return 1
-    logger.info('losetup (sudo): found')
+    logger.info('provision strategy: ' + config.provision_strategy)
 
-    try:
-        subprocess.check_call(['sudo', 'mkdir', '--help'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('mkdir (sudo): error')
+    if dependencies_check(config.data_dir, recheck):
         return 1
-    except Exception, e:
-        logger.error('mkdir (sudo): missing')
-        return 1
-    logger.info('mkdir (sudo): found')
-
-    try:
-        subprocess.check_call(['sudo', 'mkfs.ext4', '-V'], stderr=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('mkfs.ext4 (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('mkfs.ext4 (sudo): missing')
-        return 1
-    logger.info('mkfs.ext4 (sudo): found')
-
-    try:
-        subprocess.check_call(['sudo', 'mount'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('mount (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('mount (sudo): missing')
-        return 1
-    logger.info('mount (sudo): found')
-
-    try:
-        subprocess.check_call(['sudo', 'mountpoint', '/'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('mountpoint (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('mountpoint (sudo): missing')
-        return 1
-    logger.info('mountpoint (sudo): found')
-
-    try:
-        subprocess.check_call(['pv', '--version'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('pv: error')
-        return 1
-    except Exception, e:
-        logger.error('pv: missing')
-        return 1
-    logger.info('pv: found')
-
-    try:
-        subprocess.check_call(['sudo', 'rsync', '--version'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('rsync (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('rsync (sudo): missing')
-        return 1
-    logger.info('rsync (sudo): found')
-
-    try:
-        subprocess.check_call(['sudo', 'tcplay', '-v'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('tcplay (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('tcplay (sudo): missing')
-        return 1
-    logger.info('tcplay (sudo): found')
-
-    try:
-        subprocess.check_call(['sudo', 'umount', '-h'], stdout=devnull)
-    except subprocess.CalledProcessError, e:
-        logger.error('umount (sudo): error')
-        return 1
-    except Exception, e:
-        logger.error('umount (sudo): missing')
-        return 1
-    logger.info('umount (sudo): found')
 
     config.archive_list = config.archives.split()
     for i, s in enumerate(config.archive_list):
@@ -702,6 +2398,28 @@ def config_validate(config, interactive):
         rc = dir_validate(config.archive_list[i], read=1)
         if rc:
             return 1
+        try:
+            controller = config_bandwidth(config, config.archive_list[i], 0)
+        except ValueError, e:
+            logger.error(config.archive_list[i] + ': bandwidth settings '
+                         'invalid: ' + str(e))
+            return 1
+        if controller:
+            logger.info(config.archive_list[i] + ': bandwidth limit ' +
+                        controller.describe())
+        if config_archive_option(config, config.archive_list[i],
+                                 'sync_shards', 1) < 1 or \
+           config_archive_option(config, config.archive_list[i],
+                                 'sync_shard_retries', 2) < 0:
+            logger.error(config.archive_list[i] + ': sync_shards must be at '
+                         'least 1 and sync_shard_retries not negative')
+            return 1
+        if config_archive_option(config, config.archive_list[i],
+                                 'compression', 'auto') not in \
+                ['auto', 'on', 'off']:
+            logger.error(config.archive_list[i] + ': compression must be '
+                         'auto, on, or off')
+            return 1
 
 
 def normalize_dir(dir):
@@ -718,22 +2436,20 @@ def mapper_check(lbdevice, archive_map, container_file, password_base,
     """ Verify we have a container mapping and offer to create one if not. """
     status_item('Mapped Device')
     status_result(archive_map)
-    if os.path.islink('/dev/mapper/' + container_file):
+    if kernel.mapped(container_file):
         status_item('/dev/mapper' + container_file)
         status_result('FOUND MAP', 1)
     else:
         if mapper_container(lbdevice, container_file, password_base, verbose):
             return 1
+        if mapper_extend(container_file, lbdevice, verbose):
+            return 1
 
 
 def mount_check(archive_map, archive_mount, mountcreate=False, verbose=False):
     """ Determine if the directory where an encrypted container will be
     mounted exists.  If mountcreate is True then the directory will be
     automatically created. """
-    if verbose:
-        status_item('Command')
-        status_result('sudo mountpoint ' + archive_mount)
-
     status_item('Mount Point')
     status_result(archive_mount)
     status_item('')
@@ -745,16 +2461,14 @@ def mount_check(archive_map, archive_mount, mountcreate=False, verbose=False):
         status_result('sudo mount ' + archive_map + ' ' + archive_mount)
 
     status_item('Mount Check')
-    p1 = subprocess.Popen(['sudo', 'mountpoint', archive_mount],
-                          stdout=subprocess.PIPE)
-    result = p1.communicate()[0]
-    if re.match('.*' + archive_mount + ' is a mountpoint.*', str(result)):
+    if kernel.mounted(archive_mount):
         status_result('MOUNTED', 1)
         return
     else:
         try:
             subprocess.check_call(['sudo', 'mount',
                                   archive_map, archive_mount])
+            kernel.invalidate()
         except subprocess.CalledProcessError, e:
             status_result('MOUNT ERROR', 3)
             return 1
@@ -764,23 +2478,34 @@ def mount_check(archive_map, archive_mount, mountcreate=False, verbose=False):
         status_result('MOUNTED', 4)
 
 
-def umount(mount_point, remove=False):
+def umount(mount_point, remove=False, timeout=10):
     """ Perform an umount operation to release a filesystem, typically during
-    cleanup.  Operation is performed via sudo.  Optionally remove the mount
-    point.  Return 1 if problems. """
-    devnull = open('/dev/null', 'w')
+    cleanup.  Operation is performed via sudo.  Processes still using the
+    filesystem are given up to timeout seconds to let go, and the umount
+    itself is retried while the kernel reports it busy.  Optionally remove
+    the mount point.  Return 1 if problems. """
+    if not kernel.mounted(mount_point):
+        return
+
+    deadline = time.time() + timeout
+    delay = 0.05
+    while mount_users(mount_point) and time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+
     try:
-        subprocess.check_call(['sudo', 'umount', mount_point], stderr=devnull)
-    except subprocess.CalledProcessError, e:
-        if re.match('.* returned non-zero exit status 1', str(e)):
-            # Not mounted.
-            return
+        rc, error = retry_busy(['sudo', 'umount', mount_point])
+    except OSError, e:
         status_item(mount_point)
-        status_result('ERROR UNMOUNTING', 3)
+        status_result('UNMOUNT COMMAND MISSING', 3)
         return 1
-    except Exception, e:
+    kernel.invalidate()
+    if rc:
         status_item(mount_point)
-        status_result('UNMOUNT COMMAND MISSING', 3)
+        if 'busy' in error.lower():
+            status_result('BUSY', 3)
+        else:
+            status_result('ERROR UNMOUNTING', 3)
         return 1
     status_item(mount_point)
     status_result('UNMOUNTED', 4)
@@ -796,17 +2521,19 @@ def umount(mount_point, remove=False):
 
 def unmap(container_file):
     """ Unmap a dm-crypt volume. """
-    if not os.path.islink('/dev/mapper/' + container_file):
+    if not kernel.mapped(container_file):
         return 0
 
     status_item('/dev/mapper/' + container_file)
     try:
-        subprocess.check_call(['sudo', 'dmsetup', 'remove', container_file])
-    except subprocess.CalledProcessError, e:
+        rc, error = retry_busy(['sudo', 'dmsetup', 'remove', container_file])
+    except OSError, e:
+        status_result('UNMAP COMMAND MISSING', 3)
+        return 1
+    kernel.invalidate()
+    if rc:
         status_result('ERROR UNMAPPING', 3)
         return 1
-    except Exception, e:
-        status_result('UNMAP COMMAND MISSING', 3)
     status_result('UNMAPPED', 4)
 
 
@@ -836,7 +2563,8 @@ def mapper_container(lbdevice, container_file, password_base, verbose=False):
         status_result("\n\n" + str(e) + "\n")
         return 1
 
-    if os.path.islink('/dev/mapper/' + container_file):
+    kernel.invalidate()
+    if kernel.mapped(container_file):
         status_result('VERIFIED', 1)
     else:
         status_result('FAILURE', 3)
@@ -849,6 +2577,84 @@ def mapper_container(lbdevice, container_file, password_base, verbose=False):
         return 1
 
 
+def mapper_extend(container_file, lbdevice, verbose=False):
+    """ Extend a dm-crypt mapping to cover the whole loopback device.
+
+    tcplay maps only the data area recorded in the TrueCrypt header when the
+    container was created: the header area, then the data area, then 128K
+    of backup headers at the very end.  Once the container file has been
+    grown, the data area is extended to end 128K before the new end of the
+    file.  tcplay cannot rewrite the header, so this is repeated every time
+    the container is mapped; it is a no-op for containers which have never
+    been grown.  Return 1 if failure or 0 if successful. """
+    try:
+        table = subprocess.Popen(['sudo', 'dmsetup', 'table', '--showkeys',
+                                  container_file],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE).communicate()[0]
+    except Exception, e:
+        status_item('Mapping Size')
+        status_result('COMMAND NOT FOUND', 3)
+        return 1
+
+    # start length crypt cipher key iv_offset device offset [options]
+    fields = table.split()
+    sectors = loopback_sectors(lbdevice)
+    if len(fields) < 8 or fields[2] != 'crypt' or not sectors:
+        status_item('Mapping Size')
+        status_result('UNRECOGNIZED MAPPING', 3)
+        return 1
+
+    length = sectors - int(fields[7]) - 256
+    if length <= int(fields[1]):
+        return 0
+
+    fields[1] = str(length)
+    if verbose:
+        status_item('Command')
+        status_result('sudo dmsetup reload ' + container_file)
+    status_item('Mapping Size')
+    try:
+        # The table holds the key, so it is fed on stdin rather than put on
+        # the command line where any user could read it.
+        p = subprocess.Popen(['sudo', 'dmsetup', 'reload', container_file],
+                             stdin=subprocess.PIPE)
+        p.communicate(' '.join(fields) + '\n')
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, 'dmsetup')
+        subprocess.check_call(['sudo', 'dmsetup', 'resume', container_file])
+    except subprocess.CalledProcessError, e:
+        status_result('RELOAD ERROR', 3)
+        return 1
+    except Exception, e:
+        status_result('COMMAND NOT FOUND', 3)
+        return 1
+    status_result('EXTENDED ' + size(length * 512), 4)
+    return 0
+
+
+def filesystem_grow(archive_map, verbose=False):
+    """ Grow a mounted ext4 filesystem online to fill its device.  Return 1
+    if failure or 0 if successful. """
+    if verbose:
+        status_item('Command')
+        status_result('sudo resize2fs ' + archive_map)
+
+    status_item('Filesystem Grow')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['sudo', 'resize2fs', archive_map],
+                                  stdout=devnull, stderr=devnull)
+    except subprocess.CalledProcessError, e:
+        status_result('RESIZE ERROR', 3)
+        return 1
+    except Exception, e:
+        status_result('COMMAND NOT FOUND', 3)
+        return 1
+    status_result('GROWN', 4)
+    return 0
+
+
 def filesystem_check(archive_map):
     """ Verify the integrity of an ext4 filesystem within an encrypted
     container. """
@@ -880,9 +2686,9 @@ def filesystem_format(archive_map, verbose=False):
         p = subprocess.Popen(['sudo', 'mkfs.ext4', archive_map],
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         print
-        t1 = Thread(target=print_pipe, args=('stdout', p.stdout,))
+        t1 = status_thread(print_pipe, ('stdout', p.stdout,))
         t1.start()
-        t2 = Thread(target=print_pipe, args=('stderr', p.stderr,))
+        t2 = status_thread(print_pipe, ('stderr', p.stderr,))
         t2.start()
         t1.join()
         t2.join()
@@ -897,46 +2703,731 @@ def filesystem_format(archive_map, verbose=False):
     print
 
 
-def sync(source, target, bwlimit=1300):
-    """ Synchronize files from a source to a target location. """
+# One change reported by rsync: kind is 'created', 'changed', 'deleted',
+# 'progress', or 'transferred' once a file is complete, bytes is the amount
+# of the current file transferred so far, and rate is rsync's current
+# transfer rate in bytes per second.
+rsync_event = namedtuple('rsync_event', 'kind path bytes rate')
+
+
+def rsync_number(text):
+    """ Convert a number printed by rsync, such as 1,234,567 or with
+    --human-readable 1.23M, to a float. """
+    m = re.match('([0-9.,]+)([kKMGT]?)', text)
+    return float(m.group(1).replace(',', '')) * \
+        {'': 1, 'k': 1e3, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}[m.group(2)]
+
+
+class rsync_progress:
+    """ Streaming parser for the output of rsync --itemize-changes --progress
+    --stats.  Each line fed to it is turned into rsync_events, which are
+    folded into running totals so that transfer performance can be measured
+    while rsync runs and reported once it finishes. """
+
+    number = '([0-9][0-9.,]*[kKMGT]?)'
+    itemized = re.compile('([<>ch.])([fdLDS])(\\S{7,10}) (.+)$')
+    deleting = re.compile('\\*deleting +(.+)$')
+    progress = re.compile(' *' + number + ' +([0-9]+)% +' + number +
+                          'B/s +[0-9:]+(?: +\\(xfr#([0-9]+), '
+                          '(?:to|ir)-chk=([0-9]+)/([0-9]+)\\))?')
+    stats = {'Total bytes sent': 'sent',
+             'Literal data': 'literal'}
+
+    def __init__(self):
+        self.lock = Lock()
+        self.time_init = time.time()
+        self.time_final = None
+        self.returncode = None
+        self.created = 0
+        self.changed = 0
+        self.deleted = 0
+        self.transferred = 0
+        self.bytes_done = 0
+        self.bytes_current = 0
+        self.rate = 0
+        self.to_check = None
+        self.check_total = None
+        self.sent = None
+        self.literal = None
+        self.path = None
+
+    def parse(self, line):
+        """ Return the events described by a line of rsync output.  Progress
+        updates for a file are separated by carriage returns rather than
+        newlines, so a single line may hold several of them. """
+        events = []
+        for segment in line.rstrip('\n').split('\r'):
+            if not segment.strip():
+                continue
+            m = self.progress.match(segment)
+            if m:
+                events.append(rsync_event(
+                    'transferred' if m.group(4) else 'progress', self.path,
+                    rsync_number(m.group(1)), rsync_number(m.group(3))))
+                if m.group(4):
+                    self.to_check = int(m.group(5))
+                    self.check_total = int(m.group(6))
+                continue
+            m = self.deleting.match(segment)
+            if m:
+                events.append(rsync_event('deleted', m.group(1), 0, 0))
+                continue
+            m = self.itemized.match(segment)
+            if m:
+                flags = m.group(3)
+                if flags.strip('+') == '':
+                    kind = 'created'
+                elif flags.strip('. ') == '' and m.group(1) == '.':
+                    # Listed, but nothing about the file changed.
+                    continue
+                else:
+                    kind = 'changed'
+                self.path = m.group(4)
+                events.append(rsync_event(kind, self.path, 0, 0))
+                continue
+            if ':' in segment:
+                name, value = segment.split(':', 1)
+                if name in self.stats and value.strip():
+                    setattr(self, self.stats[name],
+                            rsync_number(value.strip()))
+        return events
+
+    def feed(self, line):
+        """ Parse a line of rsync output and fold it into the totals.  Return
+        the events it described. """
+        with self.lock:
+            events = self.parse(line)
+            for event in events:
+                if event.kind in ('progress', 'transferred'):
+                    self.rate = event.rate
+                    if event.bytes < self.bytes_current:
+                        # A new file started without a final 100% line.
+                        self.bytes_done += self.bytes_current
+                    self.bytes_current = event.bytes
+                    if event.kind == 'transferred':
+                        self.transferred += 1
+                        self.bytes_done += self.bytes_current
+                        self.bytes_current = 0
+                elif event.kind == 'created':
+                    self.created += 1
+                elif event.kind == 'changed':
+                    self.changed += 1
+                elif event.kind == 'deleted':
+                    self.deleted += 1
+            return events
+
+    def absorb(self, other):
+        """ Add the totals of another, finished, transfer to these, for
+        example those of one shard of a sharded sync. """
+        with self.lock:
+            self.created += other.created
+            self.changed += other.changed
+            self.deleted += other.deleted
+            self.transferred += other.transferred
+            self.bytes_done += other.bytes_done + other.bytes_current
+            for name in ['sent', 'literal']:
+                if getattr(other, name) is not None:
+                    setattr(self, name, (getattr(self, name) or 0) +
+                            getattr(other, name))
+
+    def finish(self, returncode):
+        with self.lock:
+            self.returncode = returncode
+            self.time_final = time.time()
+            self.bytes_done += self.bytes_current
+            self.bytes_current = 0
+
+    def totals(self):
+        """ Return the running totals as a dictionary.  compressed is the
+        percentage saved by --compress on the wire, and eta the estimated
+        seconds remaining, either of which may be None if rsync has not yet
+        said enough to tell. """
+        with self.lock:
+            elapsed = (self.time_final or time.time()) - self.time_init
+            files = self.created + self.changed
+            bytes = self.bytes_done + self.bytes_current
+            compressed = None
+            if self.sent is not None and self.literal:
+                compressed = max(0.0, 100.0 * (1 - self.sent / self.literal))
+            eta = None
+            if self.to_check is not None and self.check_total:
+                done = self.check_total - self.to_check
+                if self.time_final:
+                    eta = 0.0
+                elif done:
+                    eta = elapsed * self.to_check / done
+            return {'files': files,
+                    'created': self.created,
+                    'changed': self.changed,
+                    'deleted': self.deleted,
+                    'transferred': self.transferred,
+                    'bytes': int(bytes),
+                    'elapsed': elapsed,
+                    'files_per_second': files / elapsed if elapsed else 0.0,
+                    'mb_per_second': bytes / 1e6 / elapsed if elapsed
+                    else 0.0,
+                    'rate': self.rate,
+                    'compressed': compressed,
+                    'eta': eta,
+                    'returncode': self.returncode}
+
+    def describe(self):
+        """ Summarize the totals in a single line. """
+        t = self.totals()
+        line = '%d files (%d created, %d changed, %d deleted), %s in ' \
+            '%0.1f seconds, %0.1f files/s, %0.2f MB/s' % \
+            (t['files'], t['created'], t['changed'], t['deleted'],
+             size(t['bytes']), t['elapsed'], t['files_per_second'],
+             t['mb_per_second'])
+        if t['compressed'] is not None:
+            line += ', %0.0f%% compressed' % t['compressed']
+        return line
+
+
+def bandwidth_schedule(text):
+    """ Parse a schedule of bandwidth limits by time of day, such as
+    "08:00-18:00 1300, 18:00-08:00 0", into a list of (start minute, end
+    minute, KBps) where 0 means no limit.  Windows may wrap past midnight.
+    Raise ValueError if malformed. """
+    schedule = []
+    for window in [w.strip() for w in text.split(',') if w.strip()]:
+        m = re.match('([0-9]{1,2}):([0-9]{2}) *- *([0-9]{1,2}):([0-9]{2}) +'
+                     '([0-9]+)$', window)
+        if not m:
+            raise ValueError('bad schedule window "' + window + '"')
+        start = int(m.group(1)) * 60 + int(m.group(2))
+        end = int(m.group(3)) * 60 + int(m.group(4))
+        if start >= 1440 or end > 1440:
+            raise ValueError('bad time in schedule window "' + window + '"')
+        schedule.append((start, end, int(m.group(5))))
+    return schedule
+
+
+def clock_time(text):
+    """ Parse HH:MM into minutes past midnight.  Raise ValueError if
+    malformed. """
+    m = re.match('([0-9]{1,2}):([0-9]{2})$', text.strip())
+    if not m or int(m.group(1)) >= 24 or int(m.group(2)) >= 60:
+        raise ValueError('bad time "' + text + '"')
+    return int(m.group(1)) * 60 + int(m.group(2))
+
+
+class bandwidth_controller:
+    """ Choose the rsync bandwidth limit over the course of a transfer.  The
+    limit follows a time of day schedule, is raised when rsync's estimated
+    completion would miss the deadline, and is never raised beyond what
+    the measured throughput shows the link can deliver.  Limits are in
+    KBps, as for rsync --bwlimit, with 0 meaning no limit.
+
+    rsync cannot change its limit while running, so each change restarts
+    it.  --partial keeps the file in flight, but the file list has to be
+    rebuilt, so the limit only changes after interval seconds and when it
+    moves by at least a fifth. """
+
+    def __init__(self, minimum=100, maximum=0, schedule=[], deadline='',
+                 interval=300, default=0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.schedule = schedule
+        self.interval = interval
+        self.default = default
+        self.deadline = None
+        if deadline:
+            minutes = clock_time(deadline)
+            now = time.localtime()
+            self.deadline = time.mktime(now[:3] + (minutes // 60,
+                                                   minutes % 60, 0) +
+                                        now[6:8] + (-1,))
+            if self.deadline <= time.time():
+                self.deadline += 86400
+        if minimum < 0 or maximum < 0 or interval < 0:
+            raise ValueError('limits and interval must not be negative')
+        if maximum and minimum > maximum:
+            raise ValueError('bwlimit_min exceeds bwlimit_max')
+        self.bytes_last = 0
+        self.time_last = None
+
+    def scheduled(self, now=None):
+        """ Return the limit the schedule calls for at a given time. """
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, limit in self.schedule:
+            if start <= end and start <= minute < end or \
+               start > end and (minute >= start or minute < end):
+                return limit
+        return self.default
+
+    def clamp(self, limit):
+        if self.maximum and (not limit or limit > self.maximum):
+            limit = self.maximum
+        if limit and limit < self.minimum:
+            limit = self.minimum
+        return int(limit)
+
+    def limit(self, progress=None, current=None):
+        """ Return the limit to use now, given the totals so far and the
+        limit rsync is currently running with. """
+        now = time.time()
+        limit = self.scheduled(now)
+        if progress:
+            totals = progress.totals()
+            measured = None
+            if self.time_last and now > self.time_last:
+                measured = (totals['bytes'] - self.bytes_last) / \
+                    (now - self.time_last) / 1024
+            self.bytes_last = totals['bytes']
+            self.time_last = now
+
+            if self.deadline and totals['eta'] and measured:
+                left = self.deadline - now
+                needed = measured * totals['eta'] / max(left, 1)
+                if limit and needed > limit:
+                    limit = needed * 1.1
+            if limit and current and measured is not None and \
+               measured < current * 0.5 and limit > current:
+                # The link, not the limit, is holding rsync back, so a
+                # higher limit would only cost a restart.
+                limit = current
+        return self.clamp(limit)
+
+    def worth_changing(self, current, limit):
+        if current == limit:
+            return False
+        if not current or not limit:
+            return True
+        return abs(limit - current) >= current * 0.2
+
+    def watch(self, process, progress, current):
+        """ Wait for rsync to exit, checking every interval seconds whether
+        the limit should change.  If it should, stop rsync and return the
+        new limit so the caller can restart it, otherwise return None once
+        rsync has exited. """
+        self.bytes_last = progress.totals()['bytes']
+        self.time_last = time.time()
+        while process_wait(process, max(self.interval, 1)) is None:
+            limit = self.limit(progress, current)
+            if self.worth_changing(current, limit):
+                process.terminate()
+                if process_wait(process, 30) is None:
+                    return None
+                return limit
+
+    def describe(self):
+        line = 'adaptive, ' + str(self.minimum) + '-' + \
+            (str(self.maximum) if self.maximum else 'unlimited') + ' KBps'
+        if self.schedule:
+            line += ', ' + ', '.join(['%02d:%02d-%02d:%02d %s' %
+                                      (start // 60, start % 60, end // 60,
+                                       end % 60, limit or 'unlimited')
+                                      for start, end, limit in self.schedule])
+        if self.deadline:
+            line += ', finish by ' + \
+                time.strftime('%H:%M', time.localtime(self.deadline))
+        return line
+
+
+def rsync_options(bwlimit, compression=['--compress'], delete=True,
+                  recursive=True):
+    """ Return the rsync options used to synchronize an archive.  Without
+    delete, files missing from the source are left in the target. """
+    options = ['--bwlimit', str(bwlimit)] + compression
+    if recursive:
+        options += ['--recursive']
+    options += ['--links', '--perms', '--times', '--group', '--owner',
+                '--partial', '--verbose', '--progress']
+    if delete:
+        options += ['--delete', '--delete-delay', '--max-delete=250']
+    return options + ['--human-readable', '--itemize-changes', '--stats']
+
+
+class shard_plan:
+    """ Split an archive into shards of roughly equal cost for parallel
+    rsync workers.  Files seen during the inventory are tallied per
+    directory; each file costs file_cost on top of its size, since on trees
+    of many small files the per-file round trips dominate.  The heaviest
+    directories are then broken into their subdirectories and loose files
+    until the pieces are small enough to balance, and the pieces dealt out
+    largest first to the lightest shard. """
+
+    file_cost = 131072
+
+    def __init__(self, archive_dir, shards):
+        self.root = archive_dir.rstrip('/')
+        self.shards = shards
+        # relative directory -> [files, bytes] directly within it
+        self.direct = {'': [0, 0]}
+        self.children = {'': set()}
+        # directories broken into pieces by the last call to pieces()
+        self.split = []
+
+    def observe(self, entry):
+        rel = os.path.relpath(os.path.dirname(entry.path), self.root)
+        if rel == '.':
+            rel = ''
+        if rel.startswith('..'):
+            return
+        if rel not in self.direct:
+            # Register the directory and any ancestors not yet seen.
+            child = rel
+            while child not in self.direct:
+                self.direct[child] = [0, 0]
+                self.children[child] = set()
+                parent = os.path.dirname(child)
+                self.children.setdefault(parent, set()).add(child)
+                child = parent
+        self.direct[rel][0] += 1
+        self.direct[rel][1] += entry.size
+
+    def weights(self):
+        """ Return the total cost of every directory's subtree. """
+        totals = {}
+        for rel in sorted(self.direct, key=lambda r: r.count('/') +
+                          bool(r), reverse=True):
+            files, bytes = self.direct[rel]
+            totals[rel] = files * self.file_cost + bytes + \
+                sum([totals[c] for c in self.children[rel]])
+        return totals
+
+    def pieces(self):
+        """ Return the pieces to deal out, each a (cost, paths) pair with
+        paths relative to the archive directory.  A directory listed is
+        transferred recursively; those broken up are listed in split. """
+        totals = self.weights()
+        target = totals[''] / (self.shards * 4.0)
+        pieces = [(totals[''], ['.'], '')]
+        self.split = []
+        while len(pieces) < self.shards * 64:
+            pieces.sort(reverse=True)
+            cost, paths, rel = pieces[0]
+            if rel is None or cost <= target or not self.children[rel]:
+                break
+            pieces.pop(0)
+            self.split.append(rel)
+            for child in self.children[rel]:
+                pieces.append((totals[child], [child], child))
+            # Files directly within the directory travel together.
+            try:
+                names = os.listdir(os.path.join(self.root, rel))
+            except OSError:
+                names = []
+            loose = [os.path.join(rel, n) for n in names
+                     if os.path.join(rel, n) not in self.children[rel]]
+            if loose:
+                files, bytes = self.direct[rel]
+                pieces.append((files * self.file_cost + bytes, loose, None))
+        return [(cost, paths) for cost, paths, rel in pieces]
+
+    def plan(self):
+        """ Return a list of shards, each a list of paths relative to the
+        archive directory. """
+        shards = [[0, []] for i in range(self.shards)]
+        for cost, paths in sorted(self.pieces(), reverse=True):
+            lightest = min(shards, key=lambda shard: shard[0])
+            lightest[0] += cost
+            lightest[1].extend(paths)
+        return [paths for cost, paths in shards if paths]
+
+
+def sync_sharded(source, target, shards, list_dir, bwlimit=1300,
+                 started=None, progress=None, compression=['--compress'],
+                 retries=2, options=[], split=[]):
+    """ Synchronize files from a source to a target location with one rsync
+    worker per shard, each shard being a list of paths relative to source.
+    Each worker deletes within the directories it transfers recursively,
+    and failed workers are retried.  split lists the directories broken up
+    between shards, which no worker owns as a whole.  Once every shard has
+    succeeded, a final rsync is given just those directories, to settle
+    their times and create any left empty, and whatever they hold in the
+    target which is no longer in the source, to delete it.  --max-delete
+    is divided between the workers, as is the bandwidth limit.  options are
+    further rsync options for every worker, such as filters.  Return 1 if
+    any problems. """
+    status_item('Sync')
+    status_result('IN PROGRESS (' + str(len(shards)) + ' SHARDS)', 2)
+    if not progress:
+        progress = rsync_progress()
+    source = source.rstrip('/')
+    parent, base = os.path.split(source)
+    limit = bwlimit and max(1, bwlimit // len(shards))
+    max_delete = max(1, 250 // len(shards))
+    parsers = [rsync_progress() for shard in shards]
+    results = [None] * len(shards)
+
+    def worker(n):
+        list_file = list_dir + base + '.shard' + str(n)
+        with open(list_file, 'w') as f:
+            for path in shards[n]:
+                f.write(os.path.normpath(os.path.join(base, path)) + '\0')
+        delay = 1
+        for attempt in range(retries + 1):
+            try:
+                p = subprocess.Popen(['sudo', 'rsync'] +
+                                     rsync_options(limit, compression,
+                                                   delete=False) +
+                                     ['--delete', '--delete-delay',
+                                      '--max-delete=' + str(max_delete)] +
+                                     options +
+                                     ['--from0', '--files-from=' + list_file,
+                                      parent + '/', target],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+            except OSError, e:
+                results[n] = e.errno
+                break
+            if started:
+                started(p)
+            # Only the attempt which finishes counts towards the totals.
+            parsers[n] = rsync_progress()
+            prefix = '[' + str(n + 1) + '] '
+            t = status_thread(print_pipe, ('stderr', p.stderr, None, prefix))
+            t.start()
+            print_pipe('stdout', p.stdout, parsers[n], prefix)
+            t.join()
+            results[n] = p.wait()
+            # 24 means files vanished while being read, and 20 that rsync was
+            # interrupted, which retrying would defeat.
+            if results[n] in [0, 20, 24]:
+                break
+            if attempt < retries:
+                status_item('Shard ' + str(n + 1))
+                status_result('RETRYING AFTER ERROR ' + str(results[n]), 2)
+                time.sleep(delay)
+                delay *= 2
+        parsers[n].finish(results[n])
+        try:
+            os.remove(list_file)
+        except OSError:
+            pass
+
+    threads = [status_thread(worker, (n,)) for n in range(len(shards))]
+    for t in threads:
+        t.daemon = True  # thread dies with the program
+        t.start()
+    for t in threads:
+        # Join in slices so that Ctrl-C still reaches the main thread.
+        while t.is_alive():
+            t.join(0.5)
+
+    print
+    failed = False
+    for n in range(len(shards)):
+        status_item('Shard ' + str(n + 1))
+        if results[n] in [0, 24]:
+            status_result(parsers[n].describe())
+        else:
+            status_result('FAILED WITH ERROR ' + str(results[n]), 3)
+            failed = True
+        progress.absorb(parsers[n])
+    if failed:
+        status_item('Sync')
+        status_result('ERROR', 3)
+        return 1
+
+    if not split:
+        return 0
+    status_item('Sync')
+    status_result('SETTLING ' + str(len(split)) + ' SPLIT DIRECTORIES', 2)
+    # List what the split directories hold in the target, one level deep,
+    # with a single find as root, since root wrote the container.  %H is
+    # the directory each name was found under.
+    copy = os.path.join(target.rstrip('/'), base)
+    starts = dict((os.path.normpath(os.path.join(copy, rel)), rel)
+                  for rel in split)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            found = subprocess.Popen(['sudo', 'find'] + sorted(starts) +
+                                     ['-mindepth', '1', '-maxdepth', '1',
+                                      '-printf', '%H\\0%f\\0'],
+                                     stdout=subprocess.PIPE,
+                                     stderr=devnull).communicate()[0]
+    except OSError, e:
+        status_item('Sync')
+        status_result('ERROR ' + str(e), 3)
+        return 1
+    found = found.split('\0')[:-1]
+    files = [rel or '.' for rel in split]
+    present = {}
+    for start, name in zip(found[0::2], found[1::2]):
+        rel = starts.get(os.path.normpath(start))
+        if rel is None:
+            continue
+        if rel not in present:
+            try:
+                present[rel] = set(os.listdir(os.path.join(source, rel)))
+            except OSError:
+                present[rel] = set()
+        if name not in present[rel]:
+            files.append(os.path.join(rel, name))
+    return sync(source, target, bwlimit, started, progress,
+                compression=compression, files=files, options=options)
+
+
+class change_journal:
+    """ The state of an archive as of its last successful sync, so that the
+    next sync can be limited to what changed rather than having rsync scan
+    both the source and the target in full.  Entries from the current
+    inventory are written to a scan table, which is diffed against the
+    journal by size, times, mode, and type, and replaces it once the sync
+    succeeds.  Kept in SQLite so that millions of entries need not be held
+    in memory. """
+
+    def __init__(self, file, root, batch=1000):
+        self.root = root.rstrip('/')
+        self.batch = batch
+        self.pending = []
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for table in ['entries', 'scan']:
+            self.db.execute('CREATE TABLE IF NOT EXISTS ' + table +
+                            ' (path TEXT PRIMARY KEY, type TEXT, size '
+                            'INTEGER, mtime REAL, ctime REAL, mode INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY '
+                        'KEY, value TEXT)')
+        self.db.execute('DELETE FROM scan')
+        self.db.commit()
+
+    def observe(self, entry):
+        self.pending.append((os.path.relpath(entry.path, self.root),
+                             entry.type, entry.size, entry.mtime,
+                             entry.ctime, entry.mode))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany('INSERT OR REPLACE INTO scan VALUES '
+                            '(?, ?, ?, ?, ?, ?)', self.pending)
+        self.pending = []
+
+    def full_due(self, days):
+        """ Return True if a full sync is due, because there is no journal
+        yet or the last full sync was more than days ago.  Full syncs catch
+        anything the journal cannot see, such as changes made directly to
+        the target. """
+        row = self.db.execute('SELECT value FROM meta WHERE key = '
+                              '"last_full"').fetchone()
+        return not row or float(row[0]) < time.time() - days * 86400
+
+    def changes(self):
+        """ Return the paths, relative to the archive, which are new or
+        changed since the journal, and those which have been deleted. """
+        self.flush()
+        changed = [row[0] for row in self.db.execute(
+            'SELECT s.path FROM scan s LEFT JOIN entries e ON s.path = '
+            'e.path WHERE e.path IS NULL OR e.type != s.type OR e.size != '
+            's.size OR e.mtime != s.mtime OR e.ctime != s.ctime OR e.mode '
+            '!= s.mode')]
+        deleted = [row[0] for row in self.db.execute(
+            'SELECT e.path FROM entries e LEFT JOIN scan s ON s.path = '
+            'e.path WHERE s.path IS NULL')]
+        return changed, deleted
+
+    def commit(self, full=False):
+        """ Make the current inventory the journal, after a successful
+        sync. """
+        self.flush()
+        self.db.execute('DELETE FROM entries')
+        self.db.execute('INSERT INTO entries SELECT * FROM scan')
+        self.db.execute('DELETE FROM scan')
+        if full:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES '
+                            '("last_full", ?)', (str(time.time()),))
+        self.db.commit()
+
+    def close(self):
+        self.pending = []
+        self.db.execute('DELETE FROM scan')
+        self.db.commit()
+        self.db.close()
+
+
+def sync(source, target, bwlimit=1300, started=None, progress=None,
+         controller=None, compression=['--compress'], files=None,
+         options=[]):
+    """ Synchronize files from a source to a target location.  If given,
+    started is called with the rsync process as soon as it is launched so
+    that cleanup can wait for it to exit, and rsync's output is fed to the
+    progress parser so that the caller can report on the transfer.  A
+    bandwidth controller replaces the static bwlimit, restarting rsync
+    whenever it calls for a different limit.  compression is the list of
+    rsync compression options to use.
+
+    If files is given, only those paths (relative to source) are
+    transferred, without recursing into directories, and any which no
+    longer exist in the source are deleted from the target, directories
+    along with whatever they still contain.  options are
+    further rsync options, such as filters.  Return 1 if failure, including
+    any rsync exit status but 0 and 24 (files vanished), or 0 if
+    successful. """
     status_item('Sync')
     status_result('IN PROGRESS', 2)
+    if not progress:
+        progress = rsync_progress()
+    if controller:
+        bwlimit = controller.limit()
+    list_file = None
     try:
-        cmd = 'sudo rsync ' \
-              '--bwlimit ' + str(bwlimit) + ' ' + \
-              '--compress ' + \
-              '--recursive ' + \
-              '--links ' + \
-              '--perms ' + \
-              '--times ' + \
-              '--group ' + \
-              '--owner ' + \
-              '--partial ' + \
-              '--verbose ' + \
-              '--progress ' + \
-              '--delete ' + \
-              '--delete-delay ' + \
-              '--max-delete=250 ' + \
-              '--human-readable ' + \
-              '--itemize-changes ' + \
-              source.rstrip('/') + ' ' + target
-
-        p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        print
-        t1 = Thread(target=print_pipe, args=('stdout', p.stdout,))
-        t1.start()
-        t2 = Thread(target=print_pipe, args=('stderr', p.stderr,))
-        t2.start()
-        t1.join()
-        t2.join()
+        if files is not None:
+            list_fd, list_file = tempfile.mkstemp(prefix='ArchiveR3-')
+            parent, base = os.path.split(source.rstrip('/'))
+            with os.fdopen(list_fd, 'w') as f:
+                for path in files:
+                    f.write(os.path.join(base, path) + '\0')
+        while True:
+            if list_file:
+                cmd = ['sudo', 'rsync'] + \
+                    rsync_options(bwlimit, compression, delete=False,
+                                  recursive=False) + options + \
+                    ['--delete-missing-args', '--force', '--max-delete=250',
+                     '--from0', '--files-from=' + list_file, parent + '/',
+                     target]
+            else:
+                cmd = ['sudo', 'rsync'] + \
+                    rsync_options(bwlimit, compression) + options + \
+                    [source.rstrip('/'), target]
+
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            if started:
+                started(p)
+            print
+            t1 = status_thread(print_pipe, ('stdout', p.stdout, progress))
+            t1.start()
+            t2 = status_thread(print_pipe, ('stderr', p.stderr,))
+            t2.start()
+            limit = None
+            if controller:
+                limit = controller.watch(p, progress, bwlimit)
+            t1.join()
+            t2.join()
+            rc = p.wait()
+            if limit is None:
+                break
+            print
+            status_item('Bandwidth Limit')
+            status_result('RESTARTING AT ' +
+                          (str(limit) + ' KBps' if limit else 'NO LIMIT'), 2)
+            bwlimit = limit
+        progress.finish(rc)
         print
+        status_item('Transfer')
+        status_result(progress.describe())
+        # 24 means files vanished while being read, which is expected of a
+        # live source.
+        if rc not in [0, 24]:
+            status_item('')
+            status_result('ERROR ' + str(rc), 3)
+            return 1
     except subprocess.CalledProcessError, e:
         status_result('ERROR', 3)
         return 1
     except Exception, e:
         status_result('NOT FOUND ' + str(e), 3)
         return 1
+    finally:
+        if list_file:
+            os.remove(list_file)
     status_item('')
     status_result('SYNCHRONIZED', 1)
     print
+    return 0
@@ -14,9 +14,41 @@ import math
 import re
 import subprocess
 import sys
+from threading import Condition, Event, Lock, Thread
 import time
 
 
+class archive_job:
+    """ State for a single archive being backed up.  The container file,
+    mount point, and loopback device are key to performing safe cleanup if
+    the archive fails or the user Ctrl-C's out. """
+
+    def __init__(self, archive_dir, config):
+        self.archive_dir = archive_dir
+        self.container = config.backup_dir + \
+            archive_dir.split('/')[-2] + '.archive'
+        self.reset(config)
+        self.lbdevice = ''
+        self.rc = None
+        # The rsync child processes, waited on before the mount is released.
+        self.rsync = []
+        # Parsed rsync output, reported once the backup is over.
+        self.transfer = None
+        # The change journal from the previous run, if one is kept.
+        self.journal = None
+        # Source device, used to limit concurrent reads from the same disk.
+        try:
+            self.device = os.stat(archive_dir).st_dev
+        except OSError:
+            self.device = archive_dir
+
+    def reset(self, config):
+        """ Repopulate the names needed for cleanup, for example after the
+        container has been torn down to be recreated. """
+        self.container_file = self.archive_dir.split('/')[-2] + '.archive'
+        self.archive_mount = config.mount_dir + self.container_file
+
+
 class backup:
     """ Perform a backup via rsync to an encrypted filesystem hosted in the
     cloud. """
@@ -32,6 +64,22 @@ class backup:
         self.container_overhead_fixed = 6225865
         self.container_overhead_percent = 7.5
         self.logfile = 'ArchiveR3-' + time.strftime("%Y%m%d-%H%M%S") + '.log'
+        self.jobs = []
+        # Threads backing up archives in parallel, with their jobs.
+        self.workers = []
+        self.abort_event = Event()
+        self.loopback_lock = Lock()
+        self.prompt_lock = Lock()
+        self.schedule_cond = Condition()
+        # rsync totals of each archive, filled in by backup().
+        self.transfers = {}
+        # Content index across archives, opened by backup() if configured.
+        self.dedup = None
+        # Per-phase timings, written next to the log file.
+        self.report = run_report('backup')
+        self.report_file = None
+        # node_exporter textfile directory, if metrics are configured.
+        self.metrics_dir = ''
 
     def args_process(self):
         """ Process command-line arguments. """
@@ -57,7 +105,9 @@ class backup:
                             'for example the archive is being created on a '
                             'local filesystem where you do not care about '
                             'saturating the connection and want to write '
-                            'as quickly as possible.', default=1300)
+                            'as quickly as possible.  Archives configured '
+                            'with bwlimit_adaptive use this only outside '
+                            'their bwlimit_schedule.', default=1300)
         parser.add_argument('-c', '--cleanup', action='store_true',
                             help='Perform cleanup operations only, no '
                             'backup.  Cleanup consists of unmounting, '
@@ -72,6 +122,10 @@ class backup:
                             'prompting.')
         parser.add_argument('--mountcreate', action='store_true',
                             help='Create the mount point automatically.')
+        parser.add_argument('--recheck', action='store_true',
+                            help='Probe every dependency utility again, '
+                            'rather than trusting the results cached by a '
+                            'previous run.')
         parser.add_argument('--reprovision', action='store_true',
                             help='Reprovision the container automatically '
                             'if too small.')
@@ -138,284 +192,718 @@ class backup:
         """ Create an encrypted container.  The resulting containersize is only
         accurate to the nearest megabyte.  Return 1 if any problems or 0 for
         success. """
-        if self.args.create:
-            status_item('!! CREATE CONTAINER')
-            status_result('CONFIRMED', 4)
-        else:
-            status_item('!! CREATE CONTAINER? (y/n)')
-
-        if self.args.create or raw_input() == 'y':
-            archive_size = int(float(arc_block) /
-                               float(self.config.provision_capacity_percent)
-                               * 100)
-            status_item('Archive Block Size')
-            status_result(str(arc_block) + ' (' + size(arc_block) + ')')
-            status_item('Provision Capacity')
-            status_result(str(archive_size) + ' (' + size(archive_size) + ')')
-            status_item('Required Container Size')
-            # Round to the nearest megabyte to speed up dd blocksize below.
-            container_size_needed_m = \
-                int(math.ceil(self.calc_archive_container(archive_size)
-                    / 1048576))
-
-            status_result(str(container_size_needed_m * 1048576) + ' (' +
-                          str(container_size_needed_m) + 'M)')
+        if self.confirm('CREATE CONTAINER', self.args.create):
+            container_size_needed = self.calc_container_size(arc_block)
             status_item('Generating Container')
             status_result('IN PROGRESS', 2)
-            try:
-                if self.args.verbose:
-                    status_item('Command')
-                    status_result('dd if=/dev/zero bs=1048576 status=none ' +
-                                  'count=' + str(container_size_needed_m) +
-                                  ' ' + 'of=' + container)
-
-                print
-
-                # TODO: need to convert this into a scheme which is not
-                # dependent on Unix pipes
-                subprocess.check_call('dd if=/dev/zero bs=1048576 ' +
-                                      'status=none ' +
-                                      'count=' + str(container_size_needed_m) +
-                                      ' | pv -s ' +
-                                      str(container_size_needed_m * 1048576) +
-                                      ' | ' + 'dd status=none ' +
-                                      'of=' + container, shell=True)
-                print
-            except subprocess.CalledProcessError, e:
-                status_item('Generation Result')
-                status_result('FAILED: ' + str(e), 3)
-                return 1
-            except Exception, e:
-                status_item('Generation Result')
-                print e
-                if re.match('.*No such file or directory', str(e)):
-                    status_result('COMMAND NOT FOUND', 3)
+            with self.report.span(archive_dir, 'provision') as counts:
+                counts['bytes'] = container_size_needed
+                if provision_container(container, container_size_needed,
+                                       self.config.provision_strategy,
+                                       self.args.verbose):
                     return 1
             return 0
         else:
             return 1
 
-    def cleanup(self):
-        """ Unmount, remove mount point, unmap, and remove the loopback
-        device associated with the encrypted container. """
-        # Give the rsync time to gracefully terminate.
-        status_item('Cleaning Up')
-        status_result('.', no_newline=True)
-        time.sleep(1)
-        status_result('.', no_newline=True)
-        time.sleep(1)
-        status_result('.')
-        time.sleep(1)
-        if self.archive_mount:
-            umount(self.archive_mount, remove=True)
-        if self.container_file:
-            unmap(self.container_file)
-        if self.lbdevice:
-            loopback_delete(self.lbdevice)
+    def calc_container_size(self, arc_block):
+        """ Given an archive block size, show and return the container size
+        needed to hold it at provision_capacity_percent.  The result is
+        rounded up to the nearest megabyte. """
+        archive_size = int(float(arc_block) /
+                           float(self.config.provision_capacity_percent)
+                           * 100)
+        status_item('Archive Block Size')
+        status_result(str(arc_block) + ' (' + size(arc_block) + ')')
+        status_item('Provision Capacity')
+        status_result(str(archive_size) + ' (' + size(archive_size) + ')')
+        status_item('Required Container Size')
+        # Round to the nearest megabyte.
+        container_size_needed_m = \
+            int(math.ceil(self.calc_archive_container(archive_size)
+                / 1048576))
+
+        status_result(str(container_size_needed_m * 1048576) + ' (' +
+                      str(container_size_needed_m) + 'M)')
+        return container_size_needed_m * 1048576
+
+    def grow_archive(self, job, archive_map, arc_block):
+        """ Grow a mapped and mounted container in place: extend the
+        container file, refresh the loopback device capacity, extend the
+        dm-crypt mapping, and grow the ext4 filesystem online.  Only the
+        added space has to be written and uploaded.  Return 1 if any step
+        fails, in which case the container should be recreated instead, or 0
+        if successful. """
+        container_size = os.path.getsize(job.container)
+        container_size_needed = self.calc_container_size(arc_block)
+        status_item('Grow Container')
+        if container_size_needed <= container_size:
+            status_result('ALREADY ' + size(container_size), 2)
+            return 1
+        status_result(size(container_size) + ' -> ' +
+                      size(container_size_needed))
+        with self.report.span(job.archive_dir, 'provision') as counts:
+            counts['bytes'] = container_size_needed - container_size
+            if provision_container(job.container, container_size_needed,
+                                   self.config.provision_strategy,
+                                   self.args.verbose, offset=container_size):
+                return 1
+            if loopback_capacity(job.lbdevice, self.args.verbose):
+                return 1
+            if mapper_extend(job.container_file, job.lbdevice,
+                             self.args.verbose):
+                return 1
+            if filesystem_grow(archive_map, self.args.verbose):
+                return 1
+        return 0
 
-    def backup(self):
-        for i, s in enumerate(self.config.archive_list):
-            section_break()
+    def consumption(self, job, arc_block):
+        """ Show how full the mounted encrypted filesystem will be once the
+        archive is synchronized.  Return the condition: 1 (green/OK), 2
+        (yellow/WARNING) if at or beyond provision_capacity_reprovision, or
+        None if the filesystem size cannot be probed. """
+        stat = os.statvfs(job.archive_mount)
 
-            archive_dir = self.config.archive_list[i]
-            status_item('Archive')
-            status_result(archive_dir)
+        cryptfs_size = str((stat.f_blocks -
+                           (stat.f_bfree - stat.f_bavail)) * stat.f_frsize)
 
-            self.container_file = self.config.archive_list[i].split('/')[-2] \
-                + '.archive'
+        if not cryptfs_size:
+            status_item('Encrypted Filesystem Size')
+            status_result('PROBE FAILED', 3)
+            return
 
-            self.archive_mount = self.config.mount_dir + self.container_file
-            container = self.config.backup_dir + self.container_file
+        status_item('Anticipated Consumption')
 
-            self.lbdevice = loopback_exists(container)
+        capacity_act = float(arc_block) / float(cryptfs_size) * 100
 
-            if self.args.cleanup:
-                self.cleanup()
-                return 2
+        # capacity_act_condition will be 1 (green/OK) or 2 (yellow/WARNING)
+        if capacity_act < self.config.provision_capacity_reprovision:
+            capacity_act_condition = 1
+        else:
+            capacity_act_condition = 2
+
+        self.report.set(job.archive_dir, 'consumption', capacity_act)
+        status_result(str('%0.2f%%' % capacity_act),
+                      capacity_act_condition, no_newline=True)
+        status_result(str(arc_block) + '/' + cryptfs_size + ' ' +
+                      size(arc_block) + '/' + size(int(cryptfs_size)))
+        return capacity_act_condition
+
+    def confirm(self, item, confirmed=False):
+        """ Ask the user to confirm a potentially destructive action, unless
+        it has already been confirmed on the command line.  Prompts are
+        serialized so that parallel archives do not interleave them.  Return
+        True if the action should proceed. """
+        with self.prompt_lock:
+            if confirmed:
+                status_item('!! ' + item)
+                status_result('CONFIRMED', 4)
+                return True
+            status_item('!! ' + item + '? (y/n)')
+            return raw_input() == 'y'
+
+    def cleanup(self, job=None):
+        """ Unmount, remove mount point, unmap, and remove the loopback
+        device associated with the encrypted container.  If no job is
+        specified, clean up every archive which is currently in flight. """
+        if job:
+            jobs = [job]
+        else:
+            jobs = list(self.jobs)
+        status_item('Cleaning Up')
+        status_result('IN PROGRESS', 2)
+        for job in jobs:
+            with self.report.span(job.archive_dir, 'cleanup'):
+                self.rsync_wait(job)
+                if job.journal:
+                    job.journal.close()
+                    job.journal = None
+                if job.archive_mount:
+                    umount(job.archive_mount, remove=True)
+                if job.container_file:
+                    unmap(job.container_file)
+                if job.lbdevice:
+                    loopback_delete(job.lbdevice)
+
+            # Clean up job variables so there is no chance of accidentally
+            # cleaning up the same archive twice.
+            job.container_file = ''
+            job.archive_mount = ''
+            job.lbdevice = ''
+
+    def rsync_wait(self, job, timeout=10):
+        """ Give a job's rsync processes up to timeout seconds to exit
+        gracefully, for example after a Ctrl-C, before terminating them.
+        The filesystem cannot be released while rsync still holds it. """
+        running = [p for p in job.rsync if p.poll() is None]
+        job.rsync = []
+        if not running:
+            return
+        status_item('Waiting For Rsync')
+        deadline = time.time() + timeout
+        for p in running:
+            process_wait(p, max(0, deadline - time.time()))
+        running = [p for p in running if p.poll() is None]
+        if not running:
+            status_result('EXITED', 4)
+            return
+        status_result('TERMINATING', 2)
+        for p in running:
+            try:
+                p.terminate()
+            except OSError:
+                pass
+        deadline = time.time() + timeout
+        for p in running:
+            if process_wait(p, max(0, deadline - time.time())) is None:
+                status_item('Rsync')
+                status_result('STILL RUNNING', 3)
+                job.rsync.append(p)
+
+    def backup_archive(self, job):
+        """ Back up a single archive.  Return 1 if any problems or 0 for
+        success. """
+        archive_dir = job.archive_dir
+        container = job.container
+
+        section_break()
+        status_item('Archive')
+        status_result(archive_dir)
+
+        shards = config_archive_option(self.config, archive_dir,
+                                       'sync_shards', 1)
+        plan = shards > 1 and shard_plan(archive_dir, shards)
+        dedup = self.dedup and \
+            config_archive_option(self.config, archive_dir, 'dedup', True) \
+            and dedup_plan(self.dedup, archive_dir,
+                           config_archive_option(self.config, archive_dir,
+                                                 'dedup_min_size', 1048576))
+
+        inventoried = [0]
+
+        def observe(entry):
+            inventoried[0] += 1
+            if plan:
+                plan.observe(entry)
+            if dedup:
+                dedup.observe(entry)
+
+        if config_archive_option(self.config, archive_dir, 'journal', False):
+            job.journal = change_journal(self.config.data_dir +
+                                         job.container_file + '.journal',
+                                         archive_dir)
+        with self.report.span(archive_dir, 'inventory') as counts:
+            # Read the tree from watch.py's snapshot if it is running.
+            snapshot = None
+            if os.path.isfile(watch_file(self.config, archive_dir)):
+                snapshot = tree_snapshot(watch_file(self.config, archive_dir))
+            arc_block = dir_size(archive_dir, block_size=512,
+                                 observer=observe,
+                                 every=job.journal and job.journal.observe,
+                                 snapshot=snapshot)
+            if snapshot:
+                snapshot.close()
+            counts['bytes'] = max(arc_block, 0)
+            counts['items'] = inventoried[0]
+        if arc_block == -1:
+            status_item('ARCHIVE READABILITY')
+            status_result('FAILED', 3)
+            return 1
 
-            arc_block = dir_size(archive_dir, block_size=512)
-            if arc_block == -1:
-                status_item('ARCHIVE READABILITY')
-                status_result('FAILED', 3)
+        if dedup:
+            with self.report.span(archive_dir, 'dedup') as counts:
+                within, across = self.dedup.report(archive_dir)
+                saved = dedup.plan()
+                counts['bytes'] = saved
+                counts['items'] = len(dedup.links)
+            status_item('Duplicate Content')
+            status_result(size(within) + ' within archive, ' + size(across) +
+                          ' shared with other archives')
+            status_item('Deduplicated')
+            status_result(str(len(dedup.links)) + ' files, ' + size(saved),
+                          4)
+            logging.getLogger().info(
+                archive_dir + ': duplicate content ' + str(within) +
+                ' bytes within archive, ' + str(across) + ' bytes shared '
+                'with other archives, ' + str(saved) + ' bytes linked')
+            # Linked copies take no room in the container.
+            arc_block -= saved - saved % 512
+
+        status_item('Container')
+        status_result(container)
+        status_item('')
+        if os.path.isfile(container):
+            status_result('FOUND', 1)
+        else:
+            status_result('NOT FOUND', 2)
+            if self.create_archive(archive_dir, container,
+                                   self.config.backup_dir, arc_block):
                 return 1
 
-            status_item('Container')
-            status_result(container)
-            status_item('')
-            if os.path.isfile(container):
-                status_result('FOUND', 1)
-            else:
-                status_result('NOT FOUND', 2)
-                if self.create_archive(self.config.archive_list[i],
-                                       container, self.config.backup_dir,
-                                       arc_block):
-                    return 1
-
-            container_size = os.path.getsize(container)
-            if not container_size:
-                status_item('Container Size')
-                status_result('PROBE FAILED', 3)
-                return 1
+        container_size = os.path.getsize(container)
+        if not container_size:
+            status_item('Container Size')
+            status_result('PROBE FAILED', 3)
+            return 1
 
-            if self.args.verbose:
-                status_item('Archive Size')
-                status_result(str(arc_block) + ' (' + size(arc_block) + ')')
-                status_item('Container Size')
-                status_result(str(container_size) + ' (' +
-                              size(container_size) + ')')
+        if self.args.verbose:
+            status_item('Archive Size')
+            status_result(str(arc_block) + ' (' + size(arc_block) + ')')
+            status_item('Container Size')
+            status_result(str(container_size) + ' (' +
+                          size(container_size) + ')')
 
-            status_item('Estimated Consumption')
-            container_size_net = container_size - \
-                self.calc_container_overhead(container_size)
+        status_item('Estimated Consumption')
+        container_size_net = container_size - \
+            self.calc_container_overhead(container_size)
 
-            capacity_est = float(arc_block) / float(container_size_net) * 100
+        capacity_est = float(arc_block) / float(container_size_net) * 100
 
-            if capacity_est < self.config.provision_capacity_reprovision:
-                capacity_est_condition = 1
-            else:
-                capacity_est_condition = 2
+        if capacity_est < self.config.provision_capacity_reprovision:
+            capacity_est_condition = 1
+        else:
+            capacity_est_condition = 2
 
-            status_result(str('%0.2f%%' % capacity_est),
-                          capacity_est_condition, no_newline=True)
-            status_result(str(arc_block) + '/' + str(container_size_net) + ' '
-                          + size(arc_block) + '/' + size(container_size_net))
+        status_result(str('%0.2f%%' % capacity_est),
+                      capacity_est_condition, no_newline=True)
+        status_result(str(arc_block) + '/' + str(container_size_net) + ' '
+                      + size(arc_block) + '/' + size(container_size_net))
 
-            if capacity_est_condition == 2:
-                status_item('')
-                status_result('OUT OF SPACE', capacity_est_condition)
+        # Set once the user has agreed to reprovision an undersized container.
+        reprovision = False
 
-                if self.args.reprovision:
-                    status_item('!! REPROVISION?')
-                    status_result('CONFIRMED', 4)
+        if capacity_est_condition == 2:
+            status_item('')
+            status_result('OUT OF SPACE', capacity_est_condition)
+
+            if self.confirm('REPROVISION', self.args.reprovision):
+                reprovision = True
+            if reprovision and self.config.provision_grow:
+                # The container can only be grown once it is mounted, and
+                # the actual consumption measured there is authoritative.
+                status_item('Reprovision')
+                status_result('GROW AFTER MOUNT', 4)
+            elif reprovision:
+                self.cleanup(job)
+                job.reset(self.config)
+                if self.create_archive(archive_dir, container,
+                                       self.config.backup_dir, arc_block):
+                    return 1
                 else:
-                    status_item('!! REPROVISION? (y/n)')
+                    status_item('Container Generation')
+                    status_result('SUCCESS', 1)
+            else:
+                status_item('Capacity')
+                status_result('EXCEEDED', 3)
+                return 1
 
-                if self.args.reprovision or raw_input() == 'y':
-                    self.cleanup()
-                    if self.create_archive(self.config.archive_list[i],
-                                           container, self.config.backup_dir,
-                                           arc_block):
-                        return 1
-                    else:
-                        status_item('Container Generation')
-                        status_result('SUCCESS', 1)
-                else:
-                    status_item('Capacity')
-                    status_result('EXCEEDED', 3)
-                    return 1
+        if self.abort_event.is_set():
+            return 1
 
-            if not self.lbdevice:
+        if not job.lbdevice:
+            # Allocating the next free loopback device and binding it are
+            # two separate steps, so only one archive may do this at a time.
+            with self.loopback_lock, \
+                    self.report.span(archive_dir, 'loopback'):
                 loopback_cleanup(container)
-                self.lbdevice = loopback_next()
-                if not self.lbdevice:
+                job.lbdevice = loopback_next()
+                if not job.lbdevice:
                     return 1
-                if loopback_setup(self.lbdevice, container, self.args.verbose):
+                if loopback_setup(job.lbdevice, container, self.args.verbose):
                     return 1
 
-            if loopback_encrypted(self.lbdevice, self.config.password_base,
-                                  self.config.backup_dir, self.container_file,
-                                  self.args.verbose):
-                if self.args.encrypt:
-                    status_item('!! (RE)ENCRYPT CONTAINER')
-                    status_result('CONFIRMED', 4)
-                else:
-                    status_item('!! (RE)ENCRYPT CONTAINER? (y/n)')
+        if self.abort_event.is_set():
+            return 1
 
-                if self.args.encrypt or raw_input() == 'y':
-                    if loopback_encrypt(self.lbdevice,
+        with self.report.span(archive_dir, 'encryption check'):
+            encrypted = loopback_encrypted(
+                job.lbdevice, self.config.password_base,
+                self.config.backup_dir, job.container_file, self.args.verbose)
+        if encrypted:
+            if self.confirm('(RE)ENCRYPT CONTAINER', self.args.encrypt):
+                with self.report.span(archive_dir, 'encrypt'):
+                    if loopback_encrypt(job.lbdevice,
                                         self.config.password_base,
-                                        self.container_file,
+                                        job.container_file,
                                         self.args.verbose):
                         return 1
-                else:
-                    return 1
+            else:
+                return 1
+
+        archive_map = '/dev/mapper/' + job.container_file
 
-            archive_map = '/dev/mapper/' + self.container_file
+        if self.abort_event.is_set():
+            return 1
 
-            if mapper_check(self.lbdevice, archive_map, self.container_file,
+        with self.report.span(archive_dir, 'unlock'):
+            if mapper_check(job.lbdevice, archive_map, job.container_file,
                             self.config.password_base, self.args.verbose):
                 return 1
 
-            if filesystem_check(archive_map):
-                if self.args.format:
-                    status_item('!! (RE)FORMAT FILESYSTEM')
-                    status_result('CONFIRMED', 4)
-                else:
-                    status_item('!! (RE)FORMAT FILESYSTEM? (y/n)')
-                if self.args.format or raw_input() == 'y':
+        with self.report.span(archive_dir, 'e2fsck'):
+            damaged = filesystem_check(archive_map)
+        if damaged:
+            if self.confirm('(RE)FORMAT FILESYSTEM', self.args.format):
+                with self.report.span(archive_dir, 'format'):
                     if filesystem_format(archive_map, self.args.verbose):
                         return 1
-                else:
-                    return 1
+            else:
+                return 1
 
-            if mount_check(archive_map, self.archive_mount,
+        if self.abort_event.is_set():
+            return 1
+
+        with self.report.span(archive_dir, 'mount'):
+            if mount_check(archive_map, job.archive_mount,
                            mountcreate=self.args.mountcreate,
                            verbose=self.args.verbose):
                 return 1
 
-            stat = os.statvfs(self.archive_mount)
-
-            cryptfs_size = str((stat.f_blocks -
-                               (stat.f_bfree - stat.f_bavail)) * stat.f_frsize)
+        capacity_act_condition = self.consumption(job, arc_block)
+        if not capacity_act_condition:
+            return 1
 
-            if not cryptfs_size:
-                status_item('Encrypted Filesystem Size')
-                status_result('PROBE FAILED', 3)
+        if capacity_act_condition == 2:
+            if not reprovision and \
+               not self.confirm('REPROVISION', self.args.reprovision):
+                status_item('Capacity')
+                status_result('EXCEEDED', 3)
                 return 1
 
-            status_item('Anticipated Consumption')
-
-            capacity_act = float(arc_block) / float(cryptfs_size) * 100
-
-            # capacity_act_condition will be 1 (green/OK) or 2 (yellow/WARNING)
-            if capacity_act < self.config.provision_capacity_reprovision:
-                capacity_act_condition = 1
+            if self.config.provision_grow and \
+               not self.grow_archive(job, archive_map, arc_block):
+                status_item('Reprovision')
+                status_result('GROWN', 4)
+                if not self.consumption(job, arc_block):
+                    return 1
             else:
-                capacity_act_condition = 2
-
-            status_result(str('%0.2f%%' % capacity_act),
-                          capacity_act_condition, no_newline=True)
-            status_result(str(arc_block) + '/' + cryptfs_size + ' ' +
-                          size(arc_block) + '/' + size(int(cryptfs_size)))
-
-            if capacity_act_condition == 2:
-                status_item('Reprovision? (y/n)')
-                confirm_reprovision = raw_input()
-                self.cleanup()
-                if self.create_archive(self.config.archive_list[i],
-                                       container, self.config.backup_dir,
-                                       arc_block + self.container_overhead):
+                status_item('Reprovision')
+                status_result('RECREATING CONTAINER', 2)
+                self.cleanup(job)
+                job.reset(self.config)
+                if self.create_archive(archive_dir, container,
+                                       self.config.backup_dir, arc_block):
                     return 1
                 else:
                     status_item('Reprovision')
-                    status_result('SUCCESS BUT NEED TO RESTART AND USE' +
+                    status_result('SUCCESS BUT NEED TO RESTART AND USE ' +
                                   'WITH --nocleanup OPTION', 2)
                     return 1
 
-            if not self.args.skipbackup:
-                if sync(archive_dir, self.archive_mount, self.args.bwlimit):
+        if self.abort_event.is_set():
+            return 1
+
+        if not self.args.skipbackup:
+            def started(process):
+                job.rsync = [p for p in job.rsync if p.poll() is None] + \
+                    [process]
+
+            job.transfer = rsync_progress()
+            controller = config_bandwidth(self.config, archive_dir,
+                                          self.args.bwlimit)
+            compression = compression_options(config_archive_option(
+                self.config, archive_dir, 'compression', 'auto'))
+            options = dedup and dedup.rsync_filter() or []
+            with self.report.span(archive_dir, 'rsync') as counts:
+                delta = self.delta_files(archive_dir, job.archive_mount, dedup)
+                if delta:
+                    # rsync sends local files whole; ask for its delta
+                    # transfer, written in place, where little of a file has
+                    # changed.
+                    status_item('Delta Transfer')
+                    status_result(str(len(delta)) + ' PARTLY CHANGED FILES',
+                                  4)
+                    if sync(archive_dir, job.archive_mount,
+                            self.args.bwlimit, started, job.transfer,
+                            controller, compression, delta,
+                            options + ['--no-whole-file', '--inplace']):
+                        if options:
+                            os.remove(dedup.filter_file)
+                        return 1
+                if self.abort_event.is_set():
+                    if options:
+                        os.remove(dedup.filter_file)
                     return 1
+                full = True
+                if job.journal:
+                    full = job.journal.full_due(config_archive_option(
+                        self.config, archive_dir, 'journal_full_days', 7))
+                    status_item('Change Journal')
+                    if full:
+                        status_result('FULL SYNC DUE', 2)
+                    else:
+                        changed, deleted = job.journal.changes()
+                        status_result(str(len(changed)) + ' CHANGED, ' +
+                                      str(len(deleted)) + ' DELETED', 4)
+                if not full:
+                    if changed or deleted:
+                        rc = sync(archive_dir, job.archive_mount,
+                                  self.args.bwlimit, started, job.transfer,
+                                  controller, compression, changed + deleted,
+                                  options)
+                    else:
+                        job.transfer.finish(0)
+                        rc = 0
+                elif plan:
+                    if controller:
+                        bwlimit = controller.limit()
+                    else:
+                        bwlimit = self.args.bwlimit
+                    shards = plan.plan()
+                    rc = sync_sharded(
+                        archive_dir, job.archive_mount, shards,
+                        self.config.data_dir, bwlimit, started, job.transfer,
+                        compression,
+                        config_archive_option(self.config, archive_dir,
+                                              'sync_shard_retries', 2),
+                        options, plan.split)
+                else:
+                    rc = sync(archive_dir, job.archive_mount,
+                              self.args.bwlimit, started, job.transfer,
+                              controller, compression, options=options)
+                totals = job.transfer.totals()
+                counts['bytes'] = totals['bytes']
+                counts['items'] = totals['transferred']
+            if options:
+                os.remove(dedup.filter_file)
+            if rc or self.abort_event.is_set():
+                return 1
+            if dedup and dedup.links and \
+               job.transfer.returncode in [0, 24]:
+                status_item('Hard Links')
+                with self.report.span(archive_dir, 'hardlink') as counts:
+                    counts['items'] = len(dedup.links)
+                    failed = dedup.link(job.archive_mount)
+                if failed:
+                    status_result(str(failed) + ' FAILED', 2)
+                else:
+                    status_result(str(len(dedup.links)) + ' LINKED', 4)
+            if job.journal and job.transfer.returncode in [0, 24]:
+                # Only a clean sync may become the baseline, or whatever
+                # rsync missed would never be retried.
+                job.journal.commit(full)
 
-            if not self.args.nocleanup:
-                self.cleanup()
+        if not self.args.nocleanup:
+            self.cleanup(job)
 
-            # Clean up global variables so there is no chance of accidentally
-            # using them next time through the loop.
-            self.container_file = ''
-            self.archive_mount = ''
-            self.lbdevice = ''
+        return 0
 
+    def delta_files(self, archive_dir, target, dedup=None):
+        """ Return the large files of an archive, relative to it, which
+        validate.py's chunk index shows were only partly changed when it
+        last rehashed them: the changed byte ranges cover less than the
+        chunk_sync fraction of the file.  Files hard linked by dedup are
+        left out, since writing one in place would change every link.  That
+        includes files linked in the target by an earlier run which have no
+        duplicate any more, so any whose copy under target has more than
+        one link (or cannot be examined) is left to the normal sync. """
+        fraction = config_archive_option(self.config, archive_dir,
+                                         'chunk_sync', 0.25)
+        if not self.config.digest_dir or not fraction:
+            return []
+        store_file = digest_file(self.config, archive_dir)
+        if not os.path.isfile(store_file):
+            return []
+        linked = set()
+        for pair in dedup and dedup.links or []:
+            linked.update(pair)
+        store = digest_store(store_file)
+        try:
+            rows = store.changed_files(config_archive_option(
+                self.config, archive_dir, 'chunk_sync_min_size', 67108864))
+        finally:
+            store.close()
+        root = archive_dir.rstrip('/')
+        base = os.path.join(target.rstrip('/'), os.path.basename(root))
+
+        def unshared(relpath):
+            try:
+                return os.lstat(os.path.join(base, relpath)).st_nlink == 1
+            except OSError, e:
+                # A file rsync has yet to create is safe to write in place.
+                return e.errno == errno.ENOENT
+
+        return sorted([os.path.relpath(path, root)
+                       for path, file_size, changed in rows
+                       if path.startswith(root + '/') and
+                       changed < file_size * fraction and
+                       os.path.relpath(path, root) not in linked and
+                       os.path.isfile(path) and
+                       unshared(os.path.relpath(path, root))])
+
+    def backup_worker(self, job):
+        """ Thread body used by the parallel scheduler.  Its status lines
+        are tagged with the archive's name. """
+        status_prefix('[' + job.archive_dir.split('/')[-2] + '] ')
+        try:
+            job.rc = self.backup_archive(job)
+        except Exception, e:
+            status_item(job.archive_dir)
+            status_result('UNEXPECTED ERROR ' + str(e), 3)
+            job.rc = 1
+        self.report.set(job.archive_dir, 'returncode', job.rc)
+        with self.schedule_cond:
+            self.schedule_cond.notify()
+
+    def job_slots(self, job):
+        """ Return the resources a job occupies while running, each paired
+        with the maximum number of jobs allowed to share it. """
+        return [('device', job.device, self.config.parallel_per_device),
+                ('backup_dir', self.config.backup_dir,
+                 self.config.parallel_per_backup_dir)]
+
+    def backup_parallel(self, jobs):
+        """ Back up several archives at once.  At most parallel_archives run
+        concurrently, further limited by parallel_per_device for archives
+        living on the same source device and parallel_per_backup_dir for
+        containers sharing the backup directory.  Once an archive fails no
+        new archives are started, but those in flight are allowed to
+        finish.  Return 1 if any archive failed or 0 for success. """
+        pending = list(jobs)
+        running = []
+        usage = {}
+        failed = False
+
+        with self.schedule_cond:
+            while True:
+                for job in [j for j in running if j.rc is not None]:
+                    running.remove(job)
+                    for kind, key, limit in self.job_slots(job):
+                        usage[(kind, key)] -= 1
+                    if job.rc:
+                        failed = True
+                    elif job in self.jobs:
+                        self.jobs.remove(job)
+
+                if not running and (failed or not pending):
+                    break
+
+                for job in list(pending):
+                    if failed or \
+                       len(running) >= self.config.parallel_archives:
+                        break
+                    slots = self.job_slots(job)
+                    if [s for s in slots if usage.get(s[:2], 0) >= s[2]]:
+                        continue
+                    for kind, key, limit in slots:
+                        usage[(kind, key)] = usage.get((kind, key), 0) + 1
+                    pending.remove(job)
+                    running.append(job)
+                    self.jobs.append(job)
+                    t = Thread(target=self.backup_worker, args=(job,))
+                    t.daemon = True  # thread dies with the program
+                    t.start()
+                    self.workers.append((t, job))
+
+                # Wait with a timeout so that Ctrl-C is delivered promptly to
+                # the main thread.
+                self.schedule_cond.wait(0.5)
+
+        if failed:
+            return 1
         return 0
 
+    def workers_join(self, timeout=10):
+        """ After a Ctrl-C, wait for the archives being backed up in
+        parallel to notice the abort and return, so that cleanup does not
+        release a mount, map, or loopback device a worker is still setting
+        up or using.  A worker whose rsync has not exited after timeout
+        seconds has it terminated. """
+        for t, job in self.workers:
+            deadline = time.time() + timeout
+            # Join in slices so that another Ctrl-C still gets through.
+            while t.is_alive() and time.time() < deadline:
+                t.join(0.5)
+            if t.is_alive():
+                self.rsync_wait(job, 0)
+            while t.is_alive():
+                t.join(0.5)
+        self.workers = []
+
+    def backup(self):
+        jobs = [archive_job(archive_dir, self.config)
+                for archive_dir in self.config.archive_list]
+
+        if self.args.cleanup:
+            for job in jobs:
+                section_break()
+                status_item('Archive')
+                status_result(job.archive_dir)
+                job.lbdevice = loopback_exists(job.container)
+                self.cleanup(job)
+            return 2
+
+        for job in jobs:
+            job.lbdevice = loopback_exists(job.container)
+
+        if self.config.digest_dir and self.config.dedup:
+            self.dedup_open(jobs)
+
+        if self.config.parallel_archives > 1 and len(jobs) > 1:
+            rc = self.backup_parallel(jobs)
+        else:
+            rc = 0
+            for job in jobs:
+                self.jobs.append(job)
+                rc = self.backup_archive(job)
+                self.report.set(job.archive_dir, 'returncode', rc)
+                if rc:
+                    break
+                self.jobs.remove(job)
+
+        self.transfers = self.transfer_report(jobs)
+        return rc
+
+    def dedup_open(self, jobs):
+        """ Open the content index across archives, and load into it the
+        digests validate.py has recorded for each archive. """
+        self.dedup = dedup_index(self.config.data_dir + 'dedup.db')
+        for job in jobs:
+            with self.report.span(None, 'dedup index') as counts:
+                loaded = self.dedup.refresh(
+                    job.archive_dir, digest_file(self.config,
+                                                 job.archive_dir))
+                counts['items'] = loaded or 0
+            if loaded is not None:
+                logging.getLogger().info(job.archive_dir + ': indexed ' +
+                                         str(loaded) + ' digests')
+
+    def transfer_report(self, jobs):
+        """ Log the rsync totals of every archive which was synchronized and
+        return them keyed by archive. """
+        logger = logging.getLogger()
+        report = {}
+        for job in jobs:
+            if job.transfer:
+                report[job.archive_dir] = job.transfer.totals()
+                self.report.set(job.archive_dir, 'transfer',
+                                report[job.archive_dir])
+                logger.info(job.archive_dir + ': ' + job.transfer.describe())
+        return report
+
+    def report_write(self, rc):
+        """ Show where the time went, write the run report next to the log
+        file, and update the metrics for node_exporter. """
+        totals = self.report.totals()
+        if totals:
+            section_break()
+            for name in sorted(totals, key=lambda n: -totals[n]['seconds']):
+                status_item('Time ' + name.title())
+                status_result('%.1f seconds' % totals[name]['seconds'])
+        if self.report_file:
+            self.report.write(self.report_file, rc)
+        if self.metrics_dir:
+            metrics_write(self.metrics_dir, self.report, rc)
+
     def main(self):
         """ If you call the python as a script, this is what gets executed. """
 
-        # These 3 variables are key to performing safe cleanup.  they do not
-        # need to be populated now, but they need to be declared.  At any point
-        # the user may Ctrl-C out, and we will use these variables to clean up.
-        self.container_file = ''
-        self.lbdevice = ''
-        self.archive_mount = ''
+        # The archives currently in flight are key to performing safe
+        # cleanup.  At any point the user may Ctrl-C out, and we will use them
+        # to clean up.
+        self.jobs = []
+        self.workers = []
+        self.abort_event = Event()
 
         try:
             self.args_process()
@@ -442,11 +930,16 @@ class backup:
             time_init = print_header('BACKUP')
 
             logger.info(self.args.config + ': configuration file loading')
-            self.config = config_read(self.args.config)
+            with self.report.span(None, 'configuration'):
+                self.config = config_read(self.args.config)
 
             if self.config:
                 logger.info(self.args.config + ': validating configuration')
-                if config_validate(self.config, self.args.interactive):
+                with self.report.span(None, 'configuration'):
+                    invalid = config_validate(self.config,
+                                              self.args.interactive,
+                                              self.args.recheck)
+                if invalid:
                     logger.error('configuration file invalid')
                     logger.critical('backup failed')
                 else:
@@ -477,6 +970,12 @@ class backup:
 
                     logger.info('logfile ' + self.config.log_dir +
                                 self.logfile)
+                    self.report_file = os.path.join(
+                        self.config.log_dir,
+                        os.path.splitext(self.logfile)[0] + '.json')
+                    if self.config.metrics_dir and \
+                       not dir_validate(self.config.metrics_dir, write=1):
+                        self.metrics_dir = self.config.metrics_dir
 
                     rc = self.backup()
                     status_item('Backup')
@@ -488,15 +987,19 @@ class backup:
                         status_result('SKIPPED', 2)
                     else:
                         status_result('SUCCESS', 1)
+                    self.report_write(rc)
             print_footer('backup', time_init)
         except KeyboardInterrupt:
+            self.abort_event.set()
             print
             status_item('Backup')
             status_result('ABORT', 3)
+            self.workers_join()
             if not self.args.nocleanup:
                 self.cleanup()
             status_item('Safe Quit')
             status_result('SUCCESS', 1)
+            self.report_write('abort')
             pass
 
 
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+from ArchiveR3 import *
+import argparse
+import hashlib
+import platform
+import resource
+from validate import hash_pool, validate
+
+
+class bench_validate(validate):
+    """ A validate which is set up from the benchmark's options instead of
+    its command line and configuration. """
+
+    def __init__(self, args):
+        self.init_vars()
+        self.args = argparse.Namespace(verbose=False, full=False,
+                                       verify_age=30, verify_limit=0,
+                                       chunk_min=0, chunk_size=1024,
+                                       time_budget=0, byte_budget=0,
+                                       workers=args.workers)
+        self.stale_age = 0
+        self.digests = None
+
+    def generate_hash_legacy(self, file, size=None):
+        """ The read() loop generate_hash() replaced, which allocates a new
+        string for every 64K read, kept to compare it with. """
+        with open(file, 'rb') as afile:
+            BLOCKSIZE = 65536
+            hasher = hashlib.sha1()
+            buf = afile.read(BLOCKSIZE)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = afile.read(BLOCKSIZE)
+        return hasher.hexdigest()
+
+    def status_item(self, item):
+        pass
+
+    def status_result(self, result):
+        pass
+
+
+class benchmark:
+    """ Measure the hot paths of backup.py and validate.py against a
+    synthetic tree, so that a change to them can be shown to make things
+    faster or slower. """
+
+    def __init__(self):
+        self.init_vars()
+
+    def init_vars(self):
+        """ Initialize class variables. """
+        # Benchmarks in the order they are run.  Each takes the tree's root
+        # and returns the files and bytes it processed.
+        self.benchmarks = [('inventory', self.run_inventory),
+                           ('dir_size', self.run_dir_size),
+                           ('generate_hash', self.run_generate_hash),
+                           ('generate_hash_legacy',
+                            self.run_generate_hash_legacy),
+                           ('hash_pool', self.run_hash_pool),
+                           ('validate_index', self.run_validate_index),
+                           ('validate_unchanged',
+                            self.run_validate_unchanged),
+                           ('digest_store', self.run_digest_store)]
+
+    def args_process(self):
+        """ Process command-line arguments. """
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Generate a reproducible synthetic tree and time the '
+            'inventory, hashing, and digest store code paths against it.  '
+            'Each benchmark runs in a process of its own so that its peak '
+            'RSS can be measured, and the fastest of --repeat runs is kept.  '
+            'Results are written as JSON and may be compared with a '
+            'baseline saved earlier, in which case any benchmark slower than '
+            'the baseline by more than --tolerance is reported as a '
+            'regression.')
+        parser.add_argument('benchmarks', nargs='*',
+                            help='Benchmarks to run (default: all of ' +
+                            ', '.join([b[0] for b in self.benchmarks]) + ')')
+        parser.add_argument('--tree', default=tempfile.gettempdir() +
+                            '/ArchiveR3-benchmark',
+                            help='Directory to generate the tree in.  A tree '
+                            'generated earlier with the same parameters is '
+                            'reused.')
+        parser.add_argument('--files', type=int, default=5000,
+                            help='Number of regular files.')
+        parser.add_argument('--fanout', type=int, default=8,
+                            help='Subdirectories per directory.')
+        parser.add_argument('--depth', type=int, default=3,
+                            help='Levels of subdirectories.')
+        parser.add_argument('--median-size', dest='median_size', type=int,
+                            default=16384,
+                            help='Median file size in bytes.  Sizes are '
+                            'log-normally distributed around it.')
+        parser.add_argument('--size-sigma', dest='size_sigma', type=float,
+                            default=2.0,
+                            help='Spread of the size distribution; 0 makes '
+                            'every file the median size.')
+        parser.add_argument('--max-size', dest='max_size', type=int,
+                            default=268435456,
+                            help='Largest file size in bytes.')
+        parser.add_argument('--hardlinks', type=float, default=0.0,
+                            help='Fraction of the files which are additional '
+                            'hard links to another file.  validate.py '
+                            'refuses hard links, so the validate benchmarks '
+                            'are skipped when this is not 0.')
+        parser.add_argument('--symlinks', type=float, default=0.02,
+                            help='Symlinks to create, as a fraction of the '
+                            'files.')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Seed for the tree layout and contents.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs of each benchmark.')
+        parser.add_argument('--cold', action='store_true',
+                            help='Drop the tree from the page cache before '
+                            'each run, so that the disk is measured rather '
+                            'than memory.')
+        parser.add_argument('-j', dest='workers', type=int, default=4,
+                            help='Hashing workers for the hash_pool and '
+                            'validate benchmarks.')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='File to write the results to.')
+        parser.add_argument('--baseline',
+                            help='Results from an earlier run to compare '
+                            'with.')
+        parser.add_argument('--tolerance', type=float, default=10,
+                            help='Percent by which a benchmark may be slower '
+                            'than the baseline before it is reported as a '
+                            'regression.')
+        self.args = parser.parse_args()
+        for name in self.args.benchmarks:
+            if name not in dict(self.benchmarks):
+                parser.error('unknown benchmark: ' + name)
+
+    def tree_params(self):
+        """ Return the parameters which determine the tree's contents. """
+        return dict((k, getattr(self.args, k)) for k in
+                    ('files', 'fanout', 'depth', 'median_size', 'size_sigma',
+                     'max_size', 'hardlinks', 'symlinks', 'seed'))
+
+    def tree_generate(self):
+        """ Generate the synthetic tree under --tree, unless the one there
+        was generated with the same parameters.  Return the tree's root. """
+        params = self.tree_params()
+        root = normalize_dir(self.args.tree) + 'tree/'
+        manifest = normalize_dir(self.args.tree) + 'tree.json'
+        status_item('Tree')
+        if os.path.isfile(manifest) and \
+           json.load(open(manifest)) == params:
+            status_result('REUSED ' + root, 1)
+            return root
+        if os.path.isdir(root):
+            subprocess.check_call(['rm', '-rf', root])
+        os.makedirs(root)
+        if os.path.isfile(manifest):
+            os.remove(manifest)
+
+        generator = random.Random(self.args.seed)
+        dirs = [root]
+        level = [root]
+        for depth in range(self.args.depth):
+            level = [parent + 'd%d/' % i for parent in level
+                     for i in range(self.args.fanout)]
+            dirs.extend(level)
+        for d in dirs[1:]:
+            os.mkdir(d)
+
+        # Contents are slices of one pseudo-random block: incompressible,
+        # reproducible, and cheap to write.
+        block = ''.join([chr(generator.getrandbits(8))
+                         for i in range(1048576)])
+        links = int(self.args.files * self.args.hardlinks)
+        files = []
+        total = 0
+        for n in range(self.args.files - links):
+            path = generator.choice(dirs) + 'f%d' % n
+            file_size = min(self.args.max_size, int(generator.lognormvariate(
+                math.log(self.args.median_size), self.args.size_sigma)))
+            offset = generator.randrange(len(block))
+            with open(path, 'wb') as f:
+                written = 0
+                while written < file_size:
+                    chunk = (block[offset:] + block[:offset])[
+                        :file_size - written]
+                    f.write(chunk)
+                    written += len(chunk)
+            files.append(path)
+            total += file_size
+        for n in range(links):
+            os.link(generator.choice(files),
+                    generator.choice(dirs) + 'h%d' % n)
+        for n in range(int(self.args.files * self.args.symlinks)):
+            os.symlink(os.path.relpath(generator.choice(files + dirs[1:]),
+                                       root),
+                       generator.choice(dirs) + 's%d' % n)
+        json.dump(params, open(manifest, 'w'))
+        status_result('GENERATED ' + str(len(files)) + ' files, ' +
+                      str(links) + ' hard links, ' + size(total), 1)
+        return root
+
+    def files(self, root):
+        """ Return the regular files of the tree, with their sizes. """
+        return [(e.path, e.size) for e in inventory(root) if e.type == 'file']
+
+    def run_inventory(self, root):
+        count = 0
+        total = 0
+        for entry in inventory(root):
+            count += 1
+            total += entry.size
+        return count, total
+
+    def run_dir_size(self, root):
+        count = [0]
+
+        def observer(entry):
+            count[0] += 1
+        total = dir_size(root, observer=observer)
+        return count[0], total
+
+    def run_generate_hash(self, root):
+        hasher = bench_validate(self.args)
+        files = self.files(root)
+        for path, file_size in files:
+            hasher.generate_hash(path, file_size)
+        return len(files), sum([f[1] for f in files])
+
+    def run_generate_hash_legacy(self, root):
+        hasher = bench_validate(self.args)
+        files = self.files(root)
+        for path, file_size in files:
+            hasher.generate_hash_legacy(path, file_size)
+        return len(files), sum([f[1] for f in files])
+
+    def run_hash_pool(self, root):
+        hasher = bench_validate(self.args)
+        files = self.files(root)
+        pool = hash_pool(hasher.generate_hash, self.args.workers)
+        for path, file_size in files:
+            pool.submit(path, file_size, lambda hash, error=None: None)
+        pool.close()
+        return len(files), sum([f[1] for f in files])
+
+    def validate_run(self, root, store_dir):
+        """ Validate the tree the way validate_archive() does, without the
+        reporting. """
+        v = bench_validate(self.args)
+        v.totalsize_block = v.totalsize = v.totalfiles = v.totaldirs = 0
+        v.totalentries = v.totalhashed = v.totalunchanged = 0
+        v.totalmismatch = v.totaldeferred = v.totalbytes_hashed = 0
+        v.totalchunked = v.totalchunk_bytes = 0
+        v.totalcandidates = 0
+        v.verify_budget = 0
+        v.digests = digest_store(store_dir + 'benchmark.db')
+        v.hashes = hash_pool(v.generate_hash, self.args.workers)
+        for entry in inventory(root):
+            v.validate_entry(entry, 'benchmark')
+        v.validate_candidates('benchmark')
+        v.hashes.close()
+        v.digests.close()
+        return v.totalfiles, v.totalbytes_hashed
+
+    def run_validate_index(self, root):
+        store_dir = tempfile.mkdtemp(prefix='ArchiveR3-benchmark-')
+        try:
+            return self.validate_run(root, store_dir + '/')
+        finally:
+            subprocess.call(['rm', '-rf', store_dir])
+
+    def run_validate_unchanged(self, root):
+        store_dir = tempfile.mkdtemp(prefix='ArchiveR3-benchmark-')
+        try:
+            # Index untimed, then time the run which finds nothing changed.
+            # Only the bytes actually hashed count, so its throughput is in
+            # files per second.
+            self.validate_run(root, store_dir + '/')
+            self.time_start = time.time()
+            return self.validate_run(root, store_dir + '/')
+        finally:
+            subprocess.call(['rm', '-rf', store_dir])
+
+    def run_digest_store(self, root):
+        store_dir = tempfile.mkdtemp(prefix='ArchiveR3-benchmark-')
+        try:
+            entries = list(inventory(root))
+            self.time_start = time.time()
+            store = digest_store(store_dir + '/benchmark.db')
+            for entry in entries:
+                store.put(entry.path, {'type': entry.type,
+                                       'hash': '0' * 40,
+                                       'mode': entry.mode,
+                                       'mtime': entry.mtime,
+                                       'size': entry.size,
+                                       'uid': entry.uid,
+                                       'gid': entry.gid,
+                                       'checked': time.time(),
+                                       'ino': entry.ino,
+                                       'ctime': entry.ctime})
+            store.close()
+            store = digest_store(store_dir + '/benchmark.db')
+            for entry in entries:
+                store.get(entry.path)
+            store.close()
+            return len(entries), os.path.getsize(store_dir + '/benchmark.db')
+        finally:
+            subprocess.call(['rm', '-rf', store_dir])
+
+    def drop_cache(self, root):
+        """ Ask the kernel to drop the tree's pages from the page cache.
+        Unlike writing to /proc/sys/vm/drop_caches this needs no root. """
+        for path, file_size in self.files(root):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+    def measure(self, name, run, root):
+        """ Run a benchmark once in a child process.  Return its wall time,
+        files, bytes, and peak RSS in KB. """
+        if self.args.cold:
+            self.drop_cache(root)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            # The code under test reports its progress; keep it quiet.
+            sys.stdout = open(os.devnull, 'w')
+            result = {}
+            try:
+                self.time_start = time.time()
+                count, total = run(root)
+                result = {'seconds': time.time() - self.time_start,
+                          'files': count, 'bytes': total,
+                          'peak_rss_kb': resource.getrusage(
+                              resource.RUSAGE_SELF).ru_maxrss}
+            except Exception, e:
+                result = {'error': repr(e)}
+            os.write(write_fd, json.dumps(result))
+            os._exit(0)
+        os.close(write_fd)
+        output = ''
+        data = os.read(read_fd, 65536)
+        while data:
+            output += data
+            data = os.read(read_fd, 65536)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        result = output and json.loads(output) or \
+            {'error': 'benchmark process died'}
+        if 'error' in result:
+            raise RuntimeError(name + ': ' + result['error'])
+        return result
+
+    def run(self, root):
+        """ Run the selected benchmarks.  Return their results, keeping the
+        fastest run of each and the highest peak RSS. """
+        results = {}
+        for name, run in self.benchmarks:
+            if self.args.benchmarks and name not in self.args.benchmarks:
+                continue
+            status_item(name)
+            if self.args.hardlinks and name.startswith('validate'):
+                status_result('SKIPPED (hard links)', 2)
+                continue
+            runs = [self.measure(name, run, root)
+                    for i in range(self.args.repeat)]
+            best = min(runs, key=lambda r: r['seconds'])
+            best['peak_rss_kb'] = max([r['peak_rss_kb'] for r in runs])
+            best['runs'] = [r['seconds'] for r in runs]
+            seconds = max(best['seconds'], 1e-6)
+            best['files_per_second'] = best['files'] / seconds
+            best['mb_per_second'] = best['bytes'] / 1048576.0 / seconds
+            results[name] = best
+            status_result('%.3fs, %.0f files/s, %.1f MB/s, %s peak RSS' %
+                          (best['seconds'], best['files_per_second'],
+                           best['mb_per_second'],
+                           size(best['peak_rss_kb'] * 1024)))
+        return results
+
+    def compare(self, results, baseline):
+        """ Report how each benchmark compares with the baseline.  Return
+        the number of regressions. """
+        regressions = 0
+        section_break()
+        if baseline['tree'] != self.tree_params():
+            status_item('Baseline')
+            status_result('DIFFERENT TREE, TIMES ARE NOT COMPARABLE', 2)
+        for name, run in self.benchmarks:
+            if name not in results or name not in baseline['results']:
+                continue
+            before = baseline['results'][name]['seconds']
+            after = results[name]['seconds']
+            change = (after - before) / max(before, 1e-6) * 100
+            status_item(name)
+            if change > self.args.tolerance:
+                regressions += 1
+                status_result('%+.1f%% REGRESSION' % change, 3)
+            elif change < -self.args.tolerance:
+                status_result('%+.1f%% FASTER' % change, 1)
+            else:
+                status_result('%+.1f%%' % change)
+        return regressions
+
+    def main(self):
+        """ If you call the python as a script, this is what gets executed. """
+        self.args_process()
+        time_init = time.time()
+
+        root = self.tree_generate()
+        section_break()
+        results = self.run(root)
+        report = {'tree': self.tree_params(),
+                  'repeat': self.args.repeat,
+                  'cold': self.args.cold,
+                  'workers': self.args.workers,
+                  'host': platform.node(),
+                  'python': platform.python_version(),
+                  'numpy': numpy is not None,
+                  'time': time_init,
+                  'results': results}
+        with open(self.args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        status_item('Results')
+        status_result(self.args.output)
+
+        if self.args.baseline:
+            if self.compare(results, json.load(open(self.args.baseline))):
+                return 1
+        return 0
+
+
+if __name__ == '__main__':
+    sys.stdout = Unbuffered(sys.stdout)
+
+    benchmark = benchmark()
+    sys.exit(benchmark.main())
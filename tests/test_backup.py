@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import ConfigParser
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import ArchiveR3
+import backup
+
+
+class delta_files_test(unittest.TestCase):
+    """ Files picked for the in-place delta transfer. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ArchiveR3-test-')
+        self.archive_dir = self.dir + '/archive/'
+        self.target = self.dir + '/mount/'
+        os.makedirs(self.archive_dir + 'd')
+        os.makedirs(self.target + 'archive/d')
+        os.makedirs(self.dir + '/digest')
+        with open(self.archive_dir + 'd/big', 'wb') as f:
+            f.write('x' * 1000)
+        with open(self.target + 'archive/d/big', 'wb') as f:
+            f.write('y' * 1000)
+
+        # validate.py found a small part of the file changed.
+        store = ArchiveR3.digest_store(self.dir + '/digest/archive.db')
+        store.put(self.archive_dir + 'd/big',
+                  {'type': 'file', 'hash': 'cdc:0', 'size': 1000})
+        store.chunks_put(self.archive_dir + 'd/big', [[0, 1000, '0', '0']],
+                         [[0, 10]])
+        store.close()
+
+        config = ConfigParser.RawConfigParser()
+        config.add_section('ArchiveR3')
+        config.set('ArchiveR3', 'chunk_sync_min_size', '500')
+        config.digest_dir = self.dir + '/digest/'
+        self.backup = backup.backup()
+        self.backup.config = config
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_partly_changed(self):
+        self.assertEqual(self.backup.delta_files(self.archive_dir,
+                                                 self.target), ['d/big'])
+
+    def test_linked_this_run(self):
+        class plan:
+            links = [('d/big', 'd/copy')]
+        self.assertEqual(self.backup.delta_files(self.archive_dir,
+                                                 self.target, plan()), [])
+
+    def test_linked_earlier_run(self):
+        # An earlier run linked the copy in the container; its duplicate
+        # has since changed, so this run plans no link for it.
+        os.link(self.target + 'archive/d/big', self.target + 'archive/d/copy')
+        self.assertEqual(self.backup.delta_files(self.archive_dir,
+                                                 self.target), [])
+        os.remove(self.target + 'archive/d/copy')
+        self.assertEqual(self.backup.delta_files(self.archive_dir,
+                                                 self.target), ['d/big'])
+
+    def test_not_yet_in_target(self):
+        os.remove(self.target + 'archive/d/big')
+        self.assertEqual(self.backup.delta_files(self.archive_dir,
+                                                 self.target), ['d/big'])
+
+
+if __name__ == '__main__':
+    unittest.main()
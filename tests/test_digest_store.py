@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import ArchiveR3
+
+
+class candidates_test(unittest.TestCase):
+    """ Stale files streamed from the digest store, oldest first. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ArchiveR3-test-')
+        self.store = ArchiveR3.digest_store(self.dir + '/archive.db', batch=2)
+        for path, checked in (('/a/old', 100), ('/a/older', 50),
+                              ('/a/mid', 200), ('/a/new', 300),
+                              ('/a/tie', 100)):
+            self.store.put(path, {'type': 'file', 'hash': 'h', 'size': 1,
+                                  'checked': checked})
+        # Imported from a pickle before check times were kept.
+        self.store.put('/a/unchecked', {'type': 'file', 'hash': 'h',
+                                        'size': 1})
+        self.store.commit()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def entry(self, path):
+        return ArchiveR3.inventory_entry(path, 'file', 1, 0100644, 0, 0, 0,
+                                         0, 1, 0, 0)
+
+    def test_order(self):
+        for path in ('/a/mid', '/a/unknown', '/a/older', '/a/unchecked',
+                     '/a/tie', '/a/old', '/a/new'):
+            self.store.candidate_put(self.entry(path))
+        seen = []
+        for entry, record in self.store.candidates(time.time()):
+            seen.append(entry.path)
+            if entry.path == '/a/unknown':
+                self.assertEqual(record, None)
+            else:
+                self.assertEqual(record['hash'], 'h')
+            # Validating a file puts its record back, checked now.
+            self.store.put(entry.path, {'type': 'file', 'hash': 'h',
+                                        'size': 1, 'checked': time.time()})
+            self.store.commit()
+        self.assertEqual(seen, ['/a/unchecked', '/a/unknown', '/a/older',
+                                '/a/old', '/a/tie', '/a/mid', '/a/new'])
+        self.assertEqual(list(self.store.candidates(time.time())), [])
+
+    def test_only_candidates(self):
+        self.store.candidate_put(self.entry('/a/mid'))
+        self.assertEqual([e.path for e, r in
+                          self.store.candidates(time.time())], ['/a/mid'])
+
+
+if __name__ == '__main__':
+    unittest.main()
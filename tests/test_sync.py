@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import ArchiveR3
+
+
+def which(program):
+    for dir in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(dir, program), os.X_OK):
+            return os.path.join(dir, program)
+
+
+class rsync_test(unittest.TestCase):
+    """ An archive and an empty target, with rsync run without sudo. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ArchiveR3-test-')
+        self.archive_dir = self.dir + '/archive/'
+        self.target = self.dir + '/mount/'
+        os.makedirs(self.archive_dir + 'sub/deeper')
+        os.makedirs(self.target)
+        for name in ('keep', 'sub/a', 'sub/deeper/b'):
+            with open(self.archive_dir + name, 'w') as f:
+                f.write(name)
+        # rsync is run through sudo; run it directly instead.
+        os.makedirs(self.dir + '/bin')
+        self.script('sudo', 'exec "$@"')
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.dir + '/bin' + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir)
+
+    def script(self, name, body):
+        with open(self.dir + '/bin/' + name, 'w') as f:
+            f.write('#!/bin/sh\n' + body + '\n')
+        os.chmod(self.dir + '/bin/' + name, 0755)
+
+
+class sync_test(rsync_test):
+    """ The outcome sync() reports for rsync's exit status. """
+
+    def test_failed(self):
+        # 23 is a partial transfer due to an error.
+        self.script('rsync', 'exit 23')
+        self.assertEqual(ArchiveR3.sync(self.archive_dir, self.target, 0,
+                                        compression=[]), 1)
+
+    def test_vanished(self):
+        # 24 is files vanishing while they were read.
+        self.script('rsync', 'exit 24')
+        self.assertEqual(ArchiveR3.sync(self.archive_dir, self.target, 0,
+                                        compression=[]), 0)
+
+
+class journal_sync_test(rsync_test):
+    """ Syncing only the entries a change journal reports. """
+
+    def journal_changes(self, journal):
+        ArchiveR3.dir_size(self.archive_dir, every=journal.observe)
+        return journal.changes()
+
+    def test_force(self):
+        self.script('rsync', 'printf "%s\\n" "$@" > ' + self.dir + '/args')
+        ArchiveR3.sync(self.archive_dir, self.target, 0, compression=[],
+                       files=['sub'])
+        args = open(self.dir + '/args').read().split('\n')
+        self.assertTrue('--delete-missing-args' in args)
+        self.assertTrue('--force' in args)
+
+    @unittest.skipUnless(which('rsync'), 'rsync is not installed')
+    def test_deleted_directory(self):
+        journal = ArchiveR3.change_journal(self.dir + '/journal',
+                                           self.archive_dir)
+        self.journal_changes(journal)
+        self.assertEqual(ArchiveR3.sync(self.archive_dir, self.target, 0,
+                                        compression=[]), 0)
+        journal.commit(True)
+        self.assertTrue(os.path.isfile(self.target + 'archive/sub/deeper/b'))
+
+        shutil.rmtree(self.archive_dir + 'sub')
+        changed, deleted = self.journal_changes(journal)
+        self.assertEqual(changed, [])
+        self.assertEqual(ArchiveR3.sync(self.archive_dir, self.target, 0,
+                                        compression=[],
+                                        files=changed + deleted), 0)
+        journal.close()
+        self.assertFalse(os.path.exists(self.target + 'archive/sub'))
+        self.assertTrue(os.path.isfile(self.target + 'archive/keep'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import ArchiveR3
+import backup
+import validate
+
+
+class validate_test(unittest.TestCase):
+    """ validate.py run on an archive named in a config file. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ArchiveR3-test-')
+        self.archive_dir = self.dir + '/home/archive/'
+        os.makedirs(self.archive_dir + 'sub')
+        for name in ('a', 'sub/b'):
+            with open(self.archive_dir + name, 'w') as f:
+                f.write(name)
+        self.config = self.dir + '/config'
+        with open(self.config, 'w') as f:
+            f.write('[ArchiveR3]\n'
+                    'backup_dir: ' + self.dir + '/backup/\n'
+                    'mount_dir: ' + self.dir + '/mnt\n'
+                    'archives:\n'
+                    '    ' + self.archive_dir + '\n'
+                    'data_dir: ' + self.dir + '/data/\n'
+                    'log_dir: ' + self.dir + '/logs/\n'
+                    'password_base: password\n'
+                    'stale_age: 86400\n'
+                    'provision_capacity_percent: 75\n'
+                    'provision_capacity_reprovision: 95\n'
+                    'digest_dir: ' + self.dir + '/digest/\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_validate(self, *args):
+        """ Run validate.py as if from the command line, returning its
+        output. """
+        argv, stdout = sys.argv, sys.stdout
+        handlers = list(logging.getLogger().handlers)
+        sys.argv = ['validate.py', self.config] + list(args)
+        sys.stdout = StringIO.StringIO()
+        try:
+            v = validate.validate()
+            self.rc = v.main()
+            return v, sys.stdout.getvalue()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+            logging.getLogger().handlers = handlers
+
+    def test_archive(self):
+        v, output = self.run_validate('archive', '-j', '2')
+        self.assertEqual(v.totalhashed, 2)
+        self.assertEqual(v.report.archives['archive']['returncode'], 0)
+        self.assertTrue(os.path.isfile(self.dir + '/digest/archive.db'))
+        self.assertEqual(self.rc, 0)
+
+        # Nothing is stale on the second run.
+        v, output = self.run_validate('all', '-j', '2')
+        self.assertEqual(v.totalhashed, 0)
+        self.assertEqual(v.totalfiles, 2)
+
+    def test_remote_differs(self):
+        remote = self.dir + '/mnt/archive.archive/archive/'
+        os.makedirs(remote)
+        shutil.copy(self.archive_dir + 'a', remote)
+        v, output = self.run_validate('archive', '-j', '2', '--remote',
+                                      self.dir + '/mnt')
+        self.assertEqual(v.verify_counts['MISSING'], 2)
+        self.assertEqual(v.report.archives['archive']['returncode'], 1)
+        self.assertEqual(self.rc, 1)
+
+    def test_store_read_by_backup(self):
+        self.run_validate('archive', '-j', '2')
+        os.makedirs(self.dir + '/data')
+        b = backup.backup()
+        b.config = ArchiveR3.config_read(self.config)
+        b.dedup_open([backup.archive_job(self.archive_dir, b.config)])
+        self.assertEqual(b.report.totals()['dedup index']['items'], 2)
+        b.dedup.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
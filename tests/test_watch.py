@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import ArchiveR3
+
+
+class tree_watcher_test(unittest.TestCase):
+    """ The snapshot a tree_watcher keeps of an archive. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ArchiveR3-test-')
+        self.root = self.dir + '/archive'
+        os.makedirs(self.root + '/sub')
+        self.snapshot = ArchiveR3.tree_snapshot(self.dir + '/watch')
+        self.watcher = ArchiveR3.tree_watcher(self.root, self.snapshot)
+        self.watcher.rescan()
+
+    def tearDown(self):
+        os.close(self.watcher.fd)
+        self.snapshot.close()
+        shutil.rmtree(self.dir)
+
+    def entries(self):
+        return dict((e.path, e) for e in self.snapshot.entries(self.root))
+
+    def test_relisted_directory(self):
+        before = self.entries()[self.root + '/sub']
+        # Make sure the directory's mtime visibly changes.
+        time.sleep(0.01)
+        open(self.root + '/sub/new', 'w').close()
+        self.assertTrue(self.watcher.apply(self.watcher.events()))
+
+        entries = self.entries()
+        self.assertTrue(self.root + '/sub/new' in entries)
+        self.assertEqual(entries[self.root + '/sub'],
+                         ArchiveR3.inventory_record(
+                             self.root + '/sub',
+                             os.lstat(self.root + '/sub')))
+        self.assertNotEqual(entries[self.root + '/sub'].mtime, before.mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,51 +5,135 @@
 
 import ArchiveR3
 import argparse
+from collections import deque
 import datetime
 import hashlib
+import io
+import logging
+import multiprocessing
 import os
 import pickle
 # TODO: Convert SHA-1 (insecure) to SHA3
 # import sha3
 from signal import signal, SIGPIPE, SIG_DFL
 import sys
+from threading import Event, Thread, local
 import time
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue  # python 3.x
+
+
+class hash_pool:
+    """ Hash files concurrently on a bounded set of worker threads.  Reading
+    and hashing both release the GIL, so threads are sufficient to keep
+    several streams in flight.
+
+    Files are split into two lanes by size, each with its own workers, so
+    that a few huge files cannot starve a swarm of small ones (and vice
+    versa).  Small files are latency bound and get many workers, large files
+    are throughput bound and get few.  Completed hashes are handed back to
+    the caller's callback on the calling thread, in submission order within
+    each lane, so digest updates never race one another. """
+
+    def __init__(self, hasher, workers=4, large=16 * 1024 * 1024,
+                 backlog=1024):
+        self.hasher = hasher
+        self.large = large
+        self.backlog = backlog
+        self.lanes = {}
+        for lane, count in ((False, workers),
+                            (True, max(1, workers // 4))):
+            self.lanes[lane] = (Queue(), deque(), count)
+            for i in range(count):
+                t = Thread(target=self.worker, args=(self.lanes[lane][0],))
+                t.daemon = True  # thread dies with the program
+                t.start()
+
+    def worker(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            try:
+                job['hash'] = (job['hasher'] or self.hasher)(job['path'],
+                                                            job['size'])
+            except Exception, e:
+                job['error'] = e
+            job['done'].set()
+
+    def submit(self, path, size, callback, hasher=None):
+        """ Queue a file for hashing.  callback(hash) is invoked once the
+        hash is available, or callback(None, error) if hashing failed.
+        hasher, if given, is used for this file instead of the pool's. """
+        queue, pending, count = self.lanes[size >= self.large]
+        job = {'path': path, 'size': size, 'hash': None, 'error': None,
+               'hasher': hasher, 'done': Event()}
+        pending.append((job, callback))
+        queue.put(job)
+        self.drain(pending, len(pending) > self.backlog)
+        self.drain(self.lanes[size < self.large][1])
+
+    def drain(self, pending, block=False):
+        """ Deliver finished hashes at the head of a lane.  If block is
+        set, wait for at least the head of the lane to finish. """
+        while pending and (block or pending[0][0]['done'].is_set()):
+            job, callback = pending.popleft()
+            # Wait with a timeout so that Ctrl-C is delivered promptly.
+            while not job['done'].wait(0.5):
+                pass
+            if job['error'] is not None:
+                callback(None, job['error'])
+            else:
+                callback(job['hash'])
+            block = False
+
+    def close(self):
+        """ Wait for every outstanding hash to be delivered, then stop the
+        workers. """
+        for queue, pending, count in self.lanes.values():
+            while pending:
+                self.drain(pending, True)
+            for i in range(count):
+                queue.put(None)
 
 
 class validate:
     """ Verify a backup has integrity by comparing local files against remote
     ones.  The calculation and comparison of SHA-1 hashes is the primary
     method used for comparison, but other factors are used as well such as:
-    ctime, mtime, owner, and permissions.  A pickle is stored with telemetry
-    data for both local and remote filestores.
+    ctime, mtime, owner, and permissions.  A SQLite digest store is kept with
+    telemetry data for both local and remote filestores.
     
     Note: it is OK to Ctrl-C out of this program and not worry about losing
-    data.  However, piping it to anything else (like more, less, tee) and then
-    breaking the pipe will cause the program to exit without updating the
-    pickle file.  However, the original pickle file from before this program
-    ran will still have integrity."""
+    data.  Updates are committed to the digest store in batches as the walk
+    progresses, so piping it to anything else (like more, less, tee) and then
+    breaking the pipe only loses the current batch.  Digest pickles written
+    by earlier versions are imported into the store once, automatically."""
 
     def __init__(self):
         signal(SIGPIPE, SIG_DFL)
-        self.ArchiveR3 = ArchiveR3.ArchiveR3()
-        self.ArchiveR3.config_read()
         self.init_vars()
 
     def init_vars(self):
         """ initialize class variables """
-#       self.logdir = '/home/r3cgm/digest/log/'
-#       self.pickledir = '/home/r3cgm/digest/pickle/'
-#       self.pickle_snapshot = self.pickledir + 'snapshot.p'
-#       self.sourcedir = '/mnt/nas/r3cgm/'
-        # in seconds
-#       self.stale_age = 60 * 60 * 24
+        # the rest are set from the configuration file by config_load()
+        self.config = None
+        # archive name (the last component of its directory) -> directory
+        self.archive_dirs = {}
+        self.snapshot = {}
         self.time_init = time.time()
+        # per-phase timings, written out if --report-dir is given
+        self.report = ArchiveR3.run_report('validate')
+        # per-thread read buffer reused by generate_hash()
+        self.hash_buffers = local()
 
     def abort(self, message, archive):
         print
         self.status_item('ABORT')
         self.status_result(message)
-        self.pickle_close(archive)
+        self.digests_close(archive)
         sys.exit(1)
 
     def status_item(self, item):
@@ -70,10 +154,76 @@ class validate:
             'up the validation process.  For example, this tool can '
             'preferentially validate the files whose previously known state '
             'is the oldest.')
+        parser.add_argument('config', action='store',
+            help='Specify an ArchiveR3 config file.  Digest stores are kept '
+            'in its digest_dir.')
         parser.add_argument('archives', action='store',
-            help='Specify a specific archive to validate, or \'all\' to '
-            'process every archive listed in the ARCHIVES environment '
-            'variable. (currently: ' + os.environ.get('ARCHIVES') + ')')
+            help='Specify a specific archive to validate, by the last '
+            'component of its directory, or \'all\' to process every '
+            'archive listed in the config file.')
+        parser.add_argument('--full', action='store_true',
+            help='Rehash every stale file.  By default a stale file whose '
+            'size, mtime, inode, and ctime match its digest is considered '
+            'unchanged and only its contents are re-verified according to '
+            '--verify-age and --verify-limit.')
+        parser.add_argument('--verify-age', dest='verify_age', type=float,
+            default=30,
+            help='Days after which the contents of an unchanged file are '
+            're-verified.')
+        parser.add_argument('--verify-limit', dest='verify_limit',
+            type=float, default=10,
+            help='Maximum GB of unchanged files whose contents are '
+            're-verified per run.')
+        parser.add_argument('--time-budget', dest='time_budget',
+            type=float, default=0,
+            help='Stop validating stale files after this many minutes.  The '
+            'files whose state is the oldest are validated first, so '
+            'successive runs rotate through the whole archive.  A value of 0 '
+            'means no limit.')
+        parser.add_argument('--byte-budget', dest='byte_budget',
+            type=float, default=0,
+            help='Stop validating stale files after hashing this many GB.  A '
+            'value of 0 means no limit.')
+        parser.add_argument('--remote', metavar='MOUNT_DIR',
+            help='After validating, verify the backup mounted under '
+            'MOUNT_DIR (i.e. MOUNT_DIR/<archive>.archive/<archive>) against '
+            'the local archive.  Both trees are walked concurrently and only '
+            'remote files are hashed; local hashes come from the digest '
+            'store.  Missing, extra, and mismatched files are reported as '
+            'they are found.')
+        parser.add_argument('--watch-dir', dest='watch_dir',
+            metavar='DATA_DIR',
+            help='Data directory of a running watch.py.  If it is watching '
+            'the archive, the inventory is read from its snapshot instead '
+            'of walking the archive.')
+        parser.add_argument('--chunk-min', dest='chunk_min', type=float,
+            default=0,
+            help='Index files of at least this many MB in content-defined '
+            'chunks.  When such a file changes, only the chunks whose '
+            'contents changed are rehashed, and the byte ranges they cover '
+            'are reported and recorded for backup.py.  Verifying the remote '
+            'copy of the file then only reads those ranges, unless --full '
+            'is given.  A value of 0 disables chunking.')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+            default=1024,
+            help='Average chunk size in KB.  Changing it reindexes every '
+            'chunked file in full.')
+        parser.add_argument('--report-dir', dest='report_dir',
+            metavar='LOG_DIR',
+            help='Write a JSON run report with the time spent in each phase '
+            'to LOG_DIR/ArchiveR3-validate-<timestamp>.json, for example '
+            'next to the logs of backup.py.')
+        parser.add_argument('--metrics-dir', dest='metrics_dir',
+            metavar='TEXTFILE_DIR',
+            help='Write Prometheus metrics for the run, such as the digest '
+            'count and the files hashed, unchanged, and mismatched, to '
+            'TEXTFILE_DIR/archiver3_validate.prom for node_exporter\'s '
+            'textfile collector.')
+        parser.add_argument('-j', dest='workers', type=int,
+            default=multiprocessing.cpu_count() * 2,
+            help='Number of files to hash concurrently.  A quarter as many '
+            'workers are dedicated to large files so that they do not starve '
+            'small ones.')
         parser.add_argument('-v', dest='verbose', action='store_true',
             help='Print the status of each file as it is being processed.  '
             'Otherwise, a progress dot is printed for every 100 files '
@@ -83,67 +233,205 @@ class validate:
             sys.exit(1)
         self.args = parser.parse_args()
 
+    def config_load(self):
+        """ Read the configuration file named on the command line.  Return 1
+        if it cannot be used or 0 if successful. """
+        self.config = ArchiveR3.config_read(self.args.config)
+        if not self.config:
+            return 1
+        if not self.config.digest_dir:
+            logging.getLogger().error(self.args.config +
+                                      ': digest_dir is not set')
+            return 1
+        if ArchiveR3.dir_validate(self.config.digest_dir, auto=1, create=1,
+                                  write=1):
+            return 1
+        self.pickle_snapshot = self.config.digest_dir + 'snapshot.p'
+        self.stale_age = self.config.stale_age
+        for archive_dir in self.config.archives.split():
+            archive_dir = ArchiveR3.normalize_dir(archive_dir)
+            self.archive_dirs[archive_dir.split('/')[-2]] = archive_dir
+        return 0
+
     def get_archives(self):
         """ determine which archives to work with """
         archives = []
         if self.args.archives == 'all':
-            archives = os.environ.get('ARCHIVES').split(' ')
+            archives = [archive_dir.split('/')[-2] for archive_dir in
+                        self.config.archives.split()]
         else:
             archives.append(self.args.archives)
         return archives
 
-    def generate_hash(self, file):
+    def hash_blocksize(self, size):
+        """ Pick a read size suited to a file: small files are read in a
+        single call, larger ones in blocks of up to 4M, which keeps
+        sequential throughput high without holding much memory per
+        worker. """
+        blocksize = 65536
+        while blocksize < size and blocksize < 4194304:
+            blocksize *= 2
+        return blocksize
+
+    def generate_hash(self, file, size=None, readahead=False):
         """ generate a fingerprint for a file used for comparison.  currently
         uses SHA-1 but should be modified to use SHA-3 in the future; maybe
-        when the sha3 python lib is installed by default. """
-        with open(file, 'rb') as afile:
-            BLOCKSIZE = 65536
-            hasher = hashlib.sha1()
-            buf = afile.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = afile.read(BLOCKSIZE)
+        when the sha3 python lib is installed by default.
+
+        Each hashing thread reads into a single reused buffer rather than
+        allocating a new string per read, and the kernel is told the file is
+        read once sequentially so that its pages are dropped from the page
+        cache behind us instead of evicting everything else.
+
+        With readahead, the kernel is asked to start fetching the next
+        blocks before the current one is hashed.  On a dm-crypt mount this
+        overlaps decryption with hashing. """
+        if size is None:
+            size = os.stat(file).st_size
+        blocksize = self.hash_blocksize(size)
+        buffers = self.hash_buffers
+        if len(getattr(buffers, 'view', '')) < blocksize:
+            buffers.view = memoryview(bytearray(blocksize))
+        view = buffers.view[:blocksize]
+
+        hasher = hashlib.sha1()
+        with io.open(file, 'rb', buffering=0) as afile:
+            fd = afile.fileno()
+            ArchiveR3.fadvise(fd, 0, 0, ArchiveR3.POSIX_FADV_SEQUENTIAL)
+            offset = 0
+            dropped = 0
+            count = afile.readinto(view)
+            while count:
+                if readahead:
+                    ArchiveR3.fadvise(fd, offset + count, blocksize * 4,
+                                      ArchiveR3.POSIX_FADV_WILLNEED)
+                hasher.update(view[:count])
+                offset += count
+                # Drop what we have read every 64M, and at the end.
+                if offset - dropped >= 67108864:
+                    ArchiveR3.fadvise(fd, dropped, offset - dropped,
+                                      ArchiveR3.POSIX_FADV_DONTNEED)
+                    dropped = offset
+                count = afile.readinto(view)
+            ArchiveR3.fadvise(fd, dropped, 0, ArchiveR3.POSIX_FADV_DONTNEED)
         return hasher.hexdigest()
 
+    def generate_chunks(self, file, size=None, previous=None, reuse=True):
+        """ Fingerprint a file chunk by chunk.  Return a dict of its chunks,
+        as [offset, length, check, hash], the byte ranges of those which
+        are not in the previous index, and the number of bytes rehashed.
+
+        Every byte still has to be read to find the chunk boundaries, but
+        with reuse, a chunk whose length and check match a previous one
+        takes its SHA-1 from the index instead of being hashed again. """
+        known = {}
+        for offset, length, check, digest in previous or []:
+            known[(length, check)] = digest
+        cdc = ArchiveR3.chunker(self.args.chunk_size * 1024)
+        chunks = []
+        changed = []
+        rehashed = [0]
+
+        def close(data):
+            check = ArchiveR3.chunk_check(data)
+            digest = reuse and known.get((len(data), check))
+            if not digest:
+                digest = hashlib.sha1(data).hexdigest()
+                rehashed[0] += len(data)
+            offset = chunks and chunks[-1][0] + chunks[-1][1] or 0
+            chunks.append([offset, len(data), check, digest])
+            if known.get((len(data), check)) != digest:
+                changed.append(chunks[-1])
+
+        with io.open(file, 'rb') as afile:
+            fd = afile.fileno()
+            ArchiveR3.fadvise(fd, 0, 0, ArchiveR3.POSIX_FADV_SEQUENTIAL)
+            pending = []
+            data = afile.read(4194304)
+            while data:
+                position = cdc.position
+                last = 0
+                for cut in cdc.feed(data):
+                    pending.append(data[last:cut - position])
+                    last = cut - position
+                    close(''.join(pending))
+                    pending = []
+                pending.append(data[last:])
+                ArchiveR3.fadvise(fd, position, len(data),
+                                  ArchiveR3.POSIX_FADV_DONTNEED)
+                data = afile.read(4194304)
+            if ''.join(pending):
+                close(''.join(pending))
+        return {'chunks': chunks, 'ranges': ArchiveR3.chunk_ranges(changed),
+                'rehashed': rehashed[0]}
+
+    def chunk_root(self, chunks):
+        """ The digest recorded for a file indexed in chunks: the SHA-1 of
+        its chunk hashes, marked so that it is never compared with the
+        SHA-1 of the whole file. """
+        return 'cdc:' + hashlib.sha1(''.join([c[3] for c in chunks])
+                                     ).hexdigest()
+
+    def verify_chunks(self, file, chunks):
+        """ Hash the given chunks of a file.  Return the byte ranges of
+        those whose contents do not match. """
+        bad = []
+        with io.open(file, 'rb') as afile:
+            for chunk in chunks:
+                afile.seek(chunk[0])
+                if hashlib.sha1(afile.read(chunk[1])).hexdigest() != \
+                   chunk[3]:
+                    bad.append(chunk)
+        return ArchiveR3.chunk_ranges(bad)
+
+    def describe_ranges(self, ranges):
+        return ', '.join(['%d-%d' % (r[0], r[0] + r[1]) for r in ranges[:4]]
+                         ) + (len(ranges) > 4 and ', ...' or '')
+
     def snapshot_open(self):
         """ open the snapshot pickle """
         if os.path.exists(self.pickle_snapshot):
             self.snapshot = pickle.load(open(self.pickle_snapshot, 'rb'))
-            status_item('snapshot pickle')
-            status_result('opened')
+            self.status_item('snapshot pickle')
+            self.status_result('opened')
             print self.snapshot
 
     def snapshot_update(self, archive):
         """ update the snapshot to indicate we just successfully scanned an
         archive. """
-        status_item('snapshot ' + archive)
+        self.status_item('snapshot ' + archive)
         self.snapshot[archive] = time.time()
-        status_result(time.time())
+        self.status_result(time.time())
 
     def snapshot_close(self):
         pickle.dump(self.snapshot, open(self.pickle_snapshot, 'wb'))
 
 
-    def pickle_open(self, archive):
-        """ open an existing pickle and load it into self.digests.  if the
-        pickle does not exist, it will be created automatically by
-        pickle_close() """
-        if os.path.exists(self.pickledir + archive + '.p'):
-            self.digests = pickle.load(open(self.pickledir + archive + '.p',
-                'rb'))
-            self.status_item('pickle keys')
-            self.status_result(str(len(self.digests.keys())))
-        else:
-            self.status_item('pickle creation')
-            self.status_result('pending')
-
-    def pickle_close(self, archive):
-        """ overwrite an existing pickle or create a new one """
-        self.status_item('pickle')
-        pickle.dump(self.digests, open(self.pickledir + archive + '.p', 'wb'))
+    def digests_open(self, archive):
+        """ open the digest store for an archive into self.digests, creating
+        it if necessary.  an existing pickle from earlier versions is
+        imported the first time. """
+        self.digests = ArchiveR3.digest_store(ArchiveR3.digest_file(
+            self.config, self.archive_dirs[archive]))
+        if os.path.exists(self.config.digest_dir + archive + '.p'):
+            imported = self.digests.import_pickle(self.config.digest_dir +
+                                                  archive + '.p')
+            if imported is not None:
+                self.status_item('pickle imported')
+                self.status_result(str(imported))
+        self.status_item('digest keys')
+        self.status_result(str(self.digests.count()))
+
+    def digests_close(self, archive):
+        """ commit outstanding updates and close the digest store """
+        self.status_item('digests')
+        self.digests.commit()
+        keys = self.digests.count()
+        self.digests.close()
+        self.report.set(archive, 'digests', keys)
         self.status_result('closed')
-        self.status_item('pickle keys')
-        self.status_result(str(len(self.digests)))
+        self.status_item('digest keys')
+        self.status_result(str(keys))
         self.summary()
 
     def summary(self):
@@ -166,108 +454,276 @@ class validate:
         self.status_item('entries')
         self.status_result(str(self.totalentries))
 
+        self.status_item('hashed')
+        self.status_result(str(self.totalhashed))
+
+        if self.totalchunked:
+            self.status_item('chunked')
+            self.status_result(str(self.totalchunked) + ' files, ' +
+                               '%.1f' % (float(self.totalchunk_bytes) /
+                                         1024 / 1024) + 'M rehashed')
+
+        self.status_item('unchanged')
+        self.status_result(str(self.totalunchanged))
+
+        self.status_item('content mismatches')
+        self.status_result(str(self.totalmismatch))
+
+        self.status_item('deferred')
+        self.status_result(str(self.totaldeferred))
+
     def file_blocksize(self, size):
         blocksize = 512
         size = size - (size % blocksize) + blocksize
         return size
 
-    def validate_dir(self, dirpath, archive):
+    def validate_dir(self, entry, archive):
+        dirpath = entry.path
         if self.args.verbose is True:
             sys.stdout.write(dirpath)
         else:
             if self.totalentries % 100 == 0:
                 sys.stdout.write('.')
 
-        if not os.path.exists(dirpath):
-            print 'ERROR: ' + dirpath + ' found during os.walk() but the ' + \
-                  'exists() check failed.'
-            sys.exit(1)
-
-        if dirpath in self.digests \
-            and 'checked' in self.digests[dirpath] \
-            and self.digests[dirpath]['checked'] \
-                > time.time() - self.stale_age:
+        record = self.digests.get(dirpath)
+        if self.fresh(record):
             if self.args.verbose is True:
                 print ' SKIPPING'
             self.totalsize_block += self.file_blocksize(0)
         else:
             if self.args.verbose is True:
-                if dirpath not in self.digests:
+                if record is None:
                     print ' INDEXING'
-                elif 'checked' not in self.digests[dirpath]:
+                elif 'checked' not in record:
                     print ' REINDEXING (missing check time)'
-                elif self.digests[dirpath]['checked'] \
-                    > time.time() - self.stale_age:
+                else:
                     print ' REINDEXING (stale)'
-            self.digests.setdefault(dirpath, {})['type'] = 'dir'
-            self.digests.setdefault(dirpath, {})['size'] = 0
-            self.digests.setdefault(dirpath, {})['checked'] = time.time()
+            self.digests.put(dirpath, {'type': 'dir',
+                                       'size': 0,
+                                       'checked': time.time()})
             self.totalsize_block += self.file_blocksize(0)
 
         self.totaldirs += 1
         self.totalentries += 1
 
-    def validate_file(self, filepath, archive):
+    def fresh(self, record):
+        """ Determine whether a digest was checked recently enough to be
+        trusted without looking at the file again. """
+        return record is not None \
+            and 'checked' in record \
+            and record['checked'] > time.time() - self.stale_age
+
+    def validate_file(self, entry, archive, record):
+        """ Fingerprint a file if its digest is stale.  The entry is an
+        ArchiveR3 inventory record, so everything but the hash itself is
+        already known without touching the file again.  record is the
+        file's current digest, or None if it has never been seen. """
+        filepath = entry.path
         if self.args.verbose is True:
             sys.stdout.write(filepath)
         else:
             if self.totalentries % 100 == 0:
                 sys.stdout.write('.')
 
-        if not os.path.exists(filepath):
-            print 'ERROR: ' + filepath + ' found during os.walk() but the ' + \
-                  'exists() check failed.'
-            sys.exit(1)
-
-        if filepath in self.digests \
-            and 'checked' in self.digests[filepath] \
-            and self.digests[filepath]['checked'] \
-                > time.time() - self.stale_age:
+        if self.fresh(record):
             if self.args.verbose is True:
                 print ' SKIPPING'
-            self.totalsize += self.digests[filepath]['size']
-            self.totalsize_block += \
-                self.file_blocksize(self.digests[filepath]['size'])
+            self.totalsize += record['size']
+            self.totalsize_block += self.file_blocksize(record['size'])
         else:
+            if entry.nlink > 1:
+                self.abort('more than 1 hard link found for file. '
+                           'investigate: ' + filepath, archive)
+
+            unchanged = not self.args.full \
+                and self.signature_match(record, entry) \
+                and not self.verify_due(record, entry)
+
             if self.args.verbose is True:
-                if filepath not in self.digests:
+                if record is None:
                     print ' INDEXING'
-                elif 'checked' not in self.digests[filepath]:
+                elif unchanged:
+                    print ' UNCHANGED'
+                elif 'checked' not in record:
                     print ' REINDEXING (missing check time)'
-                elif self.digests[filepath]['checked'] \
-                    > time.time() - self.stale_age:
+                else:
                     print ' REINDEXING (stale)'
 
-            hash = self.generate_hash(filepath)
-            size = os.stat(filepath).st_size
-
-            if os.stat(filepath).st_nlink > 1:
-                abort('more than 1 hard link found for file. investigate: ' + \
-                    filepath, archive)
-
-            self.digests.setdefault(filepath, {})['type'] = 'file'
-            self.digests.setdefault(filepath, {})['hash'] = hash
-            self.digests.setdefault(filepath, {})['mode'] = \
-                os.stat(filepath).st_mode
-            self.digests.setdefault(filepath, {})['mtime'] = \
-                os.stat(filepath).st_mtime
-            self.digests.setdefault(filepath, {})['size'] = \
-                os.stat(filepath).st_size
-            self.digests.setdefault(filepath, {})['uid'] = \
-                os.stat(filepath).st_uid
-            self.digests.setdefault(filepath, {})['gid'] = \
-                os.stat(filepath).st_gid
-            self.digests.setdefault(filepath, {})['checked'] = time.time()
-
-            self.totalsize += size
-            self.totalsize_block += self.file_blocksize(size)
+            if unchanged:
+                record['checked'] = time.time()
+                record['mode'] = entry.mode
+                record['uid'] = entry.uid
+                record['gid'] = entry.gid
+                self.digests.put(filepath, record)
+                self.totalunchanged += 1
+                self.totalsize += entry.size
+                self.totalsize_block += self.file_blocksize(entry.size)
+            elif self.args.chunk_min and \
+                    entry.size >= self.args.chunk_min * 1024 * 1024:
+                # The index is read here since the store is not shared with
+                # the hashing threads.  Chunks are only reused for a file
+                # which changed; re-verification rehashes it all.
+                index = self.digests.chunks_get(filepath)
+                previous = index and index[0]
+                reuse = not self.args.full and \
+                    not self.signature_match(record, entry)
+                self.totalbytes_hashed += entry.size
+                self.hashes.submit(filepath, entry.size,
+                    lambda result, error=None:
+                        self.record_chunks(entry, archive, result, error,
+                                           record),
+                    lambda path, size:
+                        self.generate_chunks(path, size, previous, reuse))
+            else:
+                self.totalbytes_hashed += entry.size
+                self.hashes.submit(filepath, entry.size,
+                    lambda hash, error=None:
+                        self.record_file(entry, archive, hash, error,
+                                         record))
 
         self.totalfiles += 1
         self.totalentries += 1
 
+    def signature_match(self, record, entry):
+        """ Determine whether a file looks unchanged since its digest was
+        recorded, judging only by its stat signature. """
+        if record is None or 'hash' not in record:
+            return False
+        for key in ('size', 'mtime', 'ino', 'ctime'):
+            if record.get(key) != getattr(entry, key):
+                return False
+        return True
+
+    def verify_due(self, record, entry):
+        """ Decide whether to re-verify the contents of an unchanged file.
+        Contents are re-verified once they are older than --verify-age, but
+        only while this run's --verify-limit budget lasts. """
+        if record.get('verified', 0) > \
+                time.time() - self.args.verify_age * 86400:
+            return False
+        if entry.size > self.verify_budget:
+            return False
+        self.verify_budget -= entry.size
+        return True
+
+    def record_file(self, entry, archive, hash, error=None, record=None):
+        """ Store a freshly generated fingerprint.  Called by the hash pool
+        on the main thread once the hash of entry is available.  record is
+        the previous digest, if any, used to detect files whose contents
+        changed even though their stat signature did not. """
+        filepath = entry.path
+        if error is not None:
+            self.abort('could not hash ' + filepath + ': ' + str(error),
+                       archive)
+
+        # A digest of the other kind cannot be compared.
+        if self.signature_match(record, entry) and record['hash'] != hash \
+                and not record['hash'].startswith('cdc:'):
+            print
+            self.status_item('CONTENT MISMATCH')
+            self.status_result(filepath)
+            self.totalmismatch += 1
+
+        self.record_put(entry, hash)
+        if record is not None and record.get('hash', '').startswith('cdc:'):
+            self.digests.chunks_put(filepath, None, None)
+
+    def record_chunks(self, entry, archive, result, error=None, record=None):
+        """ Store a freshly built chunk index, as record_file() does for a
+        plain fingerprint.  The byte ranges found to have changed are
+        reported, and kept with the index for backup.py and for
+        verification. """
+        filepath = entry.path
+        if error is not None:
+            self.abort('could not hash ' + filepath + ': ' + str(error),
+                       archive)
+
+        hash = self.chunk_root(result['chunks'])
+        if self.signature_match(record, entry) and record['hash'] != hash \
+                and record['hash'].startswith('cdc:'):
+            print
+            self.status_item('CONTENT MISMATCH')
+            self.status_result(filepath + ' (' +
+                               self.describe_ranges(result['ranges']) + ')')
+            self.totalmismatch += 1
+        elif self.args.verbose is True and record is not None:
+            self.status_item('changed ranges')
+            self.status_result(filepath + ' (' + (self.describe_ranges(
+                result['ranges']) or 'none') + ')')
+
+        self.record_put(entry, hash)
+        self.digests.chunks_put(filepath, result['chunks'], result['ranges'])
+        self.totalchunked += 1
+        self.totalchunk_bytes += result['rehashed']
+
+    def record_put(self, entry, hash):
+        """ Store the digest of a file which was just hashed. """
+        filepath = entry.path
+        self.digests.put(filepath, {'type': 'file',
+                                    'hash': hash,
+                                    'mode': entry.mode,
+                                    'mtime': entry.mtime,
+                                    'size': entry.size,
+                                    'uid': entry.uid,
+                                    'gid': entry.gid,
+                                    'checked': time.time(),
+                                    'ino': entry.ino,
+                                    'ctime': entry.ctime,
+                                    'verified': time.time()})
+
+        self.totalhashed += 1
+        self.totalsize += entry.size
+        self.totalsize_block += self.file_blocksize(entry.size)
+
+    def validate_entry(self, entry, archive):
+        """ Dispatch a single inventory record.  Symlinks are followed, as
+        os.stat() used to do, and dangling ones are ignored. """
+        if entry.type == 'link':
+            entry = ArchiveR3.inventory_resolve(entry)
+            if entry is None:
+                return
+        if entry.type == 'dir':
+            self.validate_dir(entry, archive)
+            return
+        record = self.digests.get(entry.path)
+        if self.fresh(record):
+            self.validate_file(entry, archive, record)
+        else:
+            self.digests.candidate_put(entry)
+            self.totalcandidates += 1
+
+    def budget_exhausted(self):
+        """ Determine whether this run has used up its --time-budget or
+        --byte-budget. """
+        if self.args.time_budget and \
+           time.time() - self.time_init > self.args.time_budget * 60:
+            return True
+        if self.args.byte_budget and self.totalbytes_hashed > \
+           self.args.byte_budget * 1024 * 1024 * 1024:
+            return True
+        return False
+
+    def validate_candidates(self, archive):
+        """ Validate the stale files found during the inventory, those whose
+        state is the oldest (or unknown) first, until the budget runs out.
+        Files that do not fit are left untouched, so their digests remain
+        the oldest and they are first in line on the next run; over a number
+        of runs this rotates through the whole archive. """
+        deferred = False
+        for entry, record in self.digests.candidates(self.time_init):
+            if deferred or self.budget_exhausted():
+                deferred = True
+                self.totaldeferred += 1
+                self.totalfiles += 1
+                self.totalentries += 1
+                self.totalsize += entry.size
+                self.totalsize_block += self.file_blocksize(entry.size)
+                continue
+            self.validate_file(entry, archive, record)
+
     def validate_archive(self, archive):
         self.status_item('location')
-        self.status_result(self.sourcedir + archive)
+        self.status_result(self.archive_dirs[archive])
 
         # total size of entries based on consumed block size
         self.totalsize_block = 0
@@ -276,56 +732,283 @@ class validate:
         self.totalfiles = 0
         self.totaldirs = 0
         self.totalentries = 0
-
-        self.digests = {}
-        self.pickle_open(archive)
+        self.totalhashed = 0
+        self.totalchunked = 0
+        self.totalchunk_bytes = 0
+        self.totalunchanged = 0
+        self.totalmismatch = 0
+        self.totaldeferred = 0
+        self.totalbytes_hashed = 0
+
+        # stale files found by the inventory, set aside in the digest store
+        # and validated oldest first
+        self.totalcandidates = 0
+
+        # bytes of unchanged files whose contents may still be re-verified
+        self.verify_budget = int(self.args.verify_limit * 1024 * 1024 * 1024)
+
+        self.digests_open(archive)
+
+        self.hashes = hash_pool(self.generate_hash, self.args.workers)
+
+        snapshot = None
+        if self.args.watch_dir:
+            file = self.args.watch_dir.rstrip('/') + '/' + archive + \
+                '.archive.watch'
+            if os.path.isfile(file):
+                snapshot = ArchiveR3.tree_snapshot(file)
+                if not snapshot.valid():
+                    snapshot.close()
+                    snapshot = None
 
         try:
             self.status_item('inventory local')
-            for root, dirs, files in os.walk(self.sourcedir + archive, \
-                topdown=True):
+            if snapshot:
+                sys.stdout.write('(from watcher) ')
+            with self.report.span(archive, 'inventory') as counts:
+                for entry in ArchiveR3.inventory(self.archive_dirs[archive],
+                                                 snapshot=snapshot):
+                    try:
+                        self.validate_entry(entry, archive)
+                    except KeyboardInterrupt:
+                        self.abort('file processing', archive)
+                counts['items'] = self.totalentries + self.totalcandidates
+            with self.report.span(archive, 'hash') as counts:
                 try:
-                    for dir in dirs:
-                        try:
-                            dirpath = os.path.join(root, dir)
-                            self.validate_dir(dirpath, archive)
-                        except KeyboardInterrupt:
-                            self.abort('directory processing', archive)
-                    for file in files:
-                        try:
-                            filepath = os.path.join(root, file)
-                            self.validate_file(filepath, archive)
-                        except KeyboardInterrupt:
-                            self.abort('file processing', archive)
+                    self.validate_candidates(archive)
                 except KeyboardInterrupt:
-                    self.abort('recursive directory traversal', archive)
+                    self.abort('file processing', archive)
+                self.hashes.close()
+                counts['bytes'] = self.totalbytes_hashed
+                counts['items'] = self.totalhashed
             print
         except KeyboardInterrupt:
             self.abort('archive directory processing', archive)
         else:
-            self.pickle_close(archive)
+            if snapshot:
+                snapshot.close()
+            with self.report.span(archive, 'commit'):
+                self.digests_close(archive)
+            for key in ('totalfiles', 'totalhashed', 'totalunchanged',
+                        'totalmismatch', 'totaldeferred', 'totalchunked'):
+                self.report.set(archive, key[5:], getattr(self, key))
+            self.report.set(archive, 'returncode', int(self.totalmismatch > 0))
             self.snapshot_update(archive)
             self.snapshot_close()
 
+    def verify_report(self, kind, relpath, detail=''):
+        """ Report a single difference between the local and remote trees as
+        soon as it is found. """
+        if kind not in self.verify_counts:
+            self.verify_counts[kind] = 0
+        self.verify_counts[kind] += 1
+        if detail:
+            detail = ' (' + detail + ')'
+        self.status_item(kind)
+        self.status_result(relpath + detail)
+
+    def verify_file(self, relpath, local, remote):
+        """ Compare a file present in both trees.  Cheap metadata checks
+        come first; the remote contents are then hashed and compared with
+        the digest recorded for the local file. """
+        if local.size != remote.size:
+            self.verify_report('MISMATCH', relpath, 'size')
+            return
+        if int(local.mtime) != int(remote.mtime):
+            self.verify_report('MISMATCH', relpath, 'mtime')
+            return
+
+        record = self.digests.get(local.path)
+        if self.signature_match(record, local) and \
+                record['hash'].startswith('cdc:'):
+            self.verify_chunked(relpath, local, remote, record)
+            return
+        if self.signature_match(record, local):
+            local_hash = record['hash']
+        else:
+            # No trustworthy cached digest, so the local side has to be
+            # hashed as well.
+            local_hash = self.generate_hash(local.path, local.size)
+
+        def compare(hash, error=None):
+            if error is not None:
+                self.verify_report('UNREADABLE', relpath, str(error))
+            elif hash != local_hash:
+                self.verify_report('MISMATCH', relpath, 'content')
+            else:
+                self.verify_counts['verified'] += 1
+
+        self.remote_hashes.submit(remote.path, remote.size, compare)
+
+    def verify_chunked(self, relpath, local, remote, record):
+        """ Compare a file indexed in chunks.  Unless --full is given, only
+        the byte ranges which changed when the index was last built are
+        read from the remote file; otherwise the remote file is chunked in
+        full and compared by its chunk root. """
+        chunks, ranges = self.digests.chunks_get(local.path) or (None, None)
+        if chunks and ranges and not self.args.full:
+            # Ranges are runs of whole chunks, so each starts a chunk.
+            starts = dict((r[0], r[0] + r[1]) for r in ranges)
+            changed = []
+            end = 0
+            for chunk in chunks:
+                end = max(end, starts.get(chunk[0], 0))
+                if chunk[0] < end:
+                    changed.append(chunk)
+
+            def compare(bad, error=None):
+                if error is not None:
+                    self.verify_report('UNREADABLE', relpath, str(error))
+                elif bad:
+                    self.verify_report('MISMATCH', relpath, 'content at ' +
+                                       self.describe_ranges(bad))
+                else:
+                    self.verify_counts['verified'] += 1
+
+            self.remote_hashes.submit(remote.path, remote.size, compare,
+                lambda path, size: self.verify_chunks(path, changed))
+            return
+
+        def compare(result, error=None):
+            if error is not None:
+                self.verify_report('UNREADABLE', relpath, str(error))
+            elif self.chunk_root(result['chunks']) != record['hash']:
+                self.verify_report('MISMATCH', relpath, 'content at ' +
+                                   self.describe_ranges(result['ranges']))
+            else:
+                self.verify_counts['verified'] += 1
+
+        self.remote_hashes.submit(remote.path, remote.size, compare,
+            lambda path, size: self.generate_chunks(path, size, chunks,
+                                                    False))
+
+    def verify_archive(self, archive):
+        """ Compare the local archive with what rsync wrote into the mounted
+        container. """
+        local_root = self.archive_dirs[archive].rstrip('/')
+        remote_root = ArchiveR3.normalize_dir(self.args.remote) + \
+            archive.rstrip('/') + '.archive/' + \
+            os.path.basename(local_root)
+
+        self.status_item('remote')
+        self.status_result(remote_root)
+        if not os.path.isdir(remote_root):
+            self.status_item('ABORT')
+            self.status_result('remote archive not mounted')
+            return 1
+
+        self.digests_open(archive)
+        self.verify_counts = {'verified': 0}
+        self.remote_hashes = hash_pool(
+            lambda path, size: self.generate_hash(path, size, True),
+            self.args.workers)
+
+        # Walk the remote tree on its own thread while the local tree is
+        # walked here.
+        remote = {}
+
+        def walk_remote():
+            for entry in ArchiveR3.inventory(remote_root):
+                remote[entry.path[len(remote_root):]] = entry
+
+        t = Thread(target=walk_remote)
+        t.daemon = True  # thread dies with the program
+        t.start()
+
+        try:
+            self.status_item('inventory')
+            local = {}
+            with self.report.span(archive, 'verify inventory') as counts:
+                for entry in ArchiveR3.inventory(local_root):
+                    local[entry.path[len(local_root):]] = entry
+                while t.is_alive():
+                    t.join(0.5)
+                counts['items'] = len(local) + len(remote)
+            self.status_result(str(len(local)) + ' local, ' +
+                               str(len(remote)) + ' remote')
+            with self.report.span(archive, 'verify') as counts:
+                for relpath in sorted(local):
+                    entry = local[relpath]
+                    other = remote.pop(relpath, None)
+                    if other is None:
+                        self.verify_report('MISSING', relpath)
+                    elif entry.type != other.type:
+                        self.verify_report('MISMATCH', relpath, 'type')
+                    elif entry.type == 'link':
+                        if os.readlink(entry.path) != \
+                           os.readlink(other.path):
+                            self.verify_report('MISMATCH', relpath, 'link')
+                    elif entry.type == 'file':
+                        self.verify_file(relpath, entry, other)
+                for relpath in sorted(remote):
+                    self.verify_report('EXTRA', relpath)
+                self.remote_hashes.close()
+                counts['items'] = len(local)
+        except KeyboardInterrupt:
+            self.abort('remote verification', archive)
+
+        self.digests.close()
+        self.report.set(archive, 'verify', self.verify_counts)
+        for kind in sorted(self.verify_counts):
+            self.status_item(kind.lower())
+            self.status_result(str(self.verify_counts[kind]))
+        if len(self.verify_counts) > 1:
+            return 1
+
     def validate(self):
+        """ Validate the archives, verifying the backup of each if --remote
+        is given.  Return 1 if any archive failed or differs from its backup
+        or 0 if successful. """
+        self.snapshot_open()
         for archive in self.get_archives():
             self.status_item('processing')
             self.status_result(archive)
+            if archive not in self.archive_dirs:
+                self.status_item('ABORT')
+                self.status_result('archive not in ' + self.args.config)
+                return 1
             self.validate_archive(archive)
+            if self.args.remote and self.verify_archive(archive):
+                self.report.set(archive, 'returncode', 1)
             # only do the first archive
             break
+        rc = max([0] + [a.get('returncode', 0)
+                        for a in self.report.archives.values()])
+        if self.args.metrics_dir:
+            ArchiveR3.metrics_write(
+                ArchiveR3.normalize_dir(self.args.metrics_dir), self.report,
+                rc)
+        if self.args.report_dir:
+            self.report.write(ArchiveR3.normalize_dir(self.args.report_dir) +
+                              'ArchiveR3-validate-' +
+                              time.strftime("%Y%m%d-%H%M%S",
+                                            time.localtime(self.time_init)) +
+                              '.json', rc)
+        return rc
 
     def main(self):
-        """ If you call the python as a script, this is what gets executed """
+        """ If you call the python as a script, this is what gets executed.
+        Return the exit status. """
         self.args_process()
-        self.print_header()
-        self.validate()
-        self.print_footer()
+
+        logger = logging.getLogger()
+        logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s '
+                                               '%(message)s'))
+        logger.addHandler(handler)
+
+        self.time_init = ArchiveR3.print_header('VALIDATE')
+        if self.config_load():
+            return 1
+        rc = self.validate()
+        ArchiveR3.print_footer('validate', self.time_init)
+        return rc
 
 
 if __name__ == '__main__':
 #   try:
         validate = validate()
-        validate.main()
+        sys.exit(validate.main())
 #   except KeyboardInterrupt:
 #       pass
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from ArchiveR3 import *
+import argparse
+from colorlog import ColoredFormatter
+import logging
+import signal
+import sys
+from threading import Event, Thread
+import time
+
+
+class watch:
+    """ Watch archives on local disks for changes, keeping a snapshot of
+    each tree in the data directory so that backup.py and validate.py can
+    inventory an idle archive without walking it. """
+
+    def __init__(self):
+        self.init_vars()
+
+    def init_vars(self):
+        """ Initialize class variables. """
+        self.stop = Event()
+
+    def args_process(self):
+        """ Process command-line arguments. """
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Watch the archives listed in a config file with '
+            'inotify and keep a snapshot of each tree current in the data '
+            'directory.  While this runs, backup.py and validate.py read '
+            'the snapshot instead of walking the archive.  Only archives on '
+            'local disks can be watched, since inotify does not see changes '
+            'made by other machines.  Run it as the user who owns the '
+            'archives.')
+        parser.add_argument('config', action='store',
+                            help='Configuration file, as for backup.py.')
+        parser.add_argument('archives', nargs='*',
+                            help='Archive directories to watch.  By default '
+                            'every local archive in the config file is '
+                            'watched.')
+        self.args = parser.parse_args()
+
+    def archives(self, config):
+        """ Return the archives to watch, skipping any inotify cannot
+        serve. """
+        logger = logging.getLogger()
+        archives = []
+        for archive_dir in [normalize_dir(a) for a in
+                            self.args.archives or config.archives.split()]:
+            fstype = filesystem_type(archive_dir)
+            if fstype not in local_filesystem_types:
+                logger.warning(archive_dir + ': ' + str(fstype) +
+                               ' is not a local filesystem, not watching')
+                continue
+            archives.append(archive_dir)
+        return archives
+
+    def main(self):
+        """ If you call the python as a script, this is what gets executed. """
+        self.args_process()
+
+        logger = logging.getLogger()
+        logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(ColoredFormatter('%(asctime)s %(log_color)s'
+                                              '%(levelname)-8s %(message)s'
+                                              '%(reset)s'))
+        logger.addHandler(handler)
+
+        if not inotify:
+            logger.error('inotify is not available')
+            return 1
+
+        config = config_read(self.args.config)
+        if not config:
+            return 1
+        if dir_validate(config.data_dir, create=1, write=1):
+            return 1
+
+        # Stop cleanly on SIGTERM as well as Ctrl-C.
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop.set())
+
+        threads = []
+        for archive_dir in self.archives(config):
+            watcher = tree_watcher(archive_dir,
+                                   tree_snapshot(watch_file(config,
+                                                            archive_dir)))
+            t = Thread(target=watcher.run, args=(self.stop,))
+            t.daemon = True  # thread dies with the program
+            t.start()
+            threads.append(t)
+        if not threads:
+            logger.error('no archives to watch')
+            return 1
+
+        try:
+            while not self.stop.is_set() and \
+                    [t for t in threads if t.is_alive()]:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        self.stop.set()
+        for t in threads:
+            t.join(10)
+        logger.info('stopped watching')
+
+
+if __name__ == '__main__':
+    sys.stdout = Unbuffered(sys.stdout)
+
+    watch = watch()
+    sys.exit(watch.main())